@@ -0,0 +1,92 @@
+# benchmarks/bench_batch.py
+
+"""Batch throughput against the number of workers. Synthetic artists are served by the stub server and scraped
+   into mongomock by BatchWorkers sharing one ArtistWorkTable, each with its own FetchEngine and rate budget from
+   worker_rate. 'one egress' splits REQUESTS_PER_SECOND between the workers the way workers behind one IP must,
+   'egress per worker' gives every worker a full budget the way one proxy or machine per worker does.
+   Workers are threads here (mongomock can't be shared between processes), `main.py batch` runs processes.
+
+   Usage: python -m benchmarks.bench_batch [--artists N] [--songs N] [--rate R] [--workers 1 2 4]"""
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+import mongomock
+from config import settings
+from scripts.services import registry
+from scripts.slug_index import SlugIndex
+from scripts.batch_ingest import ArtistWorkTable, BatchWorker, worker_rate
+from scripts.fetch_engine import FetchEngine
+from scripts.http_transport import HttpTransport
+from tests.stub_server import StubServer, fixture_routes
+
+def discography_page(slug: str, songs: int) -> str:
+    items = ''.join(f'<div class="listalbum-item"><a href="/lyrics/{slug}/song{i}.html">Song {i}</a></div>\n' for i in range(songs))
+    return f'<html><body><div id="listAlbum">\n<div class="album">album: <b>"First"</b> (2020)</div>\n{items}</div></body></html>'
+
+def catalog(directory: str, artists: int, songs: int) -> tuple:
+    # Routes for every artist's discography and songs, all songs served from one fixture lyrics page
+    lyrics = fixture_routes()['/lyrics/alltimelow/weightless.html']
+    routes, names = {}, []
+    for a in range(artists):
+        slug = f'artist{a}'
+        path = os.path.join(directory, f'{slug}.html')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(discography_page(slug, songs))
+        routes[f'/a/{slug}.html'] = path
+        routes.update((f'/lyrics/{slug}/song{i}.html', lyrics) for i in range(songs))
+        names.append(f'Artist {a}')
+    return routes, names
+
+def run(names: list, workers: int, rate: float) -> float:
+    db = mongomock.MongoClient().db
+    slugs = SlugIndex(':memory:')
+    slugs.add_artists([(name, name_slug) for name, name_slug in zip(names, (f'artist{a}' for a in range(len(names))))])
+    with registry.override(db=db, slug_index=slugs), contextlib.redirect_stdout(io.StringIO()):
+        table = ArtistWorkTable('bench')
+        table.add(names)
+        engines = [FetchEngine(max_workers=4, rate=rate, burst=1, jitter=(0, 0), session=HttpTransport()) for _ in range(workers)]
+        threads = [threading.Thread(target=BatchWorker(table, engine, worker_id=f'w{i}').run, kwargs={'poll_interval': 0.05})
+                   for i, engine in enumerate(engines)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        for engine in engines:
+            engine.close()
+        assert table.counts()['done'] == len(names)
+        return db.songs.count_documents({}) / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch throughput benchmark")
+    parser.add_argument('--artists', type=int, default=8, help="Artists in the batch")
+    parser.add_argument('--songs', type=int, default=12, help="Songs per artist")
+    parser.add_argument('--rate', type=float, default=20, help="REQUESTS_PER_SECOND, the budget of one egress IP")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help="Worker counts to compare")
+    args = parser.parse_args()
+
+    # Indexing the new songs is left out, it doesn't depend on the number of workers
+    with tempfile.TemporaryDirectory() as directory, mock.patch.object(settings, 'REQUESTS_PER_SECOND', args.rate), \
+            mock.patch.object(settings, 'INDEX_ON_UPLOAD', False):
+        routes, names = catalog(directory, args.artists, args.songs)
+        server = StubServer(routes=routes, latency=0.01).start()
+        try:
+            with mock.patch.object(settings, 'AZLYRICS_BASE_URL', server.base_url):
+                print(f'{len(names)} artists x {args.songs} songs, {args.rate:g} requests/s per egress IP')
+                print(f'{"workers":<10}{"one egress":>14}{"egress per worker":>20}  (songs/s)')
+                for workers in args.workers:
+                    shared = run(names, workers, worker_rate(workers))
+                    separate = run(names, workers, worker_rate(workers, [f'proxy{i}' for i in range(workers)]))
+                    print(f'{workers:<10}{shared:14.1f}{separate:20.1f}')
+        finally:
+            server.stop()
+
+if __name__ == '__main__':
+    main()
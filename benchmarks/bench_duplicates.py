@@ -0,0 +1,79 @@
+# benchmarks/bench_duplicates.py
+
+"""Near-duplicate detection over one artist's songs, --versions percent of which are another version
+   (an intro added, a line dropped, a chorus repeated) of another song: 'lsh' checks each song against its
+   banded candidates only, 'pairwise' compares every signature with every earlier canonical one, vectorized.
+   Both report recall and precision against the generated versions; signature time is shared and shown separately.
+
+   Usage: python -m benchmarks.bench_duplicates [--songs N] [--versions PCT]
+   Lyrics are lines of words drawn from the long-tail vocabulary of bench_search."""
+
+import argparse
+import random
+import time
+import numpy as np
+from scripts.near_duplicates import DuplicateDetector, MinHasher
+from benchmarks.bench_search import long_tail
+
+def make_songs(n_songs: int, versions: float) -> tuple:
+    rng = random.Random(1)
+    # 24 lines of 8 words per song, the first four lines come back as a chorus
+    lines = long_tail(n_songs * 24, words=8)
+    originals = ['\n'.join(lines[i:i + 24] + lines[i:i + 4]) for i in range(0, len(lines), 24)]
+    songs, expected = [], {}
+    for i, text in enumerate(originals):
+        songs.append((f'Song {i}', text))
+        if rng.random() < versions / 100:
+            lines = text.split('\n')
+            del lines[rng.randrange(len(lines))]
+            version = '\n'.join(['Thank you, good night!'] + lines + lines[-3:])
+            songs.append((f'Song {i} (Live)', version))
+            expected[f'Song {i} (Live)'] = f'Song {i}'
+    return songs, expected
+
+def pairwise(signatures: list, threshold: float) -> dict:
+    # Every earlier canonical signature compared at once, still a comparison per pair
+    matrix = np.empty((len(signatures), len(signatures[0][1])), dtype=np.uint32)
+    canonical, found = [], {}
+    for title, signature in signatures:
+        scores = np.count_nonzero(matrix[:len(canonical)] == signature, axis=1) / len(signature)
+        best = int(scores.argmax()) if len(canonical) else None
+        if best is not None and scores[best] >= threshold:
+            found[title] = canonical[best]
+        else:
+            matrix[len(canonical)] = signature
+            canonical.append(title)
+    return found
+
+def lsh(signatures: list, detector: DuplicateDetector) -> dict:
+    found = {}
+    for title, signature in signatures:
+        match = detector.match(signature)
+        if match is None:
+            detector.add(title, signature)
+        else:
+            found[title] = match[0]
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="Near-duplicate detection benchmark")
+    parser.add_argument('--songs', type=int, default=5000, help="Original songs")
+    parser.add_argument('--versions', type=float, default=20, help="Percent of songs that also have a live version")
+    args = parser.parse_args()
+
+    songs, expected = make_songs(args.songs, args.versions)
+    detector = DuplicateDetector(MinHasher())
+    start = time.perf_counter()
+    signatures = [(title, detector.hasher.signature(text)) for title, text in songs]
+    print(f'{len(songs)} songs, {len(expected)} versions, signatures {time.perf_counter() - start:.2f} s')
+
+    print(f'{"":<10}{"time":>10}{"recall":>10}{"precision":>11}')
+    for label, find in (('lsh', lambda: lsh(signatures, detector)), ('pairwise', lambda: pairwise(signatures, detector.threshold))):
+        start = time.perf_counter()
+        found = find()
+        elapsed = time.perf_counter() - start
+        correct = sum(expected.get(title) == canonical for title, canonical in found.items())
+        print(f'{label:<10}{elapsed:8.2f} s{correct / max(len(expected), 1):10.3f}{correct / max(len(found), 1):11.3f}')
+
+if __name__ == '__main__':
+    main()
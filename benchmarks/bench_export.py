@@ -0,0 +1,85 @@
+# benchmarks/bench_export.py
+
+"""Parquet export cost, and what it buys analytics: mean VADER compound score per artist and year computed
+   'from mongo' by paging every song through the cursor into dicts (what the notebooks do today) and
+   'from parquet' as a column-pruned scan of the export grouped in Arrow. Peak memory is tracemalloc's for the
+   Python side and the Arrow pool's for the scan. 'sync' rows rerun the export after --new percent new songs
+   (appended as new part files) and with nothing changed.
+
+   Usage: python -m benchmarks.bench_export [--songs N] [--artists N] [--new PCT]
+   Runs against mongomock, whose cursor copies every document and so is slower than pymongo's;
+   lyrics are built from the saved fixture pages as in bench_sentiment."""
+
+import argparse
+import random
+import tempfile
+import time
+import tracemalloc
+import mongomock
+import pyarrow as pa
+from scripts.export_parquet import export_songs, songs_dataset
+from scripts.sentiment_engine import NRC_EMOTIONS
+from benchmarks.bench_sentiment import make_lyrics
+
+def make_songs(n_songs: int, n_artists: int, start: int = 0) -> list:
+    rng = random.Random(start)
+    lyrics = make_lyrics(n_songs)
+    return [{'title': f'Song {i}', 'artist': f'Artist {i % n_artists}', 'album': 'Album', 'lyrics': text,
+             'release_year': str(2000 + i % 20), 'lyrics_hash': str(i), 'genre': 'Rock', 'writers': 'Someone',
+             'sentiment': {'vader': {'neg': 0.1, 'neu': 0.6, 'pos': 0.3, 'compound': rng.uniform(-1, 1)},
+                           'nrc': {emotion: rng.random() for emotion in NRC_EMOTIONS}}}
+            for i, text in zip(range(start, start + n_songs), lyrics)]
+
+def from_mongo(songs) -> dict:
+    totals = {}
+    for song in songs.find():
+        key = (song['artist'], song['release_year'])
+        total, count = totals.get(key, (0.0, 0))
+        totals[key] = (total + song['sentiment']['vader']['compound'], count + 1)
+    return {key: total / count for key, (total, count) in totals.items()}
+
+def from_parquet(directory: str) -> dict:
+    table = songs_dataset(directory).to_table(columns=['artist', 'release_year', 'vader_compound'])
+    means = table.group_by(['artist', 'release_year']).aggregate([('vader_compound', 'mean')])
+    return {(row['artist'], row['release_year']): row['vader_compound_mean'] for row in means.to_pylist()}
+
+def timed(fn, *args) -> tuple:
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def main():
+    parser = argparse.ArgumentParser(description="Parquet export benchmark")
+    parser.add_argument('--songs', type=int, default=20000, help="Songs in the collection")
+    parser.add_argument('--artists', type=int, default=50, help="Artists the songs are spread over")
+    parser.add_argument('--new', type=float, default=1, help="Percent of new songs before the sync rerun")
+    args = parser.parse_args()
+
+    songs = mongomock.MongoClient().db.songs
+    songs.insert_many(make_songs(args.songs, args.artists))
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        export_songs(songs, directory, full=True)
+        print(f'{"full export":<16}{args.songs / (time.perf_counter() - start):10.0f} songs/s')
+
+        n_new = int(args.songs * args.new / 100)
+        songs.insert_many(make_songs(n_new, args.artists, start=args.songs))
+        for label in (f'sync +{args.new:g}%', 'sync unchanged'):
+            start = time.perf_counter()
+            stats = export_songs(songs, directory)
+            print(f'{label:<16}{time.perf_counter() - start:10.2f} s   {stats}')
+
+        expected, mongo_time, mongo_peak = timed(from_mongo, songs)
+        pool = pa.default_memory_pool()
+        means, parquet_time, _ = timed(from_parquet, directory)
+        assert means.keys() == expected.keys() and all(abs(means[k] - expected[k]) < 1e-9 for k in means)
+        print(f'{"mean per artist/year":<22}{"time":>10}{"peak":>12}')
+        print(f'{"from mongo":<22}{mongo_time * 1000:8.0f} ms{mongo_peak / 2**20:8.1f} MiB')
+        print(f'{"from parquet":<22}{parquet_time * 1000:8.0f} ms{pool.max_memory() / 2**20:8.1f} MiB')
+
+if __name__ == '__main__':
+    main()
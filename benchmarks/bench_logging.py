@@ -0,0 +1,74 @@
+# benchmarks/bench_logging.py
+
+"""Logging cost per scraped song. Each row runs AZLyrics.open_url over the fixture pages served from a warm
+   page cache (see bench_metrics) with a different logging setup. Each page is parsed once up front and the
+   parser answers from that, so parsing doesn't drown out the logging. 'sync DEBUG' writes every line, lyrics
+   included, from the scraping thread the way runs used to log; the async rows only queue records and leave
+   formatting and writing to the listener thread. 'us/song' is what the scraper waits for, 'drained' adds the
+   time to flush the queue at the end, 'bytes/song' is what reached the log file.
+
+   Usage: python -m benchmarks.bench_logging [--repeat N]"""
+
+import argparse
+import glob
+import logging
+import os
+import shutil
+import tempfile
+import time
+from scripts.log_config import setup_logging, stop_logging
+from benchmarks.bench_metrics import scrapers
+
+MODES = (
+    ('no handler', None),
+    ('sync DEBUG', dict(level='DEBUG', json_format=False, use_queue=False)),
+    ('sync INFO', dict(level='INFO', json_format=False, use_queue=False)),
+    ('async DEBUG', dict(level='DEBUG', json_format=False, use_queue=True)),
+    ('async INFO', dict(level='INFO', json_format=False, use_queue=True)),
+    ('async JSON DEBUG', dict(level='DEBUG', json_format=True, use_queue=True)),
+    ('async DEBUG 1/10', dict(level='DEBUG', json_format=False, use_queue=True, sample_every=10)),
+)
+
+def run(songs: list, repeat: int, directory: str, options: dict) -> tuple:
+    root = logging.getLogger()
+    path = os.path.join(directory, 'scraping.log')
+    if options is None:
+        root.setLevel(logging.WARNING)
+    else:
+        setup_logging(path, max_bytes=0, **options)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for song in songs:
+            song.open_url()
+    scraped = time.perf_counter() - start
+    stop_logging()
+    drained = time.perf_counter() - start
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    size = sum(os.path.getsize(f) for f in glob.glob(path + '*'))
+    for f in glob.glob(path + '*'):
+        os.remove(f)
+    count = repeat * len(songs)
+    return scraped / count * 1e6, drained / count * 1e6, size / count
+
+def main():
+    parser = argparse.ArgumentParser(description="Logging overhead benchmark")
+    parser.add_argument('--repeat', type=int, default=2000, help="Passes over the fixture pages per run")
+    args = parser.parse_args()
+
+    songs = scrapers()
+    for song in songs:
+        parsed = song.open_url()
+        song.parser.parse = lambda html, parsed=parsed: parsed
+    directory = tempfile.mkdtemp()
+    try:
+        print(f'{"mode":<20}{"us/song":>10}{"drained":>10}{"bytes/song":>12}')
+        for label, options in MODES:
+            best = min((run(songs, args.repeat, directory, options) for _ in range(3)), key=lambda r: r[0])
+            print(f'{label:<20}{best[0]:10.1f}{best[1]:10.1f}{best[2]:12.0f}')
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# benchmarks/bench_metrics.py
+
+"""What instrumentation costs. 'per call' rows time a counter increment and an empty timer block with the
+   registry disabled (every run without --metrics) and enabled. 'scrape' rows run AZLyrics.open_url over the
+   fixture pages served from a warm in-memory page cache, the cheapest instrumented path there is,
+   so the difference between its rows is an upper bound on the overhead of a real scrape.
+
+   Usage: python -m benchmarks.bench_metrics [--calls N] [--repeat N]"""
+
+import argparse
+import glob
+import os
+import timeit
+from scripts.metrics import MetricsRegistry, metrics
+from scripts.http_transport import HttpTransport
+from scripts.page_cache import MemoryPageCache
+from scripts.scrape_lyrics import AZLyrics
+from benchmarks.bench_parsing import FIXTURE_DIR
+
+def per_call(registry: MetricsRegistry, calls: int) -> tuple:
+    def timer():
+        with registry.timer('stage_seconds', stage='bench'):
+            pass
+    inc = min(timeit.repeat(lambda: registry.inc('requests_total', status='2xx'), number=calls, repeat=3))
+    timed = min(timeit.repeat(timer, number=calls, repeat=3))
+    return inc / calls * 1e9, timed / calls * 1e9
+
+def scrapers() -> list:
+    # One AZLyrics per fixture page, the pages already cached under the URLs they build
+    cache = MemoryPageCache()
+    transport = HttpTransport(cache=cache, ttl=float('inf'))
+    songs = []
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, 'lyrics_*.html'))):
+        artist, song = os.path.basename(path)[len('lyrics_'):-len('.html')].split('_')
+        scraper = AZLyrics(artist, song, fetcher=transport)
+        with open(path, 'rb') as f:
+            cache.put(scraper.url(), f.read(), encoding='utf-8')
+        songs.append(scraper)
+    return songs
+
+def main():
+    parser = argparse.ArgumentParser(description="Metrics overhead benchmark")
+    parser.add_argument('--calls', type=int, default=200000, help="Calls per 'per call' run")
+    parser.add_argument('--repeat', type=int, default=50, help="Passes over the fixture pages per 'scrape' run")
+    args = parser.parse_args()
+
+    print(f'{"per call":<16}{"inc ns":>10}{"timer ns":>10}')
+    for label, enabled in (('disabled', False), ('enabled', True)):
+        inc, timed = per_call(MetricsRegistry(enabled=enabled), args.calls)
+        print(f'{label:<16}{inc:10.0f}{timed:10.0f}')
+
+    songs = scrapers()
+    print(f'{"scrape":<16}{"ms/page":>10}')
+    for label, enabled in (('disabled', False), ('enabled', True)):
+        metrics.enabled = enabled
+        runs = timeit.repeat(lambda: [song.open_url() for song in songs], number=args.repeat, repeat=3)
+        print(f'{label:<16}{min(runs) / (args.repeat * len(songs)) * 1000:10.3f}')
+    metrics.enabled = False
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# benchmarks/bench_mongo_ingest.py
+
+"""Song ingest cost into a library that already holds other artists' songs:
+   'per-song' is the old find_one + insert_one round trip per song on unindexed collections,
+   'bulk' is the add_artist_to_db(bulk=True) path: unique indexes, one prefetch query and batched upserts.
+
+   Usage: python -m benchmarks.bench_mongo_ingest [--existing N] [--songs N] [--batch_size N] [--rtt MS] [--uri mongodb://...]
+   Without --uri the benchmark runs against mongomock. mongomock scans the collection for every lookup,
+   indexes or not, so there the gain comes from fewer round trips; --rtt adds a simulated network round trip
+   to every collection call. Against a real mongod (--uri, --rtt 0) the indexes remove the scans as well."""
+
+import argparse
+import time
+import scripts.upload_to_mongodb as upload
+from scripts.services import registry
+
+class RoundTrips:
+    """ Collection proxy counting calls, each call waits rtt seconds like a request to a remote server."""
+
+    def __init__(self, collection, rtt: float):
+        self._collection = collection
+        self._rtt = rtt
+        self.count = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            self.count += 1
+            if self._rtt:
+                time.sleep(self._rtt)
+            return attr(*args, **kwargs)
+        return call
+
+def make_song(artist: str, i: int) -> dict:
+    return {'title': f'Song {i}', 'artist': artist, 'album': 'Album', 'release_year': '2020',
+            'lyrics': 'la ' * 200, 'genre': 'Rock', 'writers': 'Someone'}
+
+def per_song(songs, artist: str, n_songs: int):
+    for i in range(n_songs):
+        if not songs.find_one({'title': f'Song {i}', 'artist': artist}):
+            songs.insert_one(make_song(artist, i))
+
+def bulk(songs, artist: str, n_songs: int, batch_size: int):
+    upload.ensure_indexes()
+    existing = upload._existing_titles(songs, artist)
+    with upload.BulkUpserter(songs, batch_size) as writer:
+        for i in range(n_songs):
+            if f'Song {i}' not in existing:
+                writer.add(make_song(artist, i))
+
+def fresh_db(args):
+    if args.uri:
+        from pymongo import MongoClient
+        client = MongoClient(args.uri)
+        client.drop_database('lyrical_analysis_bench')
+        db = client.lyrical_analysis_bench
+    else:
+        import mongomock
+        db = mongomock.MongoClient().lyrical_analysis_bench
+    # Other artists' songs already in the library
+    if args.existing:
+        db.songs.insert_many([make_song(f'Artist {i % 100}', i) for i in range(args.existing)])
+    return db
+
+def run(name: str, fn, args):
+    db = fresh_db(args)
+    songs = RoundTrips(db.songs, args.rtt / 1000)
+    with registry.override(db=db, songs_collection=songs):
+        start = time.perf_counter()
+        fn(songs)
+        elapsed = time.perf_counter() - start
+    print(f'{name:<10}{elapsed:8.3f} s  {args.songs / elapsed:10.1f} songs/s  {songs.count:6d} round trips')
+
+def main():
+    parser = argparse.ArgumentParser(description="MongoDB song ingest benchmark")
+    parser.add_argument('--existing', type=int, default=5000, help="Songs already stored for other artists")
+    parser.add_argument('--songs', type=int, default=300, help="Songs ingested for the new artist")
+    parser.add_argument('--batch_size', type=int, default=100, help="Upserts per bulk_write")
+    parser.add_argument('--rtt', type=float, default=1.0, help="Simulated milliseconds per collection call")
+    parser.add_argument('--uri', type=str, help="Benchmark a real mongod instead of mongomock")
+    args = parser.parse_args()
+
+    print(f'{args.existing} existing songs, ingesting {args.songs} ({"mongod" if args.uri else "mongomock"}, rtt {args.rtt} ms)')
+    run('per-song', lambda songs: per_song(songs, 'New Artist', args.songs), args)
+    run('bulk', lambda songs: bulk(songs, 'New Artist', args.songs, args.batch_size), args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# benchmarks/bench_parsing.py
+
+"""Per-page parse cost of the saved lyrics fixtures for each LyricsPageParser backend.
+   The 'four DOMs' row rebuilds BeautifulSoup once per field the way AZLyrics.open_url used to.
+
+   Usage: python -m benchmarks.bench_parsing [--repeat N]"""
+
+import argparse
+import glob
+import os
+import timeit
+from bs4 import BeautifulSoup
+from scripts.page_parser import LyricsPageParser
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'fixtures', 'pages')
+
+def load_pages() -> list:
+    pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, 'lyrics_*.html'))):
+        with open(path, 'r', encoding='utf-8') as f:
+            pages.append(f.read())
+    return pages
+
+def four_doms(html: str):
+    for _ in range(4):
+        BeautifulSoup(html, 'html.parser')
+
+def bench(fn, pages: list, repeat: int) -> float:
+    # Best of three runs, reported as milliseconds per page
+    runs = timeit.repeat(lambda: [fn(page) for page in pages], number=repeat, repeat=3)
+    return min(runs) / (repeat * len(pages)) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Lyrics page parsing micro-benchmark")
+    parser.add_argument('--repeat', type=int, default=50, help="Passes over the fixture pages per run")
+    args = parser.parse_args()
+
+    pages = load_pages()
+    print(f'{len(pages)} fixture pages, {args.repeat} passes')
+    print(f'{"four DOMs (html.parser)":<26}{bench(four_doms, pages, args.repeat):8.3f} ms/page')
+    for backend in LyricsPageParser.BACKENDS:
+        try:
+            page_parser = LyricsPageParser(backend=backend)
+            page_parser.parse(pages[0])
+        except Exception as e: # Backend not installed
+            print(f'{backend:<26}skipped ({e})')
+            continue
+        print(f'{backend:<26}{bench(page_parser.parse, pages, args.repeat):8.3f} ms/page')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# benchmarks/bench_rollups.py
+
+"""Per-album sentiment summaries for a dashboard, and what keeping them current costs:
+   'client-side' pulls every scored song and averages in Python (what a dashboard does without rollups),
+   'rollups' reads the precomputed album_sentiment rows. The refresh rows time refresh_rollups after --changed
+   percent of the songs were rescored, incrementally and with --full, which recomputes every group.
+
+   Usage: python -m benchmarks.bench_rollups [--songs N] [--artists N] [--changed PCT]
+   Runs against mongomock, which scans the collection for every query and every marked song and runs pipelines
+   in Python, so absolute times are pessimistic; the gap between rows is what the aggregation pushdown saves."""
+
+import argparse
+import random
+import statistics
+import time
+import mongomock
+from scripts.sentiment_engine import NRC_EMOTIONS, sentiment_fields
+from scripts.sentiment_rollups import get_rollups, refresh_rollups
+from scripts.services import registry
+
+def make_songs(n_songs: int, n_artists: int) -> list:
+    rng = random.Random(0)
+    songs = []
+    for i in range(n_songs):
+        sentiment = {'vader': {'neg': 0.1, 'neu': 0.6, 'pos': 0.3, 'compound': rng.uniform(-1, 1)},
+                     'nrc': {emotion: rng.random() for emotion in NRC_EMOTIONS}}
+        songs.append({'title': f'Song {i}', 'artist': f'Artist {i % n_artists}', 'album': f'Album {i % (n_artists * 5)}',
+                      'release_year': str(2000 + i % 20), 'lyrics': 'la ' * 200, 'lyrics_hash': str(i),
+                      **sentiment_fields(sentiment, str(i))})
+    return songs
+
+def client_side(songs) -> dict:
+    compounds = {}
+    for song in songs.find({'sentiment': {'$exists': True}}):
+        compounds.setdefault((song['artist'], song['album']), []).append(song['sentiment']['vader']['compound'])
+    return {key: (statistics.fmean(values), statistics.pvariance(values)) for key, values in compounds.items()}
+
+def timed(fn, *args, **kwargs) -> tuple:
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Sentiment rollups benchmark")
+    parser.add_argument('--songs', type=int, default=3000, help="Songs in the collection")
+    parser.add_argument('--artists', type=int, default=30, help="Artists the songs are spread over, 5 albums each")
+    parser.add_argument('--changed', type=float, default=1, help="Percent of songs rescored before the refresh")
+    args = parser.parse_args()
+
+    db = mongomock.MongoClient().lyrical_analysis_db
+    db.songs.insert_many(make_songs(args.songs, args.artists))
+    with registry.override(db=db):
+        _, build = timed(refresh_rollups)
+        expected, client = timed(client_side, db.songs)
+        rows, read = timed(get_rollups, 'album')
+        assert len(rows) == len(expected)
+        assert all(abs(row['vader_compound']['mean'] - expected[(row['artist'], row['album'])][0]) < 1e-9 for row in rows)
+        print(f'{"album summaries":<24}{"ms":>10}')
+        print(f'{"client-side":<24}{client:10.0f}')
+        print(f'{"rollups":<24}{read:10.0f}')
+
+        rng = random.Random(1)
+        for label, full in (('refresh incremental', False), ('refresh --full', True)):
+            for i in rng.sample(range(args.songs), int(args.songs * args.changed / 100)):
+                sentiment = {'vader': {'compound': rng.uniform(-1, 1)}, 'nrc': dict.fromkeys(NRC_EMOTIONS, 0.5)}
+                db.songs.update_one({'title': f'Song {i}'}, {'$set': sentiment_fields(sentiment, f'{i}-{label}')})
+            _, refresh = timed(refresh_rollups, full=full)
+            print(f'{label:<24}{refresh:10.0f}')
+        print(f'{"initial build":<24}{build:10.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# benchmarks/bench_search.py
+
+"""Query latency of the lyrics search index against scanning every lyric for the phrase, at growing corpus sizes:
+   'scan' is `phrase in lyrics.lower()` over lyrics already in memory (what a search costs today, minus reading
+   every document out of MongoDB), 'index' runs SearchIndex.search for the first --limit songs like `main.py search`.
+   'rare' is a phrase planted in one song in a thousand, 'common' a phrase from the fixture pages, 'boolean'
+   mixes OR and NOT over long-tail words. The scan grows with the corpus, the index with the matches.
+
+   Usage: python -m benchmarks.bench_search [--songs N [N ...]] [--repeat N] [--limit N]
+   Lyrics are built from the saved fixture pages as in bench_sentiment, plus a line of words drawn from a
+   Zipf-distributed vocabulary so the index sees a realistic long tail of terms."""
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from scripts.search_index import SearchIndex
+from benchmarks.bench_sentiment import make_lyrics
+
+RARE = 'velvet thunder lullaby'
+QUERIES = {
+    'rare': f'"{RARE}"',
+    'common': '"on the other side"',
+    'boolean': '(w20 OR w21) coffee -w30',
+}
+
+def long_tail(n_songs: int, words: int = 30, vocabulary: int = 50000) -> list:
+    rng = np.random.default_rng(0)
+    ranks = np.minimum(rng.zipf(1.2, size=(n_songs, words)), vocabulary)
+    return [' '.join(f'w{rank}' for rank in row) for row in ranks]
+
+def best_of(fn, repeat: int) -> float:
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return min(runs) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Lyrics search benchmark")
+    parser.add_argument('--songs', type=int, nargs='+', default=[5000, 20000, 80000], help="Corpus sizes")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per query, the fastest is reported")
+    parser.add_argument('--limit', type=int, default=20, help="Songs returned per query")
+    args = parser.parse_args()
+
+    print(f'{"songs":>7}{"query":>9}{"matches":>9}{"scan":>11}{"index":>11}')
+    for n_songs in args.songs:
+        lyrics = [f'{text}\n{tail}' for text, tail in zip(make_lyrics(n_songs), long_tail(n_songs))]
+        lyrics = [text + f'\n{RARE}' if i % 1000 == 0 else text for i, text in enumerate(lyrics)]
+        with tempfile.TemporaryDirectory() as directory:
+            index = SearchIndex(directory)
+            start = time.perf_counter()
+            for first in range(0, n_songs, 2000):
+                index.add_many([{'_id': i, 'lyrics': lyrics[i], 'lyrics_hash': '', 'artist': 'Artist', 'title': f'Song {i}'}
+                                for i in range(first, min(first + 2000, n_songs))])
+            index.compact()
+            built = time.perf_counter() - start
+            size = os.path.getsize(os.path.join(directory, 'index.sqlite'))
+            raw = sum(len(text.encode('utf-8')) for text in lyrics)
+            print(f'{n_songs:>7} songs indexed in {built:.1f} s, index {size / 2**20:.1f} MiB for {raw / 2**20:.1f} MiB of lyrics')
+
+            for name, query in QUERIES.items():
+                phrase = query.strip('"')
+                scan = best_of(lambda: [text for text in lyrics if phrase in text.lower()], args.repeat)
+                matches = len(index.match(query))
+                indexed = best_of(lambda: index.search(query, limit=args.limit), args.repeat)
+                scan_cell = f'{scan:8.2f} ms' if name != 'boolean' else f'{"":>11}'
+                print(f'{"":>7}{name:>9}{matches:>9}{scan_cell}{indexed:8.2f} ms')
+            index.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# benchmarks/bench_sentiment.py
+
+"""Songs/sec for scoring lyrics, then for scoring a collection and writing the sentiment back:
+   'per-song' is sentiment_analysis.update_song_with_sentiment over the cursor, one VADER + NRCLex pass and one
+   update_one per song, the BatchSentimentEngine rows score chunks and write with batched bulk_write.
+   NRCLex needs the nltk punkt tokenizer, without it the per-song rows score VADER only (and are flattered by it).
+
+   Usage: python -m benchmarks.bench_sentiment [--songs N] [--processes N] [--chunk_size N] [--rtt MS]
+   Runs against mongomock, lyrics are built from the saved fixture pages with their lines shuffled.
+   mongomock scans the collection on every update, so --rtt adds a simulated network round trip per call
+   as in bench_mongo_ingest. The last rows rerun a scored collection after --new percent of songs were added,
+   once rescoring everything and once incrementally."""
+
+import argparse
+import glob
+import os
+import random
+import time
+from unittest import mock
+import mongomock
+import nltk
+from scripts.page_parser import LyricsPageParser
+from scripts.sentiment_engine import BatchSentimentEngine
+from scripts.upload_to_mongodb import lyrics_hash
+import scripts.sentiment_analysis as sentiment_analysis
+from scripts.services import registry
+from benchmarks.bench_mongo_ingest import RoundTrips
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'fixtures', 'pages')
+
+def make_lyrics(n_songs: int) -> list:
+    page_parser = LyricsPageParser()
+    lines = []
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, 'lyrics_*.html'))):
+        with open(path, 'r', encoding='utf-8') as f:
+            lines.extend(line for line in page_parser.parse(f.read())[0].splitlines() if line.strip())
+    rng = random.Random(0)
+    return ['\n'.join(rng.choices(lines, k=40)) for _ in range(n_songs)]
+
+def make_collection(lyrics: list):
+    songs = mongomock.MongoClient().db.songs
+    songs.insert_many([{'title': f'Song {i}', 'artist': 'Artist', 'lyrics': text, 'lyrics_hash': lyrics_hash(text),
+                        'sentiment_stale': True} for i, text in enumerate(lyrics)])
+    return songs
+
+def has_punkt() -> bool:
+    try:
+        nltk.data.find('tokenizers/punkt_tab')
+        return True
+    except LookupError:
+        return False
+
+def nrc_patch() -> dict:
+    return {} if has_punkt() else {'analyze_sentiment_nrc': lambda text: {}}
+
+def score_per_song(lyrics: list):
+    with mock.patch.multiple(sentiment_analysis, **nrc_patch()):
+        for text in lyrics:
+            sentiment_analysis.analyze_sentiment_vader(text)
+            sentiment_analysis.analyze_sentiment_nrc(text)
+
+def per_song(songs):
+    with registry.override(songs_collection=songs), mock.patch.multiple(sentiment_analysis, **nrc_patch()):
+        for song in songs.find():
+            sentiment_analysis.update_song_with_sentiment(song, rollups=False)
+
+def timed(fn, lyrics: list, rtt: float = None) -> float:
+    target = lyrics
+    if rtt is not None:
+        target = RoundTrips(make_collection(lyrics), rtt)
+    start = time.perf_counter()
+    fn(target)
+    return len(lyrics) / (time.perf_counter() - start)
+
+def rerun(lyrics: list, new: float, incremental: bool) -> float:
+    # Seconds for a nightly run once `new` percent of the songs arrived since the last one
+    engine = BatchSentimentEngine(processes=1)
+    n_new = int(len(lyrics) * new / 100)
+    songs = make_collection(lyrics[n_new:])
+    engine.update_collection(songs)
+    engine.mark_stale(songs) # The one-off flagging of a new SENTIMENT_VERSION isn't part of a nightly run
+    songs.insert_many([{'title': f'New {i}', 'artist': 'Artist', 'lyrics': text, 'lyrics_hash': lyrics_hash(text),
+                        'sentiment_stale': True} for i, text in enumerate(lyrics[:n_new])])
+    start = time.perf_counter()
+    engine.update_collection(songs, incremental=incremental)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Sentiment scoring benchmark")
+    parser.add_argument('--songs', type=int, default=2000, help="Songs in the collection")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help="Processes for the pooled engine row")
+    parser.add_argument('--chunk_size', type=int, default=500, help="Songs per engine task")
+    parser.add_argument('--rtt', type=float, default=1, help="Simulated milliseconds per collection call")
+    parser.add_argument('--new', type=float, default=1, help="Percent of new songs before the rerun rows")
+    args = parser.parse_args()
+
+    lyrics = make_lyrics(args.songs)
+    label = 'per-song' if has_punkt() else 'per-song (VADER only)'
+    engines = [BatchSentimentEngine(processes=processes, chunk_size=args.chunk_size)
+               for processes in sorted({1, max(args.processes, 1)})]
+    print(f'{args.songs} songs, {sum(len(text.split()) for text in lyrics) // args.songs} words each')
+    print('scoring only')
+    print(f'  {label:<30}{timed(score_per_song, lyrics):10.1f} songs/s')
+    for engine in engines:
+        score = lambda texts: list(engine.score_songs({'_id': i, 'lyrics': text} for i, text in enumerate(texts)))
+        print(f'  {f"batch, {engine.processes} process(es)":<30}{timed(score, lyrics):10.1f} songs/s')
+    print(f'scoring + writing back, {args.rtt} ms per call')
+    print(f'  {label:<30}{timed(per_song, lyrics, args.rtt / 1000):10.1f} songs/s')
+    for engine in engines:
+        print(f'  {f"batch, {engine.processes} process(es)":<30}{timed(engine.update_collection, lyrics, args.rtt / 1000):10.1f} songs/s')
+    print(f'rerun after {args.new}% new songs, 1 process')
+    print(f'  {"full":<30}{rerun(lyrics, args.new, False):10.3f} s')
+    print(f'  {"incremental":<30}{rerun(lyrics, args.new, True):10.3f} s')
+
+if __name__ == '__main__':
+    main()
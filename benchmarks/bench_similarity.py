@@ -0,0 +1,70 @@
+# benchmarks/bench_similarity.py
+
+"""Recall and latency of the IVF similarity index against exact search over the same memory-mapped vectors:
+   'exact' scores every stored song, the nprobe rows scan that many of the index's clusters. recall@k is the share
+   of the exact top k the index returns, averaged over --queries songs of the collection.
+
+   Usage: python -m benchmarks.bench_similarity [--songs N] [--queries N] [-k N] [--nlist N]
+   Vectors are hashed n-gram embeddings of lyrics built from the saved fixture pages (see bench_sentiment),
+   stored in a temporary directory. The last row times the first query of a freshly opened index."""
+
+import argparse
+import tempfile
+import time
+import numpy as np
+from scripts.generate_embeddings import EmbeddingStore, HashedNgramEmbedder
+from scripts.similarity_index import IVFIndex, exact_search
+from benchmarks.bench_sentiment import make_lyrics
+
+def timed_queries(search, rows: list) -> tuple:
+    results, times = [], []
+    for row in rows:
+        start = time.perf_counter()
+        results.append(search(row))
+        times.append(time.perf_counter() - start)
+    return results, np.percentile(times, 50) * 1000, np.percentile(times, 99) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Similarity index benchmark")
+    parser.add_argument('--songs', type=int, default=20000, help="Songs in the store")
+    parser.add_argument('--queries', type=int, default=200, help="Query songs")
+    parser.add_argument('-k', type=int, default=10, help="Neighbours per query")
+    parser.add_argument('--nlist', type=int, help="Index clusters, defaults to settings.ANN_NLIST")
+    args = parser.parse_args()
+
+    embedder = HashedNgramEmbedder()
+    with tempfile.TemporaryDirectory() as directory:
+        store = EmbeddingStore(directory, dim=embedder.dim, model=embedder.name)
+        lyrics = make_lyrics(args.songs)
+        for start in range(0, args.songs, 1000):
+            batch = range(start, min(start + 1000, args.songs))
+            store.put_many([(str(i), '', 'Artist', f'Song {i}') for i in batch], embedder.embed_many(lyrics[start:start + 1000]))
+
+        start = time.perf_counter()
+        index = IVFIndex(store, nlist=args.nlist)
+        index.build()
+        print(f'{args.songs} songs, dim {store.dim}: built {index.meta["nlist"]} clusters in {time.perf_counter() - start:.2f} s')
+
+        rows = np.random.default_rng(0).choice(args.songs, size=min(args.queries, args.songs), replace=False).tolist()
+        vectors = store.vectors()
+        exact, p50, p99 = timed_queries(lambda row: exact_search(vectors, np.asarray(vectors[row]), args.k, exclude=row), rows)
+        print(f'{"search":<12}{"recall@" + str(args.k):>10}{"p50":>10}{"p99":>10}')
+        print(f'{"exact":<12}{1:>10.3f}{p50:>7.2f} ms{p99:>7.2f} ms')
+        truth = [{row for row, _ in hits} for hits in exact]
+        for nprobe in (1, 2, 4, 8, 16, 32):
+            if nprobe > index.meta['nlist']:
+                break
+            found, p50, p99 = timed_queries(
+                lambda row: index.search(np.asarray(vectors[row]), args.k, nprobe=nprobe, exclude=row), rows)
+            recall = np.mean([len(expected & {row for row, _ in hits}) / len(expected) for expected, hits in zip(truth, found)])
+            print(f'{"nprobe " + str(nprobe):<12}{recall:>10.3f}{p50:>7.2f} ms{p99:>7.2f} ms')
+
+        store.close()
+        start = time.perf_counter()
+        store = EmbeddingStore(directory)
+        IVFIndex(store).search(np.asarray(store.vectors()[rows[0]]), args.k, exclude=rows[0])
+        print(f'{"cold open":<12}{"":>10}{(time.perf_counter() - start) * 1000:>7.2f} ms')
+        store.close()
+
+if __name__ == '__main__':
+    main()
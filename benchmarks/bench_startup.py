@@ -0,0 +1,65 @@
+# benchmarks/bench_startup.py
+
+"""CLI startup cost per main.py subcommand, each measured in a fresh interpreter (best of --repeat runs):
+   'cli' runs `python main.py <command> --help`, i.e. interpreter + main.py + argument parsing,
+   'ready' additionally imports every module the command loads before its first request or query.
+   Neither may create a service (MongoDB client, analyzer, lexicon), that is checked on every 'ready' run.
+
+   Usage: python -m benchmarks.bench_startup [--repeat N]"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+# What each command imports when it runs, mirrors the imports inside main.py's command functions
+COMMAND_MODULES = {
+    'discography': ['scripts.scrape_discography'],
+    'song': ['scripts.scrape_lyrics'],
+    'upload': ['concurrent.futures', 'scripts.fetch_engine', 'scripts.upload_to_mongodb'],
+    'bulk': ['scripts.fetch_engine', 'scripts.bulk_scrape_lyrics'],
+    'enqueue': ['scripts.scrape_discography', 'scripts.job_queue'],
+    'work': ['concurrent.futures', 'scripts.job_queue'],
+    'queue-status': ['scripts.job_queue'],
+    'reparse': ['scripts.upload_to_mongodb'],
+    'similar': ['scripts.similarity_index'],
+    'search': ['scripts.search_index'],
+    'export': ['scripts.export_parquet'],
+    'list': [],
+}
+
+def best_of(cmd: list, repeat: int) -> float:
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(cmd, cwd=ROOT, capture_output=True, text=True)
+        runs.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError(f'{" ".join(cmd)} failed: {result.stderr}')
+    return min(runs) * 1000
+
+def ready_command(modules: list) -> list:
+    code = ['import main, importlib', *(f'importlib.import_module({module!r})' for module in modules),
+            'from scripts.services import registry',
+            'assert not registry.created(), registry.created()']
+    return [sys.executable, '-c', '\n'.join(code)]
+
+def main():
+    parser = argparse.ArgumentParser(description="CLI startup benchmark")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per command, the fastest is reported")
+    args = parser.parse_args()
+
+    baseline = best_of([sys.executable, '-c', 'pass'], args.repeat)
+    print(f'bare interpreter {baseline:.0f} ms, best of {args.repeat}')
+    print(f'{"command":<14}{"cli":>8}{"ready":>10}')
+    for command, modules in COMMAND_MODULES.items():
+        cli = best_of([sys.executable, 'main.py', command, '--help'], args.repeat)
+        ready = best_of(ready_command(modules), args.repeat)
+        print(f'{command:<14}{cli:6.0f} ms{ready:8.0f} ms')
+    print(f'{"sentiment":<14}{"":>8}{best_of(ready_command(["scripts.sentiment_analysis"]), args.repeat):8.0f} ms')
+
+if __name__ == '__main__':
+    main()
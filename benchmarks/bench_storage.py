@@ -0,0 +1,80 @@
+# benchmarks/bench_storage.py
+
+"""Bytes per song and scan speed of plain and compact song storage:
+   'plain' stores lyrics as text and sentiment as nested documents, 'zstd' compresses each lyric on its own,
+   'zstd + dictionary' with a dictionary trained on --samples songs (what compact_collection does), both with
+   sentiment packed as float32. A scan decodes the BSON a cursor would receive and reads every song through
+   song_lyrics / song_sentiment, a lyrics scan as for sentiment scoring or indexing, a sentiment scan
+   (only the sentiment field projected) as for rollups and exports.
+
+   Usage: python -m benchmarks.bench_storage [--songs N] [--samples N] [--dict_size BYTES] [--level N]
+   Lyrics are built from the saved fixture pages with their lines shuffled, which repeats lines far more than
+   a real corpus does and flatters the dictionary; scan times leave out the network and the server."""
+
+import argparse
+import time
+import bson
+import mongomock
+from config import settings
+from scripts.compact_storage import LyricsCodec, pack_sentiment, song_lyrics, song_sentiment
+from scripts.sentiment_engine import BatchSentimentEngine
+from scripts.upload_to_mongodb import lyrics_hash
+from scripts.services import registry
+from benchmarks.bench_sentiment import make_lyrics
+
+def make_songs(lyrics: list) -> list:
+    sentiments = BatchSentimentEngine(processes=1).score_many(lyrics)
+    return [{'_id': i, 'title': f'Song {i}', 'artist': f'Artist {i % 50}', 'album': f'Album {i % 250}',
+             'release_year': str(2000 + i % 20), 'lyrics': text, 'lyrics_hash': lyrics_hash(text), 'sentiment': sentiment}
+            for i, (text, sentiment) in enumerate(zip(lyrics, sentiments))]
+
+def compact(songs: list, codec: LyricsCodec) -> list:
+    return [dict(song, lyrics=codec.compress(song['lyrics']), sentiment=pack_sentiment(song['sentiment'])) for song in songs]
+
+def field_bytes(songs: list, field: str) -> int:
+    return sum(len(bson.encode({field: song[field]})) - 5 for song in songs)
+
+def scan(stream: bytes, read) -> float:
+    start = time.perf_counter()
+    for song in bson.decode_all(stream):
+        read(song)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact storage benchmark")
+    parser.add_argument('--songs', type=int, default=5000, help="Songs in the corpus")
+    parser.add_argument('--samples', type=int, default=settings.COMPACT_DICT_SAMPLES, help="Songs the dictionary is trained on")
+    parser.add_argument('--dict_size', type=int, default=settings.COMPACT_DICT_SIZE, help="Dictionary bytes")
+    parser.add_argument('--level', type=int, default=settings.COMPACT_LEVEL, help="zstd level")
+    args = parser.parse_args()
+
+    songs = make_songs(make_lyrics(args.songs))
+    db = mongomock.MongoClient().lyrical_analysis_db
+    with registry.override(db=db):
+        plain_codec = LyricsCodec(db.plain_dictionaries, level=args.level)
+        codec = registry.get('lyrics_codec')
+        codec.level = args.level
+        codec.train([song['lyrics'] for song in songs[:args.samples]], args.dict_size)
+        layouts = (('plain', songs), ('zstd', compact(songs, plain_codec)), ('zstd + dictionary', compact(songs, codec)))
+
+        print(f'{args.songs} songs, dictionary of {args.dict_size} bytes trained on {min(args.samples, args.songs)}')
+        print(f'{"bytes per song":<20}{"document":>10}{"lyrics":>10}{"sentiment":>11}{"ratio":>8}')
+        plain_bytes = sum(len(bson.encode(song)) for song in songs)
+        for label, docs in layouts:
+            total = sum(len(bson.encode(song)) for song in docs)
+            print(f'{label:<20}{total / len(docs):10.0f}{field_bytes(docs, "lyrics") / len(docs):10.0f}'
+                  f'{field_bytes(docs, "sentiment") / len(docs):11.0f}{plain_bytes / total:7.1f}x')
+
+        print(f'\n{"scan, songs/s":<20}{"lyrics":>12}{"sentiment":>12}')
+        for label, docs in layouts:
+            lyrics_stream = b''.join(bson.encode(song) for song in docs)
+            sentiment_stream = b''.join(bson.encode({'_id': song['_id'], 'sentiment': song['sentiment']}) for song in docs)
+            # The plain layout decodes the same way, the accessors just return its fields
+            reader = plain_codec if label == 'zstd' else codec
+            with registry.override(db=db, lyrics_codec=reader):
+                lyrics = min(scan(lyrics_stream, song_lyrics) for _ in range(3))
+                sentiment = min(scan(sentiment_stream, song_sentiment) for _ in range(3))
+            print(f'{label:<20}{len(docs) / lyrics:12.0f}{len(docs) / sentiment:12.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# benchmarks/suite.py
+
+"""Offline regression suite: one number per case, measured against the saved fixtures, the stub server and mongomock,
+   so it runs anywhere without network or a database.
+       parse      ms per lyrics page, LyricsPageParser('html.parser')
+       scrape     songs/s, BulkScraper from discography to database over the stub server
+       ingest     songs/s, add_artist_to_db's bulk upsert path next to other artists' songs
+       sentiment  songs/s, BatchSentimentEngine scoring and writing back in one process
+   CPU bound cases are timed in process CPU time, which other load on a shared machine disturbs less than wall time;
+   scrape waits on sockets and threads, so it is timed on the wall clock. Each case keeps its best of --repeat runs.
+   --save appends the results to the history file, --check compares them with the median of the last runs recorded
+   by the same runner and exits with 1 when a case got more than --threshold worse, which is what fails the build.
+   The runner is --runner or $BENCH_RUNNER (the host name otherwise), give CI machines a stable one since their
+   host names change from build to build. A --check without a baseline exits with 1 too, unless --save records one.
+
+   Usage: python -m benchmarks.suite [--check] [--save] [--runner NAME] [--threshold 0.25] [--repeat N] [--history PATH]
+                                     [--only CASE ...]"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+import mongomock
+from config import settings
+from scripts.services import registry
+from scripts.slug_index import SlugIndex
+from scripts.page_parser import LyricsPageParser
+from scripts.fetch_engine import FetchEngine
+from scripts.http_transport import HttpTransport
+from scripts.bulk_scrape_lyrics import BulkScraper
+from scripts.sentiment_engine import BatchSentimentEngine
+from benchmarks.bench_parsing import load_pages
+from benchmarks.bench_mongo_ingest import make_song, bulk
+from benchmarks.bench_sentiment import make_lyrics, make_collection
+from benchmarks.bench_batch import catalog
+from tests.stub_server import StubServer
+
+HISTORY_PATH = os.path.join(os.path.dirname(__file__), 'history.jsonl')
+THRESHOLD = 0.25 # Relative slowdown that counts as a regression, timings on shared CI machines are noisy
+WINDOW = 5       # Recorded runs the baseline is the median of
+
+def parse_case(repeat: int, passes: int = 10) -> float:
+    pages = load_pages()
+    parse = LyricsPageParser().parse
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.process_time()
+        for _ in range(passes):
+            for page in pages:
+                parse(page)
+        best = min(best, (time.process_time() - start) / (passes * len(pages)) * 1000)
+    return best
+
+def scrape_case(repeat: int) -> float:
+    best = 0.0
+    with tempfile.TemporaryDirectory() as directory:
+        routes, (artist,) = catalog(directory, artists=1, songs=60)
+        # Scraping and writing only, indexing the new songs has cases of its own
+        with StubServer(routes=routes) as server, mock.patch.object(settings, 'AZLYRICS_BASE_URL', server.base_url), \
+                mock.patch.object(settings, 'INDEX_ON_UPLOAD', False):
+            for _ in range(repeat):
+                db = mongomock.MongoClient().db
+                slugs = SlugIndex(':memory:')
+                slugs.add_artist(artist, 'artist0')
+                with registry.override(db=db, slug_index=slugs), contextlib.redirect_stdout(io.StringIO()), \
+                        FetchEngine(max_workers=4, rate=10000, jitter=(0, 0), session=HttpTransport()) as engine:
+                    start = time.perf_counter()
+                    written = BulkScraper(artist, engine=engine, batch_size=20).run()
+                    best = max(best, written / (time.perf_counter() - start))
+    return best
+
+def ingest_case(repeat: int, existing: int = 2000, songs: int = 300) -> float:
+    best = 0.0
+    for _ in range(repeat):
+        db = mongomock.MongoClient().db
+        db.songs.insert_many([make_song(f'Artist {i % 100}', i) for i in range(existing)])
+        with registry.override(db=db):
+            start = time.process_time()
+            bulk(db.songs, 'New Artist', songs, 100)
+            best = max(best, songs / (time.process_time() - start))
+    return best
+
+def sentiment_case(repeat: int, songs: int = 300) -> float:
+    lyrics = make_lyrics(songs)
+    best = 0.0
+    for _ in range(repeat):
+        collection = make_collection(lyrics)
+        start = time.process_time()
+        BatchSentimentEngine(processes=1).update_collection(collection)
+        best = max(best, songs / (time.process_time() - start))
+    return best
+
+# name: (function, unit, higher is better)
+CASES = {
+    'parse': (parse_case, 'ms/page', False),
+    'scrape': (scrape_case, 'songs/s', True),
+    'ingest': (ingest_case, 'songs/s', True),
+    'sentiment': (sentiment_case, 'songs/s', True),
+}
+
+def runner_id(runner: str = None) -> str:
+    # Results are only comparable on the same hardware and Python
+    name = runner or os.environ.get('BENCH_RUNNER') or platform.node()
+    return f'{name}-{platform.machine()}-py{platform.python_version()}'
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_cases(names: list, repeat: int) -> dict:
+    results = {}
+    for name in names:
+        case = CASES[name][0]
+        case(1) # Warm-up, the first run pays for lexicon loads and lazy imports
+        results[name] = case(repeat)
+    return results
+
+def load_history(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def baseline(history: list, machine: str, window: int = WINDOW) -> dict:
+    # Median of each case over the last window runs of this runner
+    values = {}
+    for record in history:
+        if record['machine'] == machine:
+            for name, value in record['results'].items():
+                values.setdefault(name, []).append(value)
+    return {name: statistics.median(runs[-window:]) for name, runs in values.items()}
+
+def compare(results: dict, base: dict, threshold: float = THRESHOLD) -> list:
+    """ [(name, value, baseline, change, regressed)], change is the relative difference to the baseline,
+        positive when the case got better. Cases without a baseline never regress."""
+    rows = []
+    for name, value in results.items():
+        reference = base.get(name)
+        if not reference:
+            rows.append((name, value, None, None, False))
+            continue
+        change = (value - reference) / reference
+        if not CASES[name][2]:
+            change = -change
+        rows.append((name, value, reference, change, change < -threshold))
+    return rows
+
+def check_failures(rows: list, threshold: float, save: bool) -> list:
+    """ Why --check fails the build, nothing when it passes. A case without a baseline fails it unless
+        this run is saved as the first one, a check that compares nothing must not pass silently."""
+    failures = []
+    regressions = [row[0] for row in rows if row[4]]
+    if regressions:
+        failures.append(f'Regressed more than {threshold:.0%}: {", ".join(regressions)}')
+    missing = [row[0] for row in rows if row[2] is None]
+    if missing and not save:
+        failures.append(f'No baseline for {", ".join(missing)}: record one with --save, or keep the history file between builds')
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark regression suite")
+    parser.add_argument('--only', nargs='+', choices=list(CASES), default=list(CASES), help="Cases to run")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case, the best one counts")
+    parser.add_argument('--history', type=str, default=HISTORY_PATH, help="JSON lines file of earlier results")
+    parser.add_argument('--save', action='store_true', help="Append this run to the history")
+    parser.add_argument('--check', action='store_true', help="Exit with 1 when a case regressed against the history")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help="Relative slowdown counted as a regression")
+    parser.add_argument('--runner', type=str, help="Name the history is kept under, $BENCH_RUNNER or the host name by default")
+    args = parser.parse_args()
+
+    machine = runner_id(args.runner)
+    results = run_cases(args.only, args.repeat)
+    rows = compare(results, baseline(load_history(args.history), machine), args.threshold)
+
+    print(f'{"case":<12}{"value":>12}  {"unit":<9}{"baseline":>12}{"change":>10}')
+    for name, value, reference, change, regressed in rows:
+        base_text = f'{reference:12.3f}' if reference else f'{"-":>12}'
+        change_text = f'{change:+10.1%}' if change is not None else f'{"-":>10}'
+        print(f'{name:<12}{value:12.3f}  {CASES[name][1]:<9}{base_text}{change_text}{"  REGRESSION" if regressed else ""}')
+
+    if args.save:
+        record = {'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                  'commit': git_commit(), 'machine': machine, 'results': results}
+        with open(args.history, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+    missing = [row[0] for row in rows if row[2] is None]
+    if missing:
+        print(f'WARNING: no baseline for {", ".join(missing)} on {machine} in {args.history}, these cases were not checked',
+              file=sys.stderr)
+    failures = check_failures(rows, args.threshold, args.save) if args.check else []
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# config/settings.py
+
+import os
+
+# AZLyrics
+AZLYRICS_BASE_URL = 'https://www.azlyrics.com'
+
+# Discography JSON files written by AZArtists.open_url and read by add_artist_to_db
+ARTISTS_DIR = 'data/artists'
+
+# Politeness: every host gets one request per 1 / REQUESTS_PER_SECOND seconds plus a random
+# jitter drawn from REQUEST_JITTER, the defaults keep the old random_delay() spacing of 3-15 s
+REQUESTS_PER_SECOND = 1 / 3
+REQUEST_BURST = 1
+REQUEST_JITTER = (0, 12)
+
+# Worker threads shared by all hosts, extra workers overlap parsing and DB writes with waiting
+MAX_CONCURRENCY = 4
+
+# HTTP transport shared by every scraper
+HTTP_POOL_SIZE = 10          # Keep-alive connections per host, at least MAX_CONCURRENCY
+HTTP_CONNECT_TIMEOUT = 5     # Seconds
+HTTP_READ_TIMEOUT = 30       # Seconds
+HTTP_RETRIES = 3             # Retries for connection errors, 429 and 5xx
+HTTP_BACKOFF_FACTOR = 2      # Exponential backoff between retries: 2, 4, 8 s (Retry-After wins when sent)
+
+# Raw page cache, set PAGE_CACHE_DIR to None to keep only an in-memory cache per run
+PAGE_CACHE_DIR = 'data/cache/pages'
+PAGE_CACHE_TTL = 7 * 24 * 3600           # Seconds a cached page is served without asking the site
+PAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024 # Compressed size kept on disk before least recently used pages go
+HTTP_OFFLINE = False                     # Serve every page from the cache and never touch the network
+
+# Artist slugs from the letter index pages and song hrefs from discography pages, None keeps them in memory per run
+SLUG_INDEX_PATH = 'data/cache/slugs.sqlite'
+SLUG_INDEX_TTL = 30 * 24 * 3600          # Seconds before a letter page is read again for an artist it didn't list
+
+# MongoDB, the client is only created when a command first needs the database
+MONGO_URI = 'mongodb://localhost:27017/'
+MONGO_DB = 'lyrical_analysis_db'
+MONGO_BATCH_SIZE = 100 # Song upserts sent per bulk_write
+STATE_COLLECTION = 'pipeline_state' # Which SENTIMENT_VERSION the stale flags on songs were last brought up to
+
+# BulkScraper pipeline
+PIPELINE_QUEUE_SIZE = 32     # Scraped songs waiting for the DB sink, bounds memory for any discography size
+PIPELINE_FLUSH_INTERVAL = 5  # Seconds before a partial batch is written, so the first songs land quickly
+
+# Durable scrape job queue shared by `main.py work` processes
+JOB_QUEUE_PATH = 'data/queue/jobs.sqlite'
+JOB_LEASE_SECONDS = 300      # A claimed job returns to the queue if its worker stops renewing the lease for this long
+JOB_MAX_ATTEMPTS = 3         # Attempts before a job is marked failed
+JOB_RETRY_BACKOFF = 60       # Seconds before the first retry, doubled on every further attempt
+
+# Multi-artist `main.py batch` runs, the work table lives in MongoDB so workers on several machines can share it
+BATCH_NAME = 'default'                 # Separate batches keep separate progress in the same collection
+BATCH_COLLECTION = 'batch_artists'
+BATCH_LEASE_SECONDS = 600    # Renewed while the artist is scraped, a dead worker's artist is reclaimed after this
+BATCH_PROXIES = []           # Egress proxies, worker i uses proxies[i % len] and each proxy gets a full rate budget
+
+# NLTK tokenizer models NRCLex needs, downloaded the first time the per-song sentiment path runs
+NLTK_RESOURCES = ('punkt', 'punkt_tab')
+
+# Batch sentiment engine
+SENTIMENT_PROCESSES = os.cpu_count() or 1 # Scoring processes, 1 scores in the calling process
+SENTIMENT_CHUNK_SIZE = 1000               # Songs tokenized and scored per task
+
+# Lyric embeddings for similarity search
+EMBEDDINGS_DIR = 'data/embeddings'
+EMBEDDING_MODEL = None                   # sentence-transformers model name, None uses hashed n-gram vectors
+EMBEDDING_DIM = 256                      # Hashed n-gram vector size
+EMBEDDING_BATCH_SIZE = 1000              # Songs read and embedded per batch
+EMBEDDING_PROCESSES = os.cpu_count() or 1
+
+# IVF similarity index over the embeddings, see scripts/similarity_index.py
+ANN_NLIST = 256                          # Clusters, capped at sqrt(songs) for small collections
+ANN_NPROBE = 16                          # Clusters scanned per query, more is slower and closer to exact
+INDEX_ON_UPLOAD = True                   # Embed, index and make searchable an artist's songs at the end of add_artist_to_db
+
+# Lyrics search index, see scripts/search_index.py
+SEARCH_INDEX_DIR = 'data/search'
+SEARCH_BATCH_SIZE = 2000                 # Songs per index segment
+SEARCH_MAX_SEGMENTS = 16                 # Segments merged into one once there are more
+
+# Parquet export for analytics, see scripts/export_parquet.py (needs pyarrow)
+EXPORT_DIR = 'data/parquet'
+EXPORT_BATCH_SIZE = 1000                 # Documents per cursor batch
+EXPORT_ROWS_PER_FILE = 100000            # Rows held in memory before a part file is written
+EXPORT_COMPRESSION = 'zstd'
+
+# Compact song storage, see scripts/compact_storage.py (needs zstandard)
+COMPACT_STORAGE = False                  # Store new lyrics zstd-compressed and sentiment as packed float32, readers handle both
+COMPACT_DICT_COLLECTION = 'lyrics_dictionaries'
+COMPACT_DICT_SIZE = 112 * 1024           # Bytes of the dictionary trained on the corpus
+COMPACT_DICT_SAMPLES = 5000              # Songs sampled to train it
+COMPACT_LEVEL = 9                        # zstd level, decompression speed hardly depends on it
+
+# Metrics (counters and timers across scraping, uploads and sentiment), see scripts/metrics.py
+METRICS_ENABLED = False                  # Off costs an attribute check per call, main.py --metrics turns it on
+METRICS_PORT = 9108                      # main.py --metrics_port serves /metrics and /metrics.json on 127.0.0.1
+
+# Near-duplicate lyrics (live, acoustic, remix... versions) flagged at upload, see scripts/near_duplicates.py
+DEDUP_ON_UPLOAD = True                   # Store a MinHash signature with every song and flag near-duplicates
+DEDUP_NUM_PERM = 128                     # MinHash functions per signature
+DEDUP_BANDS = 32                         # LSH bands of DEDUP_NUM_PERM / DEDUP_BANDS rows each
+DEDUP_SHINGLE_SIZE = 3                   # Words per shingle
+DEDUP_THRESHOLD = 0.7                    # Estimated Jaccard similarity from which lyrics are duplicates
+DEDUP_SKIP_TITLES = False                # Don't fetch songs whose title marks another version of a known song
+DEDUP_LINK = False                       # Store duplicates without lyrics, linked to their canonical song
+
+# Logging, see scripts/log_config.py
+LOG_DIR = 'logs'
+LOG_LEVEL = 'INFO'
+LOG_JSON = False                         # One JSON object per line in logs/scraping.jsonl instead of text lines
+LOG_ASYNC = True                         # Callers only queue records, a listener thread formats and writes them
+LOG_QUEUE_SIZE = 10000                   # Records waiting for the listener, more are dropped instead of blocking
+LOG_QUEUE_TIMEOUT = 5                    # Seconds a warning or error waits for room in a full queue before it is dropped too
+LOG_MAX_BYTES = 10 * 1024 * 1024         # Size at which the log file is rotated
+LOG_BACKUP_COUNT = 5                     # Rotated files kept, older ones are deleted
+LOG_MAX_MESSAGE_CHARS = 2000             # Longer messages (and string extras) are cut
+LOG_SAMPLE_EVERY = 1                     # Keep 1 in N records below WARNING per message, 1 keeps everything
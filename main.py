@@ -2,46 +2,223 @@
 
 import argparse
 import logging
-from datetime import datetime
-from scripts.scrape_lyrics import AZLyrics
-from scripts.scrape_discography import AZArtists
-from scripts.upload_to_mongodb import add_artist_to_db
+import json
+from config import settings
 import os
 
-# Logging setup
-log_filename = f'logs/scraping_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
-logging.basicConfig(
-    filename=log_filename,
-    filemode='w',
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Each command imports what it needs when it runs, so `main.py list` or `--help` never loads
+# the scraping, database or analysis stacks, and nothing connects anywhere until a command does
+
+def setup_logging(args):
+    # One size-rotated file under logs/, written by a listener thread so scrapers never wait on the disk
+    from scripts.log_config import setup_logging as configure
+    configure(level=args.log_level, json_format=args.log_json or None)
 
 def retrieve_discography(artist_name):
+    from scripts.scrape_discography import AZArtists
     discography_request = AZArtists(artist=artist_name)
     discography_request.open_url()
 
 def retrieve_song(artist_name, song_title):
+    from scripts.scrape_lyrics import AZLyrics
     lyrics_request = AZLyrics(artist=artist_name, song=song_title)
     lyrics, genre, album, writers = lyrics_request.open_url()
     print(lyrics, genre, album, writers, sep='\n')
 
-def upload_artist_to_mongodb(artist_file, num_albums=None, album_title=None):
-    # Upload artist's discography and song data to MongoDB.
-    add_artist_to_db(artist_file, num_albums=num_albums, album_title=album_title)
-    artist_name = os.path.basename(artist_file).replace('.json','')
-    print(f"Artist {artist_name} data uploaded to MongoDB.")
+def upload_artist_to_mongodb(artist_files, num_albums=None, album_title=None, concurrency=None, bulk=False, batch_size=None,
+                             skip_duplicates=None, link_duplicates=None):
+    # Upload artists' discography and song data to MongoDB.
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from scripts.fetch_engine import FetchEngine
+    from scripts.upload_to_mongodb import add_artist_to_db
+    # Artists run side by side and share one engine, so the per-host rate limit holds across all of them
+    with FetchEngine(max_workers=concurrency) as engine, ThreadPoolExecutor(max_workers=len(artist_files)) as artists:
+        uploads = {artists.submit(add_artist_to_db, artist_file, num_albums=num_albums, album_title=album_title, engine=engine,
+                                  bulk=bulk, batch_size=batch_size, skip_duplicates=skip_duplicates,
+                                  link_duplicates=link_duplicates): artist_file
+                   for artist_file in artist_files}
+        for upload in as_completed(uploads):
+            upload.result()
+            artist_name = os.path.basename(uploads[upload]).replace('.json','')
+            print(f"Artist {artist_name} data uploaded to MongoDB.")
+
+def bulk_scrape_artist(artist_name, num_albums=None, album_title=None, concurrency=None, batch_size=None, save=False):
+    # Scrape the discography and every song straight into MongoDB
+    from scripts.fetch_engine import FetchEngine
+    from scripts.bulk_scrape_lyrics import BulkScraper
+    with FetchEngine(max_workers=concurrency) as engine:
+        BulkScraper(artist_name, engine=engine, batch_size=batch_size, num_albums=num_albums,
+                    album_title=album_title, save_discography=save).run()
+
+def enqueue_songs(artist_file=None, artist_name=None, num_albums=None, album_title=None):
+    # Queue every song of an artist that isn't in MongoDB yet, from a saved discography or a fresh scrape
+    from scripts.scrape_discography import AZArtists
+    from scripts.job_queue import JobQueue, enqueue_artist
+    if artist_file:
+        artist_name = os.path.basename(artist_file).replace('.json','')
+        with open(artist_file, 'r', encoding='utf-8') as f:
+            albums = json.load(f)
+    else:
+        albums = AZArtists(artist=artist_name).fetch_albums()
+        if albums is None:
+            print(f"Could not retrieve the discography for {artist_name}.")
+            return
+    queue = JobQueue()
+    added = enqueue_artist(queue, artist_name, albums, num_albums=num_albums, album_title=album_title)
+    queue.close()
+    print(f"Queued {added} songs for {artist_name}.")
+
+def run_workers(workers=1, concurrency=None):
+    # Each process gets an equal share of the per-host rate, so together they stay as polite as one
+    from concurrent.futures import ProcessPoolExecutor
+    from scripts.job_queue import run_worker
+    from scripts.log_config import init_worker_logging, logging_config
+    rate = settings.REQUESTS_PER_SECOND / workers
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_logging, initargs=(logging_config(),)) as pool:
+        runs = [pool.submit(run_worker, concurrency=concurrency, rate=rate, offline=settings.HTTP_OFFLINE)
+                for _ in range(workers)]
+        processed = sum(run.result() for run in runs)
+    # Indexed here, once, the embedding store and index files take a single writer
+    from scripts.upload_to_mongodb import index_new_songs
+    index_new_songs()
+    print(f"Workers processed {processed} jobs.")
+    show_queue_status()
+
+def show_queue_status(retry_failed=False):
+    from scripts.job_queue import JobQueue
+    queue = JobQueue()
+    if retry_failed:
+        print(f"Re-queued {queue.retry_failed()} failed jobs.")
+    counts = queue.counts()
+    print(' '.join(f"{state}: {counts[state]}" for state in counts))
+    for artist, artist_counts in sorted(queue.artist_counts().items()):
+        print(f"  {artist}: " + ' '.join(f"{state}: {n}" for state, n in artist_counts.items()))
+    for failure in queue.failures():
+        print(f"  failed {failure['artist']} - {failure['song']} after {failure['attempts']} attempts: {failure['last_error']}")
+    queue.close()
+
+def run_batch(artist_file=None, name=None, workers=1, concurrency=None, rate=None, batch_size=None):
+    # Add the listed artists to the shared work table, then drain it with local worker processes. Without a file
+    # the workers join a batch started elsewhere, so more machines can be added while it runs
+    from concurrent.futures import ProcessPoolExecutor
+    from scripts.batch_ingest import ArtistWorkTable, read_artist_list, run_batch_worker, worker_rate
+    if artist_file:
+        table = ArtistWorkTable(name)
+        print(f"Added {table.add(read_artist_list(artist_file))} artists to batch {table.batch}.")
+    from scripts.log_config import init_worker_logging, logging_config
+    rate = rate or worker_rate(workers, settings.BATCH_PROXIES)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_logging, initargs=(logging_config(),)) as pool:
+        runs = [pool.submit(run_batch_worker, name, index, concurrency=concurrency, rate=rate, batch_size=batch_size,
+                            offline=settings.HTTP_OFFLINE)
+                for index in range(workers)]
+        claimed = sum(run.result() for run in runs)
+    # Indexed here, once, the embedding store and index files take a single writer
+    from scripts.upload_to_mongodb import index_new_songs
+    index_new_songs()
+    print(f"Workers scraped {claimed} artists.")
+    show_batch_status(name)
+
+def show_batch_status(name=None, retry_failed=False):
+    from scripts.batch_ingest import ArtistWorkTable
+    table = ArtistWorkTable(name)
+    if retry_failed:
+        print(f"Re-queued {table.retry_failed()} failed artists.")
+    counts = table.counts()
+    print(f"Batch {table.batch}: " + ' '.join(f"{state}: {counts[state]}" for state in counts))
+    for worker, totals in sorted(table.worker_totals().items()):
+        print(f"  {worker}: {totals['artists']} artists, {totals['songs']} songs written, {totals['missed']} missed")
+    for failure in table.failures():
+        print(f"  failed {failure['artist']} after {failure['attempts']} attempts: {failure['error']}")
+
+def reparse_songs(artist_name=None):
+    # Re-run the lyrics parser over cached pages, no requests are made
+    from scripts.upload_to_mongodb import reparse_cached_songs
+    updated = reparse_cached_songs(artist_name)
+    print(f"Re-parsed {updated} songs from the page cache.")
+
+def find_similar(artist_name, song_title, k=10, nprobe=None):
+    # Nearest songs by lyrics from the memory-mapped similarity index, no database access
+    from scripts.similarity_index import similar_songs
+    try:
+        hits = similar_songs(artist_name, song_title, k=k, nprobe=nprobe)
+    except (KeyError, ValueError) as e:
+        print(e.args[0])
+        return
+    for artist, title, score in hits:
+        print(f"{score:.3f}  {artist} - {title}")
+
+def search_lyrics(query, limit=20):
+    # Boolean and phrase search over the lyrics index, no database access
+    from scripts.search_index import SearchIndex
+    index = SearchIndex()
+    try:
+        docs = index.match(query)
+        songs = index.songs(docs[:limit])
+    except ValueError as e:
+        print(e.args[0])
+        return
+    finally:
+        index.close()
+    for artist, title in songs:
+        print(f"{artist} - {title}")
+    print(f"{len(docs)} songs found." if len(songs) == len(docs) else f"Showing {len(songs)} of {len(docs)} songs found.")
+
+def export_parquet(full=False):
+    # Sync the collections to Parquet for analytics, see scripts/export_parquet.py
+    from scripts.export_parquet import export_all
+    stats = export_all(full=full)
+    print(f"Exported {stats['songs']} songs ({stats['appended']} appended, {stats['rewritten']} partitions rewritten), "
+          f"{stats['albums']} albums and {stats['artists']} artists to {settings.EXPORT_DIR}.")
+
+def start_instrumentation(args):
+    # Timers, counters and the profiler are opt-in, a plain run never turns them on
+    from scripts.metrics import metrics, MetricsServer, Profiler
+    server = profiler = None
+    if args.metrics or args.metrics_port is not None:
+        metrics.enable()
+    if args.metrics_port is not None:
+        server = MetricsServer(port=args.metrics_port).start()
+        print(f"Serving metrics on {server.url}")
+    if args.profile:
+        profiler = Profiler(args.profile).start()
+    return server, profiler
+
+def stop_instrumentation(args, server, profiler):
+    from scripts.metrics import metrics
+    if profiler:
+        print(profiler.stop(args.command or 'main'))
+    if metrics.enabled:
+        print(metrics.report())
+    if server:
+        server.stop()
 
 def list_commands():
     print("Available commands:")
     print("1) discography: Retrieve an artist's discography")
     print("2) song: Retrieve lyrics for a specific song")
     print("3) upload: Upload artist data to MongoDB")
-    print("4) list: List all available commands")
+    print("4) bulk: Scrape an artist's discography and songs straight into MongoDB")
+    print("5) enqueue: Queue an artist's missing songs for the workers")
+    print("6) work: Run worker processes that drain the song queue")
+    print("7) queue-status: Show the song queue")
+    print("8) batch: Scrape a list of artists with several worker processes")
+    print("9) batch-status: Show a batch's progress and failures")
+    print("10) reparse: Re-extract stored songs from the page cache")
+    print("11) similar: Find the songs with the most similar lyrics")
+    print("12) search: Find songs whose lyrics match words and phrases")
+    print("13) export: Sync songs, albums and artists to Parquet files")
+    print("14) list: List all available commands")
 
 if __name__ == '__main__':
     # Create the top-level parser
     parser = argparse.ArgumentParser(description="AZLyrics Scraper CLI")
+    parser.add_argument('--offline', action='store_true', help="Only use cached pages, never touch the network")
+    parser.add_argument('--metrics', action='store_true', help="Time every stage, count requests and writes, print a report at the end")
+    parser.add_argument('--metrics_port', type=int, help=f"Also serve the metrics on 127.0.0.1:PORT/metrics while the command runs "
+                                                         f"(e.g. {settings.METRICS_PORT})")
+    parser.add_argument('--profile', choices=('cprofile', 'pyinstrument'), help="Profile the command, the profile is written to logs/")
+    parser.add_argument('--log_level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), help=f"Default {settings.LOG_LEVEL}, DEBUG also logs every song's lyrics")
+    parser.add_argument('--log_json', action='store_true', help="Write logs/scraping.jsonl, one JSON object per record")
 
     # Subcommands for different tasks
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
@@ -57,15 +234,85 @@ if __name__ == '__main__':
 
     # Subcommand for uploading artist data to MongoDB
     parser_upload = subparsers.add_parser('upload', help="Upload artist data to MongoDB")
-    parser_upload.add_argument('--file', type=str, required=True, help="Path to the artist's JSON file")
+    parser_upload.add_argument('--file', type=str, nargs='+', required=True, help="Path to one or more artists' JSON files")
     parser_upload.add_argument('--num_albums', type=int, help="Limit to the top N albums")
     parser_upload.add_argument('--album_title', type=str, help="Upload data for a specific album")
+    parser_upload.add_argument('--concurrency', type=int, help="Number of scraping worker threads")
+    parser_upload.add_argument('--bulk', action='store_true', help="Create unique indexes and write through batched upserts")
+    parser_upload.add_argument('--batch_size', type=int, help="Songs per bulk write in --bulk mode")
+    parser_upload.add_argument('--skip_duplicates', action='store_true', default=None,
+                               help="Don't fetch live, acoustic, remix... versions of songs the artist already has")
+    parser_upload.add_argument('--link_duplicates', action='store_true', default=None,
+                               help="Store near-duplicate lyrics once, other versions link to the canonical song")
+
+    # Subcommand for scraping an artist straight into MongoDB
+    parser_bulk = subparsers.add_parser('bulk', help="Scrape an artist's discography and songs straight into MongoDB")
+    parser_bulk.add_argument('artist', type=str, help="Artist's name")
+    parser_bulk.add_argument('--num_albums', type=int, help="Limit to the top N albums")
+    parser_bulk.add_argument('--album_title', type=str, help="Scrape a specific album")
+    parser_bulk.add_argument('--concurrency', type=int, help="Number of scraping worker threads")
+    parser_bulk.add_argument('--batch_size', type=int, help="Songs per bulk write")
+    parser_bulk.add_argument('--save', action='store_true', help="Also save the discography JSON to data/artists")
+
+    # Subcommands for the durable song queue
+    parser_enqueue = subparsers.add_parser('enqueue', help="Queue an artist's missing songs for the workers")
+    enqueue_source = parser_enqueue.add_mutually_exclusive_group(required=True)
+    enqueue_source.add_argument('--file', type=str, help="Path to the artist's JSON file")
+    enqueue_source.add_argument('--artist', type=str, help="Scrape this artist's discography")
+    parser_enqueue.add_argument('--num_albums', type=int, help="Limit to the top N albums")
+    parser_enqueue.add_argument('--album_title', type=str, help="Queue a specific album")
+
+    parser_work = subparsers.add_parser('work', help="Run worker processes that drain the song queue")
+    parser_work.add_argument('--workers', type=int, default=1, help="Number of worker processes")
+    parser_work.add_argument('--concurrency', type=int, help="Scraping threads per worker")
+
+    parser_queue_status = subparsers.add_parser('queue-status', help="Show the song queue")
+    parser_queue_status.add_argument('--retry_failed', action='store_true', help="Put failed jobs back in the queue")
+
+    # Subcommands for multi-artist batches shared through MongoDB
+    parser_batch = subparsers.add_parser('batch', help="Scrape a list of artists with several worker processes")
+    parser_batch.add_argument('--file', type=str, help="Artist list, one name per line. Without it, join the running batch")
+    parser_batch.add_argument('--name', type=str, help=f"Batch name, default {settings.BATCH_NAME}")
+    parser_batch.add_argument('--workers', type=int, default=1, help="Number of worker processes on this machine")
+    parser_batch.add_argument('--concurrency', type=int, help="Scraping threads per worker")
+    parser_batch.add_argument('--rate', type=float, help="Requests per second per worker, default splits REQUESTS_PER_SECOND "
+                                                         "between the workers sharing an egress IP")
+    parser_batch.add_argument('--batch_size', type=int, help="Songs per bulk write")
+
+    parser_batch_status = subparsers.add_parser('batch-status', help="Show a batch's progress and failures")
+    parser_batch_status.add_argument('--name', type=str, help=f"Batch name, default {settings.BATCH_NAME}")
+    parser_batch_status.add_argument('--retry_failed', action='store_true', help="Put failed artists back in the batch")
+
+    # Subcommand for re-parsing cached pages
+    parser_reparse = subparsers.add_parser('reparse', help="Re-extract stored songs from the page cache")
+    parser_reparse.add_argument('--artist', type=str, help="Only re-parse this artist's songs")
+
+    # Subcommand for lyrics similarity search
+    parser_similar = subparsers.add_parser('similar', help="Find the songs with the most similar lyrics")
+    parser_similar.add_argument('artist', type=str, help="Artist's name")
+    parser_similar.add_argument('song', type=str, help="Song title")
+    parser_similar.add_argument('-k', type=int, default=10, help="Number of songs to return")
+    parser_similar.add_argument('--nprobe', type=int, help="Index clusters to scan, more is slower and closer to exact")
+
+    # Subcommand for lyrics search
+    parser_search = subparsers.add_parser('search', help="Find songs whose lyrics match words and phrases")
+    parser_search.add_argument('query', type=str, help='e.g. \'"on the other side" (love OR heart) -goodbye\'')
+    parser_search.add_argument('--limit', type=int, default=20, help="Show at most N songs")
+
+    # Subcommand for the Parquet export
+    parser_export = subparsers.add_parser('export', help="Sync songs, albums and artists to Parquet files")
+    parser_export.add_argument('--full', action='store_true', help="Rewrite every partition instead of syncing changes")
 
     # Subcommand for listing all commands
     parser_list = subparsers.add_parser('list', help="List all available commands")
 
     # Parse the command-line arguments
     args = parser.parse_args()
+    setup_logging(args)
+    settings.HTTP_OFFLINE = args.offline or settings.HTTP_OFFLINE
+    instrumented = args.metrics or args.metrics_port is not None or args.profile
+    if instrumented:
+        server, profiler = start_instrumentation(args)
 
     try:
         if args.command == 'discography':
@@ -73,10 +320,41 @@ if __name__ == '__main__':
         elif args.command == 'song':
             retrieve_song(args.artist, args.song)
         elif args.command == 'upload':
-            if not os.path.exists(args.file):
+            missing = [artist_file for artist_file in args.file if not os.path.exists(artist_file)]
+            if missing:
+                print(f"The file {missing[0]} does not exist.")
+            else:
+                upload_artist_to_mongodb(args.file, num_albums=args.num_albums, album_title=args.album_title, concurrency=args.concurrency,
+                                         bulk=args.bulk, batch_size=args.batch_size, skip_duplicates=args.skip_duplicates,
+                                         link_duplicates=args.link_duplicates)
+        elif args.command == 'bulk':
+            bulk_scrape_artist(args.artist, num_albums=args.num_albums, album_title=args.album_title,
+                               concurrency=args.concurrency, batch_size=args.batch_size, save=args.save)
+        elif args.command == 'enqueue':
+            if args.file and not os.path.exists(args.file):
+                print(f"The file {args.file} does not exist.")
+            else:
+                enqueue_songs(artist_file=args.file, artist_name=args.artist, num_albums=args.num_albums, album_title=args.album_title)
+        elif args.command == 'work':
+            run_workers(workers=args.workers, concurrency=args.concurrency)
+        elif args.command == 'queue-status':
+            show_queue_status(retry_failed=args.retry_failed)
+        elif args.command == 'batch':
+            if args.file and not os.path.exists(args.file):
                 print(f"The file {args.file} does not exist.")
             else:
-                upload_artist_to_mongodb(args.file, num_albums=args.num_albums, album_title=args.album_title)
+                run_batch(artist_file=args.file, name=args.name, workers=args.workers, concurrency=args.concurrency,
+                          rate=args.rate, batch_size=args.batch_size)
+        elif args.command == 'batch-status':
+            show_batch_status(args.name, retry_failed=args.retry_failed)
+        elif args.command == 'reparse':
+            reparse_songs(args.artist)
+        elif args.command == 'similar':
+            find_similar(args.artist, args.song, k=args.k, nprobe=args.nprobe)
+        elif args.command == 'search':
+            search_lyrics(args.query, limit=args.limit)
+        elif args.command == 'export':
+            export_parquet(full=args.full)
         elif args.command == 'list':
             list_commands()
         else:
@@ -84,3 +362,6 @@ if __name__ == '__main__':
     except Exception as e:
         logging.error(f"An error occurred: {e}")
         print("An error occurred. Please check the logs for more details.")
+    finally:
+        if instrumented:
+            stop_instrumentation(args, server, profiler)
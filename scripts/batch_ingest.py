@@ -0,0 +1,221 @@
+# scripts/batch_ingest.py
+
+from pymongo import UpdateOne, ReturnDocument, ASCENDING
+from config import settings
+from scripts.services import registry
+from scripts.fetch_engine import FetchEngine
+from scripts.http_transport import get_transport
+from scripts.bulk_scrape_lyrics import BulkScraper
+import threading
+import logging
+import socket
+import time
+import os
+
+PENDING, IN_FLIGHT, DONE, FAILED = 'pending', 'in_flight', 'done', 'failed'
+STATES = (PENDING, IN_FLIGHT, DONE, FAILED)
+
+def read_artist_list(path: str) -> list:
+    # One artist per line, blank lines and # comments are skipped, repeats are kept once
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = (line.split('#', 1)[0].strip() for line in f)
+        return list(dict.fromkeys(line for line in lines if line))
+
+class ArtistWorkTable:
+    """ The artists of a batch as documents in MongoDB, so workers on any number of machines share one table.
+        pending -> in_flight (leased to one worker) -> done
+                                                   -> pending again after a backoff, or failed after max_attempts
+        Claims are a single find_one_and_update, so two workers never get the same artist, and a worker that
+        dies keeps its lease until it expires. Each document also records who scraped the artist and how many
+        songs were planned and written, which is where progress is read from."""
+
+    def __init__(self, batch: str = None, collection=None, lease_seconds: float = None, max_attempts: int = None,
+                 retry_backoff: float = None):
+        self.batch = batch or settings.BATCH_NAME
+        self.collection = collection if collection is not None else registry.get('db')[settings.BATCH_COLLECTION]
+        self.lease_seconds = lease_seconds or settings.BATCH_LEASE_SECONDS
+        self.max_attempts = max_attempts or settings.JOB_MAX_ATTEMPTS
+        self.retry_backoff = settings.JOB_RETRY_BACKOFF if retry_backoff is None else retry_backoff
+        self.collection.create_index([('batch', ASCENDING), ('artist', ASCENDING)], unique=True)
+        self.collection.create_index([('batch', ASCENDING), ('state', ASCENDING)])
+        self.logger = logging.getLogger(__name__)
+
+    def add(self, artists: list) -> int:
+        # Artists already in the batch keep their state, :return: Number of new artists
+        if not artists:
+            return 0
+        now = time.time()
+        ops = [UpdateOne({'batch': self.batch, 'artist': artist},
+                         {'$setOnInsert': {'state': PENDING, 'attempts': 0, 'available_at': 0, 'updated_at': now}},
+                         upsert=True)
+               for artist in artists]
+        return self.collection.bulk_write(ops, ordered=False).upserted_count
+
+    def claim(self, worker_id: str) -> dict:
+        """ Leases the next artist to worker_id: a pending one whose backoff has passed, or one whose lease expired.
+            Expired artists that already used every attempt are marked failed instead. :return: The document or None."""
+        now = time.time()
+        self.collection.update_many(
+            {'batch': self.batch, 'state': IN_FLIGHT, 'lease_expires': {'$lt': now}, 'attempts': {'$gte': self.max_attempts}},
+            {'$set': {'state': FAILED, 'lease_owner': None, 'error': 'lease expired', 'updated_at': now}}
+        )
+        return self.collection.find_one_and_update(
+            {'batch': self.batch, '$or': [{'state': PENDING, 'available_at': {'$lte': now}},
+                                          {'state': IN_FLIGHT, 'lease_expires': {'$lt': now}}]},
+            {'$set': {'state': IN_FLIGHT, 'lease_owner': worker_id, 'lease_expires': now + self.lease_seconds,
+                      'started_at': now, 'updated_at': now},
+             '$inc': {'attempts': 1}},
+            sort=[('_id', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def renew(self, doc_id, worker_id: str) -> bool:
+        # Extends a lease that is still held, a long discography must not be handed to a second worker
+        now = time.time()
+        result = self.collection.update_one({'_id': doc_id, 'state': IN_FLIGHT, 'lease_owner': worker_id},
+                                            {'$set': {'lease_expires': now + self.lease_seconds, 'updated_at': now}})
+        return result.modified_count == 1
+
+    def complete(self, doc_id, worker_id: str, planned: int, written: int) -> bool:
+        # Only the current lease holder can finish an artist, a worker whose lease expired loses it
+        now = time.time()
+        result = self.collection.update_one(
+            {'_id': doc_id, 'state': IN_FLIGHT, 'lease_owner': worker_id},
+            {'$set': {'state': DONE, 'worker': worker_id, 'lease_owner': None, 'lease_expires': None, 'error': None,
+                      'songs_planned': planned, 'songs_written': written, 'finished_at': now, 'updated_at': now}}
+        )
+        return result.modified_count == 1
+
+    def fail(self, doc_id, worker_id: str, error: str) -> bool:
+        doc = self.collection.find_one({'_id': doc_id, 'state': IN_FLIGHT, 'lease_owner': worker_id}, {'attempts': 1})
+        if doc is None:
+            return False
+        now = time.time()
+        attempts = doc['attempts']
+        state = FAILED if attempts >= self.max_attempts else PENDING
+        result = self.collection.update_one(
+            {'_id': doc_id, 'lease_owner': worker_id},
+            {'$set': {'state': state, 'worker': worker_id, 'available_at': now + self.retry_backoff * 2 ** (attempts - 1),
+                      'lease_owner': None, 'lease_expires': None, 'error': error, 'updated_at': now}}
+        )
+        return result.modified_count == 1
+
+    def retry_failed(self) -> int:
+        # Puts every failed artist back with a fresh set of attempts
+        result = self.collection.update_many({'batch': self.batch, 'state': FAILED},
+                                             {'$set': {'state': PENDING, 'attempts': 0, 'available_at': 0, 'updated_at': time.time()}})
+        return result.modified_count
+
+    def counts(self) -> dict:
+        counts = dict.fromkeys(STATES, 0)
+        for row in self.collection.aggregate([{'$match': {'batch': self.batch}}, {'$group': {'_id': '$state', 'n': {'$sum': 1}}}]):
+            counts[row['_id']] = row['n']
+        return counts
+
+    def worker_totals(self) -> dict:
+        # Artists finished and songs written per worker, across every machine that joined the batch
+        totals = {}
+        pipeline = [{'$match': {'batch': self.batch, 'state': DONE}},
+                    {'$group': {'_id': '$worker', 'artists': {'$sum': 1}, 'songs': {'$sum': '$songs_written'},
+                                'planned': {'$sum': '$songs_planned'}}}]
+        for row in self.collection.aggregate(pipeline):
+            totals[row['_id']] = {'artists': row['artists'], 'songs': row['songs'], 'missed': row['planned'] - row['songs']}
+        return totals
+
+    def failures(self, limit: int = 10) -> list:
+        cursor = self.collection.find({'batch': self.batch, 'state': FAILED}, {'_id': 0, 'artist': 1, 'attempts': 1, 'error': 1})
+        return list(cursor.sort('updated_at', -1).limit(limit))
+
+class _Heartbeat:
+    # Renews a lease every third of its length while the artist is being scraped
+    def __init__(self, table: ArtistWorkTable, doc_id, worker_id: str):
+        self.table, self.doc_id, self.worker_id = table, doc_id, worker_id
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='lease-heartbeat', daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.table.lease_seconds / 3):
+            if not self.table.renew(self.doc_id, self.worker_id):
+                break
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+class BatchWorker:
+    """ Claims one artist at a time from an ArtistWorkTable and runs a BulkScraper for it on its own FetchEngine,
+        so every worker spends its own rate budget. BulkScraper ingests like add_artist_to_db: near-duplicates are
+        flagged, but new songs are only indexed by `main.py batch` once every worker process has finished.
+        An artist whose songs couldn't all be written goes back to the table.
+        Runs until no artist is pending or in flight anywhere."""
+
+    def __init__(self, table: ArtistWorkTable, engine: FetchEngine, worker_id: str = None, batch_size: int = None):
+        self.table = table
+        self.engine = engine
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self.batch_size = batch_size
+        self.logger = logging.getLogger(__name__)
+
+    def run_one(self) -> bool:
+        # Scrapes the next artist, :return: False when nothing could be claimed
+        doc = self.table.claim(self.worker_id)
+        if doc is None:
+            return False
+        artist = doc['artist']
+        self.logger.info(f"Worker {self.worker_id} scraping {artist} (attempt {doc['attempts']})")
+        try:
+            with _Heartbeat(self.table, doc['_id'], self.worker_id):
+                scraper = BulkScraper(artist, engine=self.engine, batch_size=self.batch_size, index=False)
+                written = scraper.run()
+            if not scraper.found:
+                raise RuntimeError('discography not found')
+            if scraper.write_errors:
+                # Songs that failed to scrape are only missed, songs the database refused are retried
+                raise RuntimeError(f'{scraper.write_errors} of {scraper.planned} songs could not be written')
+        except Exception as e:
+            self.logger.error(f'Worker {self.worker_id} failed on {artist}: {e}')
+            self.table.fail(doc['_id'], self.worker_id, str(e))
+            return True
+        self.table.complete(doc['_id'], self.worker_id, scraper.planned, written)
+        return True
+
+    def run(self, poll_interval: float = 5) -> int:
+        """ Works until nothing is pending or in flight, waiting on other workers' leases and retry backoffs.
+            :return: Number of artists this worker claimed."""
+        claimed = 0
+        while True:
+            if self.run_one():
+                claimed += 1
+                continue
+            counts = self.table.counts()
+            if not counts[PENDING] and not counts[IN_FLIGHT]:
+                break
+            time.sleep(poll_interval)
+        self.logger.info(f'Worker {self.worker_id} claimed {claimed} artists')
+        return claimed
+
+def worker_rate(workers: int, proxies: list = None) -> float:
+    # Workers behind one egress IP split the per-host rate, each proxy brings a full budget of its own
+    if proxies:
+        return settings.REQUESTS_PER_SECOND * min(len(proxies), workers) / workers
+    return settings.REQUESTS_PER_SECOND / workers
+
+def run_batch_worker(batch: str = None, index: int = 0, concurrency: int = None, rate: float = None,
+                     proxies: list = None, batch_size: int = None, offline: bool = None) -> int:
+    # Entry point for each `main.py batch` process, which builds its own MongoClient rather than inherit one across fork.
+    # offline is passed in because a spawned process starts from the default settings
+    registry.reset()
+    if offline is not None:
+        settings.HTTP_OFFLINE = offline
+    transport = get_transport()
+    proxies = settings.BATCH_PROXIES if proxies is None else proxies
+    if proxies:
+        proxy = proxies[index % len(proxies)]
+        transport.session.proxies.update({'http': proxy, 'https': proxy})
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    with FetchEngine(max_workers=concurrency, rate=rate, session=transport) as engine:
+        return BatchWorker(ArtistWorkTable(batch), engine, worker_id=worker_id, batch_size=batch_size).run()
@@ -1,14 +1,133 @@
 # scripts/bulk_scrape_lyrics
 
-import os
 import logging
+import threading
+import itertools
+import queue
+import time
+from config import settings
+from scripts import upload_to_mongodb
+from scripts.scrape_discography import AZArtists
+from scripts.fetch_engine import FetchEngine
+from scripts.upload_to_mongodb import (BulkUpserter, select_albums, add_artist_and_albums, scrape_songs, plan_duplicates,
+                                       index_new_songs)
+
+_DONE = object() # Tells the DB sink the stream has ended
 
 class BulkScraper:
-    """ Used to skip over saving the discography to a file. 
-        Immediatly does every song. 
-        TODO: Utilize the existing functions to scraping and save in one run."""
-    def __init__(self, artist: str):
+    """ Used to skip over saving the discography to a file.
+        Immediatly does every song, as a streaming pipeline:
+            discography page -> songs not stored yet -> FetchEngine workers (fetch + parse)
+            -> near-duplicate check -> bounded queue -> DB sink thread writing batched upserts
+        and adds the new songs to the similarity and search indexes at the end, like add_artist_to_db, unless index
+        is False: worker processes leave that to their parent, the index files take one writer at a time.
+        Only queue_size scraped songs are held at once, so memory stays flat for any discography size,
+        and partial batches are flushed every flush_interval seconds so the first songs land right away."""
+    def __init__(self, artist: str, engine: FetchEngine = None, batch_size: int = None, queue_size: int = None,
+                 flush_interval: float = None, num_albums: int = None, album_title: str = None, save_discography: bool = False,
+                 skip_duplicates: bool = None, link_duplicates: bool = None, index: bool = True):
         self.artist = artist
+        self.engine = engine
+        self.batch_size = batch_size or settings.MONGO_BATCH_SIZE
+        self.queue_size = queue_size or settings.PIPELINE_QUEUE_SIZE
+        self.flush_interval = flush_interval or settings.PIPELINE_FLUSH_INTERVAL
+        self.num_albums = num_albums
+        self.album_title = album_title
+        self.save_discography = save_discography
+        self.skip_duplicates = skip_duplicates
+        self.link_duplicates = settings.DEDUP_LINK if link_duplicates is None else link_duplicates
+        self.index = index
+        self.written = 0
+        self.write_errors = 0 # Songs the database refused
+        self.planned = 0 # Songs the run tried to scrape
+        self.found = None # Whether the discography page could be read
+        self.error = None # What stopped the DB sink, raised again by run()
         self.logger = logging.getLogger(__name__)
 
-    
+    # Stage 1: the songs of the discography that aren't in the database yet
+    def songs(self, engine: FetchEngine) -> dict:
+        discography = AZArtists(artist=self.artist, fetcher=engine)
+        albums = discography.open_url() if self.save_discography else discography.fetch_albums()
+        self.found = albums is not None
+        if albums is None:
+            return {}
+        albums_to_add = select_albums(self.artist, albums, self.num_albums, self.album_title)
+        if albums_to_add is None:
+            return {}
+        return add_artist_and_albums(self.artist, albums_to_add, bulk=True, batch_size=self.batch_size)
+
+    # Stage 3: drains the queue into batched upserts until the stream ends
+    def _sink(self, songs: queue.Queue):
+        writer = BulkUpserter(upload_to_mongodb.songs_collection(), self.batch_size)
+        try:
+            self._drain(songs, writer)
+        except Exception as e: # A thread's exception would die with it, run() raises it in the caller
+            self.logger.error(f'DB sink for {self.artist} failed: {e}')
+            self.error = e
+        finally:
+            self.written, self.write_errors = writer.written, writer.failed
+
+    def _drain(self, songs: queue.Queue, writer: BulkUpserter):
+        with writer:
+            first_pending = None # When the oldest unwritten song arrived
+            while True:
+                try:
+                    song_doc = songs.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    song_doc = None
+                if song_doc is _DONE:
+                    break
+                if song_doc is not None:
+                    writer.add(song_doc) # Writes by itself once a batch is full
+                if not writer.ops:
+                    first_pending = None
+                elif first_pending is None:
+                    first_pending = time.monotonic()
+                elif time.monotonic() - first_pending >= self.flush_interval:
+                    writer.flush()
+                    first_pending = None
+                    self.logger.info(f'{writer.written} songs written for {self.artist}')
+
+    def _put(self, songs: queue.Queue, item, sink: threading.Thread):
+        # Blocks while the sink is behind, which in turn stops new fetches, but never waits on a dead sink
+        while True:
+            if not sink.is_alive():
+                raise RuntimeError(f'DB sink for {self.artist} stopped') from self.error
+            try:
+                songs.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def run(self) -> int:
+        """ Scrapes the artist straight into MongoDB and returns the number of songs written.
+            Raises what stopped the DB sink, the songs written before it failed are in written."""
+        owns_engine = self.engine is None
+        engine = self.engine or FetchEngine()
+        songs = queue.Queue(maxsize=self.queue_size)
+        sink = threading.Thread(target=self._sink, args=(songs,), name=f'sink-{self.artist}', daemon=True)
+        sink.start()
+        try:
+            songs_to_scrape = self.songs(engine)
+            detector, linked, versions = plan_duplicates(self.artist, songs_to_scrape, self.skip_duplicates, self.link_duplicates)
+            self.planned = len(linked) + len(songs_to_scrape) + len(versions)
+            self.logger.info(f'{len(songs_to_scrape) + len(versions)} songs to scrape for {self.artist}')
+            # Stage 2: scrape_songs keeps at most queue_size songs in flight on the engine, versions come last
+            scraped = (scrape_songs(engine, self.artist, titles, max_pending=self.queue_size)
+                       for titles in (songs_to_scrape, versions) if titles)
+            for song_doc in itertools.chain(linked, *scraped):
+                if detector is not None and 'duplicate_of' not in song_doc:
+                    song_doc = detector.check(song_doc, link=self.link_duplicates)
+                self._put(songs, song_doc, sink)
+        finally:
+            if sink.is_alive():
+                self._put(songs, _DONE, sink)
+            sink.join()
+            if owns_engine:
+                engine.close()
+        if self.error is not None:
+            raise self.error
+        if self.written and self.index:
+            index_new_songs(self.artist)
+        print(f"Successfully added {self.written} songs for {self.artist} to MongoDB.")
+        return self.written
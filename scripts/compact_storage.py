@@ -0,0 +1,243 @@
+# scripts/compact_storage.py
+
+from pymongo import UpdateOne
+from bson import Binary
+from config import settings
+from scripts.services import registry
+from datetime import datetime, timezone
+import threading
+import struct
+import math
+import argparse
+import logging
+import bson
+
+# Byte layout of packed sentiment, float32 little-endian in this order. Stored documents depend on it,
+# so fields are only ever appended; a field a song wasn't scored on is NaN and left out when unpacked
+SENTIMENT_LAYOUT = (('vader', 'neg'), ('vader', 'neu'), ('vader', 'pos'), ('vader', 'compound'),
+                    ('nrc', 'anger'), ('nrc', 'anticipation'), ('nrc', 'disgust'), ('nrc', 'fear'),
+                    ('nrc', 'joy'), ('nrc', 'sadness'), ('nrc', 'surprise'), ('nrc', 'trust'))
+SENTIMENT_STRUCT = struct.Struct(f'<{len(SENTIMENT_LAYOUT)}f')
+
+logger = logging.getLogger(__name__)
+
+def _zstd():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        raise ImportError('Compact storage needs zstandard, pip install zstandard') from None
+
+def pack_sentiment(sentiment: dict) -> Binary:
+    """ {"vader": {...}, "nrc": {...}} as SENTIMENT_LAYOUT float32 values, 48 bytes instead of a nested document."""
+    values = [(sentiment.get(group) or {}).get(field) for group, field in SENTIMENT_LAYOUT]
+    return Binary(SENTIMENT_STRUCT.pack(*(math.nan if value is None else value for value in values)))
+
+def unpack_sentiment(data: bytes) -> dict:
+    sentiment = {}
+    # Songs packed before fields were appended are shorter, the missing fields are left out
+    values = SENTIMENT_STRUCT.unpack(data) if len(data) == SENTIMENT_STRUCT.size else struct.unpack(f'<{len(data) // 4}f', data)
+    for (group, field), value in zip(SENTIMENT_LAYOUT, values):
+        if not math.isnan(value):
+            sentiment.setdefault(group, {})[field] = value
+    return sentiment
+
+class LyricsCodec:
+    """ zstd compression of lyrics with a dictionary trained on the corpus. A lyric is a few hundred bytes, too
+        little for zstd to find repeats in on its own, the dictionary supplies the words and lines songs share.
+        Dictionaries are kept in MongoDB (COMPACT_DICT_COLLECTION) so every process can read every song: each frame
+        names the dictionary it was compressed with, new lyrics use the newest one, frames without one need none.
+        Compressors and decompressors aren't thread safe, each thread builds its own."""
+
+    def __init__(self, collection=None, level: int = None):
+        self.collection = collection if collection is not None else registry.get('db')[settings.COMPACT_DICT_COLLECTION]
+        self.level = level or settings.COMPACT_LEVEL
+        self.dictionaries = {} # dict_id -> ZstdCompressionDict, 0 for frames compressed without one
+        self.current = None    # dict_id new lyrics are compressed with, looked up on first use
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.logger = logging.getLogger(__name__)
+
+    def _dictionary(self, dict_id: int):
+        if dict_id not in self.dictionaries:
+            with self.lock:
+                if dict_id not in self.dictionaries:
+                    doc = self.collection.find_one({'_id': dict_id})
+                    if doc is None:
+                        raise KeyError(f'Lyrics dictionary {dict_id} is not in {self.collection.name}')
+                    self.dictionaries[dict_id] = _zstd().ZstdCompressionDict(doc['data'])
+        return self.dictionaries[dict_id]
+
+    def current_id(self) -> int:
+        if self.current is None:
+            newest = self.collection.find_one({}, {'_id': 1}, sort=[('created_at', -1)])
+            self.current = newest['_id'] if newest else 0
+        return self.current
+
+    def train(self, samples: list, size: int = None) -> int:
+        """ Trains a dictionary of size bytes on sample lyrics and makes it the one new lyrics are compressed with.
+            :return: Its id, or None when there are too few samples to train on."""
+        zstd = _zstd()
+        try:
+            dictionary = zstd.train_dictionary(size or settings.COMPACT_DICT_SIZE,
+                                               [text.encode('utf-8') for text in samples if text])
+        except zstd.ZstdError as e:
+            self.logger.warning(f'Could not train a lyrics dictionary on {len(samples)} songs: {e}')
+            return None
+        dict_id = dictionary.dict_id()
+        self.collection.replace_one({'_id': dict_id}, {'_id': dict_id, 'data': Binary(dictionary.as_bytes()),
+                                                       'samples': len(samples), 'created_at': datetime.now(timezone.utc)},
+                                    upsert=True)
+        with self.lock:
+            self.dictionaries[dict_id] = dictionary
+            self.current = dict_id
+        self.logger.info(f'Trained lyrics dictionary {dict_id} ({len(dictionary.as_bytes())} bytes) on {len(samples)} songs')
+        return dict_id
+
+    def compress(self, text: str) -> Binary:
+        dict_id = self.current_id()
+        cached = getattr(self.local, 'compressor', None)
+        if cached is None or cached[0] != dict_id:
+            zstd = _zstd()
+            compressor = zstd.ZstdCompressor(level=self.level, dict_data=self._dictionary(dict_id)) if dict_id \
+                else zstd.ZstdCompressor(level=self.level)
+            cached = self.local.compressor = (dict_id, compressor)
+        return Binary(cached[1].compress(text.encode('utf-8')))
+
+    def decompress(self, data: bytes) -> str:
+        zstd = _zstd()
+        dict_id = zstd.get_frame_parameters(data).dict_id
+        decompressors = getattr(self.local, 'decompressors', None)
+        if decompressors is None:
+            decompressors = self.local.decompressors = {}
+        decompressor = decompressors.get(dict_id)
+        if decompressor is None:
+            decompressor = decompressors[dict_id] = zstd.ZstdDecompressor(dict_data=self._dictionary(dict_id)) if dict_id \
+                else zstd.ZstdDecompressor()
+        return decompressor.decompress(data).decode('utf-8')
+
+    def dict_id_of(self, data: bytes) -> int:
+        return _zstd().get_frame_parameters(data).dict_id
+
+# Accessors: every reader of a song's lyrics or sentiment goes through these, so plain and compact songs can sit
+# side by side in one collection and COMPACT_STORAGE can be switched either way at any time
+
+def song_lyrics(song: dict) -> str:
+    """ The song's lyrics as text, None when it has none."""
+    lyrics = song.get('lyrics')
+    if isinstance(lyrics, bytes):
+        return registry.get('lyrics_codec').decompress(lyrics)
+    return lyrics
+
+def song_sentiment(song: dict) -> dict:
+    """ The song's sentiment as {"vader": {...}, "nrc": {...}}, None when it wasn't scored."""
+    sentiment = song.get('sentiment')
+    if isinstance(sentiment, bytes):
+        return unpack_sentiment(sentiment)
+    return sentiment
+
+def stored_lyrics(lyrics: str):
+    # What a writer stores as the lyrics field: the text, or its zstd frame with COMPACT_STORAGE
+    if settings.COMPACT_STORAGE and lyrics:
+        return registry.get('lyrics_codec').compress(lyrics)
+    return lyrics
+
+def stored_sentiment(sentiment: dict):
+    return pack_sentiment(sentiment) if settings.COMPACT_STORAGE else sentiment
+
+def uses_compact_storage(database) -> bool:
+    # Whether songs may be stored compact, without scanning for one: the mode is on or compact_collection ran
+    return settings.COMPACT_STORAGE or bool(database[settings.COMPACT_DICT_COLLECTION].estimated_document_count())
+
+def _songs(collection):
+    return collection if collection is not None else registry.get('songs_collection')
+
+def compact_collection(collection=None, dict_size: int = None, samples: int = None, batch_size: int = None,
+                       train: bool = True) -> int:
+    """
+    Rewrites the stored songs in the compact format: a dictionary is trained on a random sample of lyrics,
+    then every lyric not compressed with it is (re)compressed and every sentiment document packed.
+    lyrics_hash is a hash of the text, so nothing derived from the lyrics is recomputed afterwards.
+    :param train: False compresses with the newest stored dictionary instead of training one.
+    :return: Number of songs rewritten, 0 when there is no dictionary to compress with.
+    """
+    collection = _songs(collection)
+    codec = registry.get('lyrics_codec')
+    batch_size = batch_size or settings.MONGO_BATCH_SIZE
+    if train:
+        pipeline = [{'$match': {'lyrics': {'$exists': True}}}, {'$sample': {'size': samples or settings.COMPACT_DICT_SAMPLES}},
+                    {'$project': {'lyrics': 1}}]
+        codec.train([song_lyrics(song) for song in collection.aggregate(pipeline)], dict_size)
+    dict_id = codec.current_id()
+    if not dict_id:
+        # Too few songs to train on, compressing them one by one wouldn't save much
+        logger.warning('No lyrics dictionary, songs left as they are')
+        return 0
+    ops, rewritten = [], 0
+    for song in collection.find({'$or': [{'lyrics': {'$exists': True}}, {'sentiment': {'$exists': True}}]},
+                                {'lyrics': 1, 'sentiment': 1}, batch_size=batch_size):
+        update = {}
+        lyrics = song.get('lyrics')
+        if (isinstance(lyrics, str) and lyrics) or (isinstance(lyrics, bytes) and codec.dict_id_of(lyrics) != dict_id):
+            update['lyrics'] = codec.compress(song_lyrics(song))
+        if isinstance(song.get('sentiment'), dict):
+            update['sentiment'] = pack_sentiment(song['sentiment'])
+        if update:
+            ops.append(UpdateOne({'_id': song['_id']}, {'$set': update}))
+        if len(ops) >= batch_size:
+            rewritten += collection.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        rewritten += collection.bulk_write(ops, ordered=False).modified_count
+    logger.info(f'{rewritten} songs rewritten in the compact format')
+    return rewritten
+
+def expand_collection(collection=None, batch_size: int = None) -> int:
+    """ Turns compact songs back into plain text lyrics and sentiment documents. :return: Number of songs rewritten."""
+    collection = _songs(collection)
+    batch_size = batch_size or settings.MONGO_BATCH_SIZE
+    ops, rewritten = [], 0
+    for song in collection.find({'$or': [{'lyrics': {'$type': 'binData'}}, {'sentiment': {'$type': 'binData'}}]},
+                                {'lyrics': 1, 'sentiment': 1}, batch_size=batch_size):
+        update = {field: read(song) for field, read in (('lyrics', song_lyrics), ('sentiment', song_sentiment))
+                  if isinstance(song.get(field), bytes)}
+        ops.append(UpdateOne({'_id': song['_id']}, {'$set': update}))
+        if len(ops) >= batch_size:
+            rewritten += collection.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        rewritten += collection.bulk_write(ops, ordered=False).modified_count
+    logger.info(f'{rewritten} songs expanded to plain lyrics and sentiment')
+    return rewritten
+
+def storage_stats(collection=None) -> dict:
+    """ BSON bytes of the songs, in total and for their lyrics and sentiment fields, read client side."""
+    stats = {'songs': 0, 'document_bytes': 0, 'lyrics_bytes': 0, 'sentiment_bytes': 0}
+    for song in _songs(collection).find():
+        stats['songs'] += 1
+        stats['document_bytes'] += len(bson.encode(song))
+        for field in ('lyrics', 'sentiment'):
+            if field in song:
+                # The field's own encoding, less the 5 bytes of an empty document around it
+                stats[f'{field}_bytes'] += len(bson.encode({field: song[field]})) - 5
+    return stats
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Convert the stored songs to or from compact storage")
+    parser.add_argument('--expand', action='store_true', help="Back to plain text lyrics and sentiment documents")
+    parser.add_argument('--no_train', action='store_true', help="Compress with the newest stored dictionary")
+    parser.add_argument('--dict_size', type=int, default=None, help=f"Dictionary bytes, default {settings.COMPACT_DICT_SIZE}")
+    parser.add_argument('--samples', type=int, default=None, help=f"Songs trained on, default {settings.COMPACT_DICT_SAMPLES}")
+    parser.add_argument('--stats', action='store_true', help="Only print how many bytes the songs take")
+    args = parser.parse_args()
+
+    if not args.stats:
+        if args.expand:
+            expand_collection()
+        else:
+            compact_collection(dict_size=args.dict_size, samples=args.samples, train=not args.no_train)
+    stats = storage_stats()
+    per_song = max(stats['songs'], 1)
+    print(f"{stats['songs']} songs, {stats['document_bytes'] / per_song:.0f} bytes per song: "
+          f"{stats['lyrics_bytes'] / per_song:.0f} lyrics, {stats['sentiment_bytes'] / per_song:.0f} sentiment")
@@ -0,0 +1,259 @@
+# scripts/export_parquet.py
+
+from config import settings
+from scripts.upload_to_mongodb import songs_collection, albums_collection, artists_collection
+from scripts.generate_embeddings import _batches
+from scripts.sentiment_engine import NRC_EMOTIONS
+from scripts.compact_storage import song_lyrics, song_sentiment
+from urllib.parse import quote
+import argparse
+import hashlib
+import logging
+import sqlite3
+import shutil
+import json
+import time
+import os
+
+VADER_FIELDS = ('neg', 'neu', 'pos', 'compound')
+
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    song_id TEXT PRIMARY KEY,
+    artist TEXT NOT NULL,
+    release_year TEXT NOT NULL,
+    fingerprint TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS songs_partition ON songs (artist, release_year);
+"""
+
+logger = logging.getLogger(__name__)
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        return pyarrow
+    except ImportError:
+        raise ImportError('The Parquet export needs pyarrow, pip install pyarrow') from None
+
+def song_schema():
+    pa = _pyarrow()
+    return pa.schema([('song_id', pa.string()), ('title', pa.string()), ('album', pa.string()), ('genre', pa.string()),
+                      ('writers', pa.string()), ('lyrics', pa.string()), ('lyrics_hash', pa.string()),
+                      ('sentiment_version', pa.string())]
+                     + [(f'vader_{field}', pa.float64()) for field in VADER_FIELDS]
+                     + [(f'nrc_{emotion}', pa.float64()) for emotion in NRC_EMOTIONS])
+
+def partition_of(song: dict) -> tuple:
+    # Songs are laid out as songs/artist=<name>/release_year=<year>/
+    return song.get('artist') or 'Unknown', str(song.get('release_year') or 'Unknown')
+
+def fingerprint(song: dict) -> str:
+    # Everything exported but the lyrics, which lyrics_hash stands for, so the check never reads them
+    fields = {key: value for key, value in song.items() if key not in ('_id', 'lyrics')}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def song_row(song: dict) -> dict:
+    """ A song as one flat Parquet row, the sentiment scores as vader_* and nrc_* columns."""
+    sentiment = song_sentiment(song) or {}
+    vader, nrc = sentiment.get('vader') or {}, sentiment.get('nrc') or {}
+    row = {'song_id': str(song['_id'])}
+    row.update((key, song.get(key)) for key in ('title', 'album', 'genre', 'writers', 'lyrics_hash', 'sentiment_version'))
+    row['lyrics'] = song_lyrics(song)
+    row.update((f'vader_{field}', vader.get(field)) for field in VADER_FIELDS)
+    row.update((f'nrc_{emotion}', nrc.get(emotion)) for emotion in NRC_EMOTIONS)
+    return row
+
+class PartitionWriter:
+    """ Writes rows into part files under their artist/year partition directory, rows_per_file at a time,
+        so an export holds at most rows_per_file rows of one partition in memory."""
+
+    def __init__(self, directory: str, rows_per_file: int = None):
+        self.directory = directory
+        self.rows_per_file = rows_per_file or settings.EXPORT_ROWS_PER_FILE
+        self.partition, self.rows = None, []
+        self.files = []
+        self.written = 0
+        self.logger = logging.getLogger(__name__)
+
+    def path(self, partition: tuple) -> str:
+        artist, year = partition
+        return os.path.join(self.directory, f'artist={quote(artist, safe="")}', f'release_year={quote(year, safe="")}')
+
+    def add(self, partition: tuple, song: dict):
+        if partition != self.partition:
+            self.flush()
+            self.partition = partition
+        self.rows.append(song_row(song))
+        if len(self.rows) >= self.rows_per_file:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        pa = _pyarrow()
+        directory = self.path(self.partition)
+        os.makedirs(directory, exist_ok=True)
+        name = f'part-{time.time_ns()}-{len(self.files)}.parquet'
+        # Written under a dot name and renamed, readers skip hidden files and never see half a file
+        pa.parquet.write_table(pa.Table.from_pylist(self.rows, schema=song_schema()), os.path.join(directory, '.' + name),
+                               compression=settings.EXPORT_COMPRESSION)
+        os.replace(os.path.join(directory, '.' + name), os.path.join(directory, name))
+        self.files.append(os.path.join(directory, name))
+        self.written += len(self.rows)
+        self.rows = []
+
+class ExportManifest:
+    """ What each exported song looked like (its partition and fingerprint), in _manifest.sqlite next to the export."""
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, '_manifest.sqlite'), timeout=30)
+        self.db.executescript(MANIFEST_SCHEMA)
+
+    def __len__(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+
+    def lookup(self, song_ids: list) -> dict:
+        stored = {}
+        for start in range(0, len(song_ids), 500):
+            ids = song_ids[start:start + 500]
+            stored.update((song_id, ((artist, year), digest)) for song_id, artist, year, digest in self.db.execute(
+                f"SELECT song_id, artist, release_year, fingerprint FROM songs WHERE song_id IN ({','.join('?' * len(ids))})", ids))
+        return stored
+
+    def record(self, entries: list):
+        # [(song_id, (artist, year), fingerprint)]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO songs (song_id, artist, release_year, fingerprint) VALUES (?, ?, ?, ?)',
+                                ((song_id, *partition, digest) for song_id, partition, digest in entries))
+
+    def drop_partition(self, partition: tuple):
+        with self.db:
+            self.db.execute('DELETE FROM songs WHERE artist = ? AND release_year = ?', partition)
+
+    def clear(self):
+        with self.db:
+            self.db.execute('DELETE FROM songs')
+
+    def close(self):
+        self.db.close()
+
+def _partition_query(partition: tuple) -> dict:
+    artist, year = partition
+    query = {'artist': artist if artist != 'Unknown' else {'$in': ['Unknown', None]}}
+    query['release_year'] = year if year != 'Unknown' else {'$in': ['Unknown', None]}
+    return query
+
+def _write_songs(writer: PartitionWriter, manifest: ExportManifest, songs):
+    recorded = []
+    for song in songs:
+        partition = partition_of(song)
+        writer.add(partition, song)
+        recorded.append((str(song['_id']), partition, fingerprint(song)))
+        if len(recorded) >= 1000:
+            manifest.record(recorded)
+            recorded = []
+    writer.flush()
+    manifest.record(recorded)
+
+def export_songs(collection=None, directory: str = None, full: bool = False, batch_size: int = None) -> dict:
+    """
+    Syncs the songs collection to Parquet files partitioned by artist and release year.
+    A full export streams every song, sorted by partition, into a new directory that then replaces the old one.
+    Otherwise a first pass reads every song but its lyrics and compares it with the manifest: new songs are
+    appended to their partitions as new part files, a partition with a changed song is rewritten.
+    :return: {'appended': songs in new part files, 'rewritten': partitions rewritten, 'songs': rows written}
+    """
+    collection = collection if collection is not None else songs_collection()
+    directory = os.path.join(directory or settings.EXPORT_DIR, 'songs')
+    batch_size = batch_size or settings.EXPORT_BATCH_SIZE
+    manifest = ExportManifest(os.path.dirname(directory))
+    stats = {'appended': 0, 'rewritten': 0, 'songs': 0}
+    try:
+        if full or not len(manifest) or not os.path.isdir(directory):
+            staging = directory + '.tmp'
+            shutil.rmtree(staging, ignore_errors=True)
+            manifest.clear()
+            writer = PartitionWriter(staging)
+            cursor = collection.find({}, batch_size=batch_size).sort([('artist', 1), ('release_year', 1)])
+            _write_songs(writer, manifest, cursor)
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(staging, exist_ok=True)
+            os.replace(staging, directory)
+            stats['songs'] = writer.written
+            logger.info(f'Exported {writer.written} songs to {directory}')
+            return stats
+
+        new, dirty = {}, set()
+        for batch in _batches(collection.find({}, {'lyrics': 0}, batch_size=batch_size), batch_size):
+            stored = manifest.lookup([str(song['_id']) for song in batch])
+            for song in batch:
+                partition, previous = partition_of(song), stored.get(str(song['_id']))
+                if previous is None:
+                    new.setdefault(partition, []).append(song['_id'])
+                elif previous != (partition, fingerprint(song)):
+                    dirty.update((partition, previous[0]))
+
+        writer = PartitionWriter(directory)
+        for partition in sorted(dirty):
+            old_files = [os.path.join(writer.path(partition), name) for name in os.listdir(writer.path(partition))] \
+                if os.path.isdir(writer.path(partition)) else []
+            manifest.drop_partition(partition)
+            _write_songs(writer, manifest, collection.find(_partition_query(partition), batch_size=batch_size))
+            for path in old_files:
+                os.remove(path)
+            stats['rewritten'] += 1
+        # New songs are fetched batch_size at a time whatever their partition, then written grouped by partition
+        ids = [song_id for partition, song_ids in new.items() if partition not in dirty for song_id in song_ids]
+        before = writer.written
+        for chunk in _batches(ids, batch_size):
+            _write_songs(writer, manifest, sorted(collection.find({'_id': {'$in': chunk}}), key=partition_of))
+        stats['appended'] = writer.written - before
+        stats['songs'] = writer.written
+        logger.info(f"Appended {stats['appended']} songs and rewrote {stats['rewritten']} partitions in {directory}")
+        return stats
+    finally:
+        manifest.close()
+
+def export_collection(collection, path: str, fields: dict, batch_size: int = None) -> int:
+    """ Streams a small collection (albums, artists) into a single Parquet file, replaced on every export."""
+    pa = _pyarrow()
+    schema = pa.schema(list(fields.items()))
+    batch_size = batch_size or settings.EXPORT_BATCH_SIZE
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    staging = os.path.join(os.path.dirname(path), '.' + os.path.basename(path))
+    written = 0
+    with pa.parquet.ParquetWriter(staging, schema, compression=settings.EXPORT_COMPRESSION) as writer:
+        for batch in _batches(collection.find({}, {name: 1 for name in fields}, batch_size=batch_size), batch_size):
+            writer.write_table(pa.Table.from_pylist([{name: doc.get(name) for name in fields} for doc in batch], schema=schema))
+            written += len(batch)
+    os.replace(staging, path)
+    return written
+
+def export_all(directory: str = None, full: bool = False, batch_size: int = None) -> dict:
+    pa = _pyarrow()
+    directory = directory or settings.EXPORT_DIR
+    stats = export_songs(directory=directory, full=full, batch_size=batch_size)
+    stats['albums'] = export_collection(albums_collection(), os.path.join(directory, 'albums', 'albums.parquet'), {
+        'title': pa.string(), 'artist': pa.string(), 'release_year': pa.string(), 'songs': pa.list_(pa.string())}, batch_size)
+    stats['artists'] = export_collection(artists_collection(), os.path.join(directory, 'artists', 'artists.parquet'), {
+        'name': pa.string(), 'albums': pa.list_(pa.string())}, batch_size)
+    return stats
+
+def songs_dataset(directory: str = None):
+    """ The exported songs as a pyarrow dataset, artist and release_year come from the directory names:
+        songs_dataset().to_table(columns=['vader_compound'], filter=pc.field('artist') == 'All Time Low')"""
+    pa = _pyarrow()
+    import pyarrow.dataset as ds
+    partitioning = ds.partitioning(pa.schema([('artist', pa.string()), ('release_year', pa.string())]), flavor='hive')
+    return ds.dataset(os.path.join(directory or settings.EXPORT_DIR, 'songs'), format='parquet', partitioning=partitioning)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export MongoDB songs, albums and artists to Parquet")
+    parser.add_argument('--full', action='store_true', help="Rewrite every partition instead of syncing changes")
+    parser.add_argument('--batch_size', type=int, help="Documents per cursor batch")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(export_all(full=args.full, batch_size=args.batch_size))
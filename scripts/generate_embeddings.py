@@ -0,0 +1,311 @@
+# scripts/generate_embeddings.py
+
+from concurrent.futures import ProcessPoolExecutor
+from config import settings
+from scripts.upload_to_mongodb import songs_collection, lyrics_hash, without_linked
+from scripts.compact_storage import song_lyrics
+import numpy as np
+import argparse
+import itertools
+import logging
+import sqlite3
+import json
+import zlib
+import re
+import os
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+# Function words every song shares, left out so vectors reflect what the lyrics are about
+STOPWORDS = frozenset("""
+a an and are as at be but by do for from had has have he her him his i i'm if in into is it it's its me my no not
+of oh on or our she so that the their them then there they this to up was we were what when with you you're your
+""".split())
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rows (
+    song_id TEXT PRIMARY KEY,
+    row INTEGER NOT NULL UNIQUE,
+    lyrics_hash TEXT NOT NULL,
+    artist TEXT,
+    title TEXT
+);
+CREATE INDEX IF NOT EXISTS rows_artist_title ON rows (artist, title);
+"""
+
+logger = logging.getLogger(__name__)
+
+class HashedNgramEmbedder:
+    """ CPU-only lyric vectors with no training step: word unigrams and bigrams are hashed into dim buckets
+        with a random sign, weighted by 1 + log(count) and L2 normalized. Nothing depends on the rest
+        of the corpus, so songs can be embedded one batch at a time and new songs never shift old vectors."""
+
+    def __init__(self, dim: int = None):
+        self.dim = dim or settings.EMBEDDING_DIM
+        self.name = f'hashed-ngram-{self.dim}'
+        self._token_hashes = {} # A lyrics corpus has a small vocabulary, every word is hashed once
+
+    def _hashes(self, text: str) -> np.ndarray:
+        cache = self._token_hashes
+        hashes = []
+        for token in TOKEN_PATTERN.findall(text.lower()):
+            if token in STOPWORDS:
+                continue
+            h = cache.get(token)
+            if h is None:
+                h = cache[token] = zlib.crc32(token.encode('utf-8'))
+            hashes.append(h)
+        return np.asarray(hashes, dtype=np.uint64)
+
+    def embed_many(self, texts: list) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            unigrams = self._hashes(text or '')
+            if not len(unigrams):
+                continue
+            # Bigram hashes are mixed from their two word hashes in numpy instead of hashing strings
+            bigrams = (unigrams[:-1] * np.uint64(0x9E3779B1)) ^ unigrams[1:]
+            features = np.concatenate([unigrams, bigrams]) * np.uint64(0x85EBCA6B) % np.uint64(2 ** 61 - 1)
+            signs = np.where((features >> np.uint64(40)) & np.uint64(1), -1.0, 1.0)
+            bucket_ids = (features % np.uint64(self.dim)).astype(np.intp)
+            totals = np.bincount(bucket_ids, weights=signs, minlength=self.dim)
+            vector = np.sign(totals) * np.log1p(np.abs(totals))
+            norm = np.linalg.norm(vector)
+            if norm:
+                vectors[i] = vector / norm
+        return vectors
+
+class SentenceTransformerEmbedder:
+    """ Local transformer model through sentence-transformers (pip install sentence-transformers), e.g. all-MiniLM-L6-v2.
+        Runs in the calling process, the model spreads each batch over the cores itself."""
+
+    def __init__(self, model: str):
+        from sentence_transformers import SentenceTransformer # Optional dependency, only imported when requested
+        self.model = SentenceTransformer(model, device='cpu')
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = f'sentence-transformers/{model}'
+
+    def embed_many(self, texts: list) -> np.ndarray:
+        return self.model.encode([text or '' for text in texts], batch_size=64, normalize_embeddings=True,
+                                 convert_to_numpy=True).astype(np.float32)
+
+def get_embedder(model: str = None):
+    model = model or settings.EMBEDDING_MODEL
+    return SentenceTransformerEmbedder(model) if model else HashedNgramEmbedder()
+
+class EmbeddingStore:
+    """ Song vectors in data/embeddings:
+            vectors.f32   - float32 rows, memory-mapped, grown in steps so the corpus never has to fit in RAM
+            index.sqlite  - song _id -> row, with the lyrics hash the row was computed from, artist and title
+            meta.json     - embedder name and dimension, a store only ever holds one kind of vector
+        A song whose lyrics change keeps its row and gets the new vector written over the old one.
+        A read_only store never creates, grows or writes anything, and raises FileNotFoundError when there is none."""
+
+    GROWTH_ROWS = 4096
+
+    def __init__(self, directory: str = None, dim: int = None, model: str = None, read_only: bool = False):
+        self.directory = directory or settings.EMBEDDINGS_DIR
+        self.read_only = read_only
+        self.meta_path = os.path.join(self.directory, 'meta.json')
+        self.vectors_path = os.path.join(self.directory, 'vectors.f32')
+        index_path = os.path.join(self.directory, 'index.sqlite')
+        if read_only:
+            if not (os.path.exists(self.meta_path) and os.path.exists(index_path)):
+                raise FileNotFoundError(f'No embedding store in {self.directory}, generate embeddings first')
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if (dim and dim != meta['dim']) or (model and model != meta['model']):
+                raise ValueError(f"{self.directory} holds {meta['model']} vectors, rebuild it to switch to {model}")
+            self.dim, self.model = meta['dim'], meta['model']
+        elif dim is None:
+            raise ValueError(f'No embedding store in {self.directory}, generate embeddings first')
+        else:
+            self.dim, self.model = dim, model
+            with open(self.meta_path, 'w', encoding='utf-8') as f:
+                json.dump({'dim': dim, 'model': model}, f)
+        if read_only:
+            self.db = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True, timeout=30, check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(index_path, timeout=30, check_same_thread=False)
+            self.db.executescript(SCHEMA)
+        self.count = self.db.execute('SELECT COALESCE(MAX(row) + 1, 0) FROM rows').fetchone()[0]
+        if read_only:
+            self._map_read_only()
+        else:
+            self._map(max(self.count, 1))
+        self.logger = logging.getLogger(__name__)
+
+    def _map(self, min_rows: int):
+        # The file only grows, and in GROWTH_ROWS steps so appending a batch doesn't remap every time
+        row_bytes = self.dim * 4
+        size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        capacity = size // row_bytes
+        if capacity < min_rows:
+            capacity = max(min_rows, capacity * 2, self.GROWTH_ROWS)
+            with open(self.vectors_path, 'ab') as f:
+                f.truncate(capacity * row_bytes)
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+
+    def _map_read_only(self):
+        # Vectors are written before their index rows, so the file always covers count rows
+        size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        capacity = size // (self.dim * 4)
+        if capacity < self.count:
+            raise FileNotFoundError(f'{self.vectors_path} is missing rows, generate embeddings again')
+        if capacity:
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(capacity, self.dim))
+        else:
+            self._vectors = np.empty((0, self.dim), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def vectors(self) -> np.ndarray:
+        # Rows 0..count-1, still backed by the file
+        return self._vectors[:self.count]
+
+    def stale(self, songs: list) -> list:
+        """ The song ids among [(song_id, lyrics_hash)] that have no vector or one computed from other lyrics."""
+        stored = {}
+        for start in range(0, len(songs), 500):
+            ids = [song_id for song_id, _ in songs[start:start + 500]]
+            query = f"SELECT song_id, lyrics_hash FROM rows WHERE song_id IN ({','.join('?' * len(ids))})"
+            stored.update(self.db.execute(query, ids).fetchall())
+        return [song_id for song_id, digest in songs if stored.get(song_id) != digest]
+
+    def put_many(self, entries: list, vectors: np.ndarray):
+        """ Stores vectors for [(song_id, lyrics_hash, artist, title)], rewriting the rows of songs already present."""
+        rows = dict(self.db.execute(
+            f"SELECT song_id, row FROM rows WHERE song_id IN ({','.join('?' * len(entries))})",
+            [entry[0] for entry in entries]).fetchall()) if entries else {}
+        assigned = []
+        for song_id, *_ in entries:
+            if song_id not in rows:
+                rows[song_id] = self.count
+                self.count += 1
+            assigned.append(rows[song_id])
+        if self.count > len(self._vectors):
+            self._vectors.flush()
+            self._map(self.count)
+        self._vectors[assigned] = vectors
+        self._vectors.flush()
+        # Vectors first, then the index, so a crash in between only leaves a row to be recomputed
+        self.db.executemany('INSERT OR REPLACE INTO rows (song_id, row, lyrics_hash, artist, title) VALUES (?, ?, ?, ?, ?)',
+                            ((song_id, row, digest, artist, title) for (song_id, digest, artist, title), row in zip(entries, assigned)))
+        self.db.commit()
+
+    def row_of(self, artist: str, title: str):
+        row = self.db.execute('SELECT row FROM rows WHERE artist = ? AND title = ?', (artist, title)).fetchone()
+        return row[0] if row else None
+
+    def songs(self, rows) -> list:
+        """ (artist, title) for each row number."""
+        rows = [int(row) for row in rows]
+        found = dict((row, (artist, title)) for row, artist, title in self.db.execute(
+            f"SELECT row, artist, title FROM rows WHERE row IN ({','.join('?' * len(rows))})", rows)) if rows else {}
+        return [found.get(row) for row in rows]
+
+    def close(self):
+        if not self.read_only:
+            self._vectors.flush()
+        del self._vectors
+        self.db.close()
+
+def _batches(iterable, size: int):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def _stale_songs(collection, store: EmbeddingStore, query: dict, batch_size: int):
+    fields = {'artist': 1, 'title': 1, 'lyrics': 1, 'lyrics_hash': 1}
+    query = without_linked(query)
+    if not len(store): # Every song needs a vector, one pass with the lyrics
+        for song in collection.find(query, fields, batch_size=batch_size):
+            song['lyrics'] = song_lyrics(song)
+            song['lyrics_hash'] = song.get('lyrics_hash') or lyrics_hash(song['lyrics'])
+            yield song
+        return
+    # First pass reads only ids and hashes, lyrics are fetched for the songs that need a vector
+    cursor = collection.find(query, {'lyrics_hash': 1}, batch_size=batch_size)
+    for batch in _batches(cursor, batch_size):
+        hashes = {str(song['_id']): song.get('lyrics_hash') for song in batch}
+        stale = set(store.stale(list(hashes.items())))
+        if not stale:
+            continue
+        ids = [song['_id'] for song in batch if str(song['_id']) in stale]
+        for song in collection.find({'_id': {'$in': ids}}, fields):
+            # Songs stored before lyrics_hash existed are hashed here and always refreshed
+            song['lyrics'] = song_lyrics(song)
+            song['lyrics_hash'] = song.get('lyrics_hash') or lyrics_hash(song['lyrics'])
+            yield song
+
+def generate_embeddings(collection=None, store: EmbeddingStore = None, embedder=None, query: dict = None,
+                        batch_size: int = None, processes: int = None) -> int:
+    """
+    Embeds every song matching query whose lyrics changed since its vector was stored.
+    Batches are embedded on a process pool (hashed n-grams) or by the local model, and written as they finish.
+    :return: Number of songs embedded.
+    """
+    collection = collection if collection is not None else songs_collection()
+    embedder = embedder or get_embedder()
+    owns_store = store is None
+    if owns_store:
+        store = EmbeddingStore(dim=embedder.dim, model=embedder.name)
+    batch_size = batch_size or settings.EMBEDDING_BATCH_SIZE
+    processes = processes or settings.EMBEDDING_PROCESSES
+    embedded = 0
+
+    def write(batch, vectors):
+        nonlocal embedded
+        store.put_many([(str(song['_id']), song['lyrics_hash'], song.get('artist'), song.get('title')) for song in batch], vectors)
+        embedded += len(batch)
+        logger.info(f'{embedded} songs embedded')
+
+    batches = _batches(_stale_songs(collection, store, query or {}, batch_size), batch_size)
+    try:
+        if processes <= 1 or not isinstance(embedder, HashedNgramEmbedder):
+            for batch in batches:
+                write(batch, embedder.embed_many([song.get('lyrics') for song in batch]))
+        else:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(embedder.dim,)) as pool:
+                pending = []
+                for batch in batches:
+                    pending.append((batch, pool.submit(_embed_batch, [song.get('lyrics') for song in batch])))
+                    if len(pending) >= processes * 2:
+                        batch, future = pending.pop(0)
+                        write(batch, future.result())
+                for batch, future in pending:
+                    write(batch, future.result())
+    finally:
+        if owns_store:
+            store.close()
+    return embedded
+
+# Process pool workers keep one embedder, and its token hash cache, for every batch they get
+_worker_embedder = None
+
+def _init_worker(dim: int):
+    global _worker_embedder
+    _worker_embedder = HashedNgramEmbedder(dim)
+
+def _embed_batch(texts: list) -> np.ndarray:
+    return _worker_embedder.embed_many(texts)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Embed the lyrics of every new or changed song in MongoDB")
+    parser.add_argument('--processes', type=int, help="Embedding processes for hashed n-gram vectors")
+    parser.add_argument('--batch_size', type=int, help="Songs per batch")
+    parser.add_argument('--model', type=str, help="Local sentence-transformers model instead of hashed n-grams")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    count = generate_embeddings(embedder=get_embedder(args.model), batch_size=args.batch_size, processes=args.processes)
+    if count:
+        from scripts.similarity_index import update_index
+        update_index()
+    print(f"Embedded {count} songs into {settings.EMBEDDINGS_DIR}.")
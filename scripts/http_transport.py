@@ -0,0 +1,119 @@
+# scripts/http_transport.py
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import settings
+from scripts.page_cache import PageCache, MemoryPageCache
+from scripts.metrics import metrics, status_class
+import requests
+import threading
+import logging
+import time
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class HttpTransport:
+    """ Pooled keep-alive session shared by AZLyrics, AZArtists and the FetchEngine.
+        - connect/read timeouts on every request, so one stalled socket can't hang a run
+        - exponential backoff retries for connection errors, 429 and 5xx
+        - a page cache: pages younger than ttl are served without a request, older ones are revalidated
+          with their ETag/Last-Modified, and a 304 is answered with the cached body so unchanged pages cost no download
+        - offline mode: every page comes from the cache and uncached pages fail without touching the network"""
+
+    def __init__(self, pool_size: int = None, connect_timeout: float = None, read_timeout: float = None,
+                 retries: int = None, backoff_factor: float = None, cache=None, ttl: float = None, offline: bool = False):
+        self.timeout = (connect_timeout or settings.HTTP_CONNECT_TIMEOUT, read_timeout or settings.HTTP_READ_TIMEOUT)
+        pool_size = pool_size or settings.HTTP_POOL_SIZE
+        retry = Retry(
+            total=settings.HTTP_RETRIES if retries is None else retries,
+            backoff_factor=settings.HTTP_BACKOFF_FACTOR if backoff_factor is None else backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=('GET', 'HEAD'),
+            respect_retry_after_header=True
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache = cache if cache is not None else MemoryPageCache()
+        self.ttl = settings.PAGE_CACHE_TTL if ttl is None else ttl
+        self.offline = offline
+        self.logger = logging.getLogger(__name__)
+
+    def _is_fresh(self, cached: dict) -> bool:
+        return cached is not None and self._is_fresh_at(cached['fetched_at'])
+
+    def _is_fresh_at(self, fetched_at: float) -> bool:
+        return fetched_at is not None and (self.offline or time.time() - fetched_at < self.ttl)
+
+    # True when get() would answer from the cache without a request, lets rate limiters skip the wait
+    def is_cached(self, url: str) -> bool:
+        # Only the timestamp, get() reads the body once the page is actually requested
+        return self._is_fresh_at(self.cache.fetched_at(url))
+
+    # Drop-in for requests.get
+    def get(self, url: str, **kwargs) -> requests.Response:
+        cached = self.cache.get(url)
+        if self._is_fresh(cached):
+            self.logger.debug('Cache hit: %s', url)
+            metrics.inc('page_cache_total', result='hit')
+            return self._cached_response(url, cached)
+        if self.offline:
+            metrics.inc('page_cache_total', result='offline_miss')
+            raise requests.exceptions.ConnectionError(f'Offline and {url} is not cached')
+
+        kwargs.setdefault('timeout', self.timeout)
+        headers = dict(kwargs.pop('headers', None) or {})
+        if cached:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        try:
+            with metrics.timer('http_request_seconds'):
+                response = self.session.get(url, headers=headers, **kwargs)
+        except requests.exceptions.RequestException as e:
+            metrics.inc('http_errors_total', error=type(e).__name__)
+            raise
+        metrics.inc('http_responses_total', status=status_class(response.status_code))
+
+        if response.status_code == 304 and cached:
+            self.logger.debug('Not modified: %s', url)
+            metrics.inc('page_cache_total', result='revalidated')
+            self.cache.touch(url)
+            response.status_code = 200
+            response._content = cached['content']
+            response.encoding = cached['encoding']
+            response.revalidated = True
+        elif response.status_code == 200:
+            metrics.inc('page_cache_total', result='miss')
+            self.cache.put(url, response.content, encoding=response.encoding,
+                           etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'))
+        return response
+
+    @staticmethod
+    def _cached_response(url: str, cached: dict) -> requests.Response:
+        response = requests.Response()
+        response.url = url
+        response.status_code = 200
+        response.reason = 'OK'
+        response._content = cached['content']
+        response.encoding = cached['encoding']
+        response.from_cache = True
+        return response
+
+    def close(self):
+        self.session.close()
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport() -> HttpTransport:
+    # One transport per process, so every scraper shares the same connection pool
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            cache = PageCache() if settings.PAGE_CACHE_DIR else MemoryPageCache()
+            _transport = HttpTransport(cache=cache, offline=settings.HTTP_OFFLINE)
+        return _transport
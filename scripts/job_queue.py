@@ -0,0 +1,288 @@
+# scripts/job_queue.py
+
+from config import settings
+from scripts import upload_to_mongodb
+from scripts.services import registry
+from scripts.metrics import metrics
+from scripts.scrape_lyrics import AZLyrics
+from scripts.fetch_engine import FetchEngine
+from scripts.upload_to_mongodb import BulkUpserter, make_song_doc, plan_duplicates
+import threading
+import logging
+import sqlite3
+import socket
+import time
+import os
+
+PENDING, IN_FLIGHT, DONE, FAILED = 'pending', 'in_flight', 'done', 'failed'
+STATES = (PENDING, IN_FLIGHT, DONE, FAILED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    artist TEXT NOT NULL,
+    album TEXT,
+    song TEXT NOT NULL,
+    release_year TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    last_error TEXT,
+    updated_at REAL NOT NULL,
+    UNIQUE (artist, song)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, available_at);
+"""
+
+class JobQueue:
+    """ Durable queue of (artist, album, song) scrape jobs in SQLite, safe to share between processes.
+        pending -> in_flight (leased to one worker) -> done
+                                                   -> pending again after a backoff, or failed after max_attempts
+        A worker that dies keeps its lease until it expires, then the job goes back to whoever claims next,
+        so restarting the workers continues exactly where they stopped."""
+
+    def __init__(self, path: str = None, lease_seconds: float = None, max_attempts: int = None, retry_backoff: float = None):
+        self.path = path or settings.JOB_QUEUE_PATH
+        self.lease_seconds = lease_seconds or settings.JOB_LEASE_SECONDS
+        self.max_attempts = max_attempts or settings.JOB_MAX_ATTEMPTS
+        self.retry_backoff = settings.JOB_RETRY_BACKOFF if retry_backoff is None else retry_backoff
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # isolation_level=None hands transactions to us, claims use BEGIN IMMEDIATE to lock out other claimers
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.logger = logging.getLogger(__name__)
+
+    def enqueue_many(self, jobs) -> int:
+        """ Adds (artist, album, song, release_year) jobs, songs already queued for the artist are ignored.
+            :return: Number of new jobs."""
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        before = self.db.total_changes
+        self.db.executemany(
+            'INSERT OR IGNORE INTO jobs (artist, album, song, release_year, updated_at) VALUES (?, ?, ?, ?, ?)',
+            ((artist, album, song, release_year, now) for artist, album, song, release_year in jobs)
+        )
+        added = self.db.total_changes - before
+        self.db.execute('COMMIT')
+        return added
+
+    def enqueue(self, artist: str, album: str, song: str, release_year: str = None) -> bool:
+        return self.enqueue_many([(artist, album, song, release_year)]) == 1
+
+    def claim(self, worker_id: str, limit: int = 1) -> list:
+        """ Leases up to limit jobs to worker_id: pending jobs whose backoff has passed, and in-flight jobs whose lease expired.
+            Expired jobs that already used every attempt are marked failed instead."""
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.execute(
+                "UPDATE jobs SET state = ?, lease_owner = NULL, last_error = 'lease expired', updated_at = ? "
+                "WHERE state = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, now, IN_FLIGHT, now, self.max_attempts)
+            )
+            rows = self.db.execute(
+                'SELECT * FROM jobs WHERE (state = ? AND available_at <= ?) OR (state = ? AND lease_expires < ?) '
+                'ORDER BY id LIMIT ?',
+                (PENDING, now, IN_FLIGHT, now, limit)
+            ).fetchall()
+            self.db.executemany(
+                'UPDATE jobs SET state = ?, lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?',
+                ((IN_FLIGHT, worker_id, now + self.lease_seconds, now, row['id']) for row in rows)
+            )
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return [dict(row, attempts=row['attempts'] + 1) for row in rows]
+
+    def renew(self, job_ids: list, worker_id: str) -> int:
+        # Extends the leases still held on job_ids, a slow batch must not be handed to a second worker
+        now = time.time()
+        cursor = self.db.execute(
+            f"UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE state = ? AND lease_owner = ? "
+            f"AND id IN ({','.join('?' * len(job_ids))})",
+            (now + self.lease_seconds, now, IN_FLIGHT, worker_id, *job_ids)
+        )
+        return cursor.rowcount
+
+    def complete(self, job_id: int, worker_id: str) -> bool:
+        # Only the current lease holder can finish a job, a worker whose lease expired loses it
+        cursor = self.db.execute(
+            'UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL, last_error = NULL, updated_at = ? '
+            'WHERE id = ? AND state = ? AND lease_owner = ?',
+            (DONE, time.time(), job_id, IN_FLIGHT, worker_id)
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id: int, worker_id: str, error: str) -> bool:
+        now = time.time()
+        row = self.db.execute('SELECT attempts FROM jobs WHERE id = ? AND state = ? AND lease_owner = ?',
+                              (job_id, IN_FLIGHT, worker_id)).fetchone()
+        if row is None:
+            return False
+        attempts = row['attempts']
+        state = FAILED if attempts >= self.max_attempts else PENDING
+        available_at = now + self.retry_backoff * 2 ** (attempts - 1)
+        self.db.execute(
+            'UPDATE jobs SET state = ?, available_at = ?, lease_owner = NULL, lease_expires = NULL, last_error = ?, updated_at = ? '
+            'WHERE id = ? AND lease_owner = ?',
+            (state, available_at, error, now, job_id, worker_id)
+        )
+        return True
+
+    def retry_failed(self) -> int:
+        # Puts every failed job back with a fresh set of attempts
+        cursor = self.db.execute('UPDATE jobs SET state = ?, attempts = 0, available_at = 0, updated_at = ? WHERE state = ?',
+                                 (PENDING, time.time(), FAILED))
+        return cursor.rowcount
+
+    def counts(self, artist: str = None) -> dict:
+        query, params = 'SELECT state, COUNT(*) FROM jobs', ()
+        if artist:
+            query, params = query + ' WHERE artist = ?', (artist,)
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.db.execute(query + ' GROUP BY state', params).fetchall())
+        return counts
+
+    def artist_counts(self) -> dict:
+        counts = {}
+        for artist, state, n in self.db.execute('SELECT artist, state, COUNT(*) FROM jobs GROUP BY artist, state'):
+            counts.setdefault(artist, dict.fromkeys(STATES, 0))[state] = n
+        return counts
+
+    def failures(self, limit: int = 10) -> list:
+        rows = self.db.execute('SELECT artist, song, attempts, last_error FROM jobs WHERE state = ? ORDER BY updated_at DESC LIMIT ?',
+                               (FAILED, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        self.db.close()
+
+class _Heartbeat:
+    # Renews the leases of a claimed batch every third of their length while it is scraped and written.
+    # On its own connection, an sqlite3 connection stays on the thread that opened it
+    def __init__(self, queue: JobQueue, job_ids: list, worker_id: str):
+        self.queue, self.job_ids, self.worker_id = queue, job_ids, worker_id
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='lease-heartbeat', daemon=True)
+
+    def _run(self):
+        queue = JobQueue(self.queue.path, lease_seconds=self.queue.lease_seconds)
+        try:
+            while not self.stopped.wait(self.queue.lease_seconds / 3):
+                if not queue.renew(self.job_ids, self.worker_id):
+                    break
+        finally:
+            queue.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+class QueueWorker:
+    """ Drains a JobQueue: claims a batch of jobs, scrapes them on a FetchEngine, upserts the songs and
+        only then marks the jobs done, so a crash at any point leaves the job to be retried, never lost: a song the
+        database refused fails its job. Songs are checked for near-duplicates like an upload's, enqueue_artist
+        planned the rest. They are indexed by `main.py work` once every worker process has finished, the index
+        files take one writer at a time. Leases are renewed while the batch runs, however long it takes.
+        Several workers, in this process or others, can drain the same queue file."""
+
+    def __init__(self, queue: JobQueue, engine: FetchEngine, batch_size: int = None, worker_id: str = None):
+        self.queue = queue
+        self.engine = engine
+        self.batch_size = batch_size or engine.max_workers * 2
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self.lost = 0 # Jobs whose lease was gone when they finished, another worker may have done them again
+        self.logger = logging.getLogger(__name__)
+
+    def _scrape(self, job: dict):
+        return AZLyrics(artist=job['artist'], song=job['song'], fetcher=self.engine).open_url()
+
+    def run_batch(self) -> int:
+        """ Processes one claimed batch, returns how many jobs were claimed (0 means nothing was available)."""
+        jobs = self.queue.claim(self.worker_id, limit=self.batch_size)
+        if not jobs:
+            return 0
+        finished, failed, detectors = [], [], {}
+        with _Heartbeat(self.queue, [job['id'] for job in jobs], self.worker_id), \
+                BulkUpserter(upload_to_mongodb.songs_collection(), len(jobs)) as writer:
+            for job, future in self.engine.imap_unordered(self._scrape, jobs):
+                try:
+                    result = future.result()
+                    if result is None:
+                        raise RuntimeError('could not retrieve lyrics')
+                    song_doc = make_song_doc(job['artist'], job['song'], job['album'], job['release_year'], result)
+                    if job['artist'] not in detectors:
+                        detectors[job['artist']] = plan_duplicates(job['artist'], {})[0]
+                    if detectors[job['artist']] is not None:
+                        song_doc = detectors[job['artist']].check(song_doc, link=settings.DEDUP_LINK)
+                    writer.add(song_doc)
+                    finished.append(job)
+                except Exception as e:
+                    self.logger.error(f"Job {job['id']} ({job['artist']} - {job['song']}) failed: {e}")
+                    failed.append((job, str(e)))
+        # Songs are written by now, upserts make a repeat harmless if we crash before the next lines
+        refused = set(writer.refused)
+        failed += [(job, 'the database refused the song') for job in finished if (job['artist'], job['song']) in refused]
+        finished = [job for job in finished if (job['artist'], job['song']) not in refused]
+        lost = sum(not self.queue.complete(job['id'], self.worker_id) for job in finished)
+        lost += sum(not self.queue.fail(job['id'], self.worker_id, error) for job, error in failed)
+        if lost:
+            self.lost += lost
+            metrics.inc('jobs_lease_lost_total', lost)
+            self.logger.warning(f'Worker {self.worker_id} lost the lease on {lost} of {len(jobs)} jobs before finishing them')
+        return len(jobs)
+
+    def run(self, poll_interval: float = 5) -> int:
+        """ Works until nothing is pending or in flight anywhere, waiting on other workers' leases and retry backoffs."""
+        processed = 0
+        while True:
+            claimed = self.run_batch()
+            processed += claimed
+            if claimed:
+                continue
+            counts = self.queue.counts()
+            if not counts[PENDING] and not counts[IN_FLIGHT]:
+                break
+            time.sleep(poll_interval)
+        self.logger.info(f'Worker {self.worker_id} processed {processed} jobs')
+        return processed
+
+def enqueue_artist(queue: JobQueue, artist_name: str, albums: list, num_albums: int = None, album_title: str = None) -> int:
+    """ Adds the artist and albums to MongoDB and queues every song that isn't stored yet. Near-duplicates are
+        planned like an upload's: skipped songs are stored linked right away, versions are queued last."""
+    albums_to_add = upload_to_mongodb.select_albums(artist_name, albums, num_albums, album_title)
+    if albums_to_add is None:
+        return 0
+    songs_to_scrape = upload_to_mongodb.add_artist_and_albums(artist_name, albums_to_add, bulk=True)
+    _, linked, versions = plan_duplicates(artist_name, songs_to_scrape)
+    if linked:
+        with BulkUpserter(upload_to_mongodb.songs_collection()) as writer:
+            for song_doc in linked:
+                writer.add(song_doc)
+    # Ids are claimed in order, so originals are scraped before their versions and become the canonical songs
+    return sum(queue.enqueue_many((artist_name, album, song, release_year) for song, (album, release_year) in songs.items())
+               for songs in (songs_to_scrape, versions))
+
+def run_worker(queue_path: str = None, concurrency: int = None, rate: float = None, batch_size: int = None,
+               offline: bool = None) -> int:
+    # Entry point for each `main.py work` process, which builds its own MongoClient rather than inherit one across fork.
+    # offline is passed in because a spawned process starts from the default settings
+    registry.reset()
+    if offline is not None:
+        settings.HTTP_OFFLINE = offline
+    queue = JobQueue(queue_path)
+    try:
+        with FetchEngine(max_workers=concurrency, rate=rate) as engine:
+            return QueueWorker(queue, engine, batch_size=batch_size).run()
+    finally:
+        queue.close()
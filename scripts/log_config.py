@@ -0,0 +1,182 @@
+# scripts/log_config.py
+
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from multiprocessing import util as mp_util
+from config import settings
+import threading
+import logging
+import atexit
+import queue
+import json
+import os
+
+# Attributes every LogRecord has, anything else was passed through extra= and goes into the JSON record
+_RECORD_FIELDS = frozenset(logging.LogRecord('', 0, '', 0, '', None, None).__dict__) | {'message', 'asctime'}
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+def truncate(text: str, limit: int) -> str:
+    if limit and len(text) > limit:
+        return f'{text[:limit]}... [{len(text) - limit} more chars]'
+    return text
+
+class TruncatingFormatter(logging.Formatter):
+    """ The usual text lines, with messages longer than max_chars cut (a page or a whole lyric logged by mistake)."""
+
+    def __init__(self, fmt: str = TEXT_FORMAT, max_chars: int = None):
+        super().__init__(fmt)
+        self.max_chars = settings.LOG_MAX_MESSAGE_CHARS if max_chars is None else max_chars
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        record.message = truncate(record.message, self.max_chars)
+        return super().formatMessage(record)
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line: time, level, logger, message and whatever was passed through extra=.
+        Long messages and string extras are cut at max_chars."""
+
+    def __init__(self, max_chars: int = None):
+        super().__init__()
+        self.max_chars = settings.LOG_MAX_MESSAGE_CHARS if max_chars is None else max_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'thread': record.threadName, 'message': truncate(record.getMessage(), self.max_chars)}
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = truncate(value, self.max_chars) if isinstance(value, str) else value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class SamplingFilter(logging.Filter):
+    """ Keeps one in every `every` records below WARNING per message template, so a line logged once per song
+        shows up now and then instead of thousands of times. Warnings and errors always pass."""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self.seen = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.every <= 1 or record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        with self.lock:
+            count = self.seen[key] = self.seen.get(key, 0) + 1
+        return count % self.every == 1
+
+class LazyQueueHandler(QueueHandler):
+    """ Hands records to the listener thread as they are. The stock QueueHandler formats every message in the
+        logging thread before queueing it; here %-style arguments are only rendered by the listener, off the
+        hot path. A full queue drops records below WARNING (counted in dropped) rather than blocking a scraper,
+        warnings and errors wait up to timeout seconds for room."""
+
+    def __init__(self, log_queue: queue.Queue, timeout: float = None):
+        super().__init__(log_queue)
+        self.timeout = settings.LOG_QUEUE_TIMEOUT if timeout is None else timeout
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info and not record.exc_text: # Tracebacks are rendered now, the frames don't outlive the call
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record, timeout=self.timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class _Listener(QueueListener):
+    # The stock listener drops its stop sentinel into a full queue with put_nowait and fails, this waits for room
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+_listener = None
+_queue_handler = None
+_config = None # The arguments of the last setup_logging, for worker processes to set up the same logging
+
+def setup_logging(path: str = None, level: str = None, json_format: bool = None, use_queue: bool = None,
+                  max_bytes: int = None, backups: int = None, sample_every: int = None) -> logging.Handler:
+    """
+    Sends every log record to a size-rotated file, by default logs/scraping.log (.jsonl with json_format).
+    With use_queue, the caller only appends the record to a queue and a listener thread formats and writes it.
+    Everything defaults to the LOG_* settings. :return: The handler installed on the root logger.
+    """
+    global _listener, _queue_handler, _config
+    json_format = settings.LOG_JSON if json_format is None else json_format
+    use_queue = settings.LOG_ASYNC if use_queue is None else use_queue
+    path = path or os.path.join(settings.LOG_DIR, 'scraping.jsonl' if json_format else 'scraping.log')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    _config = {'path': path, 'level': level, 'json_format': json_format, 'use_queue': use_queue,
+               'max_bytes': max_bytes, 'backups': backups, 'sample_every': sample_every}
+
+    handler = RotatingFileHandler(path, maxBytes=settings.LOG_MAX_BYTES if max_bytes is None else max_bytes,
+                                  backupCount=settings.LOG_BACKUP_COUNT if backups is None else backups, encoding='utf-8')
+    handler.setFormatter(JsonFormatter() if json_format else TruncatingFormatter())
+
+    stop_logging()
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    if use_queue:
+        _listener = _Listener(queue.Queue(settings.LOG_QUEUE_SIZE), handler, respect_handler_level=True)
+        _listener.start()
+        handler = _queue_handler = LazyQueueHandler(_listener.queue)
+    # Sampled out records never reach the queue
+    sample_every = settings.LOG_SAMPLE_EVERY if sample_every is None else sample_every
+    if sample_every > 1:
+        handler.addFilter(SamplingFilter(sample_every))
+    root.addHandler(handler)
+    root.setLevel(level or settings.LOG_LEVEL)
+    return handler
+
+def logging_config() -> dict:
+    # What setup_logging was last called with, None if it wasn't. Picklable, for init_worker_logging
+    return dict(_config) if _config else None
+
+def init_worker_logging(config: dict):
+    """ ProcessPoolExecutor initializer: sets up the parent's logging in a worker. A spawned worker starts
+        without any, a forked one was already restarted by _restart_after_fork."""
+    if config and config != _config:
+        setup_logging(**config)
+        _stop_with_process()
+
+def _stop_with_process(*_):
+    # multiprocessing children leave with os._exit and skip atexit, their finalizers still run
+    mp_util.Finalize(None, stop_logging, exitpriority=0)
+
+def _restart_after_fork():
+    # The listener thread doesn't survive fork: the child's records would fill a queue nobody reads, then block.
+    # The child gets its own queue and listener, the parent's are left alone
+    global _listener, _queue_handler
+    if _listener is not None:
+        _listener = _queue_handler = None
+        setup_logging(**_config)
+
+class _ForkHook:
+    pass
+
+_fork_hook = _ForkHook()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+    # Registered once a multiprocessing child has reset its finalizers, which drops any added by the hook above
+    mp_util.register_after_fork(_fork_hook, _stop_with_process)
+
+@atexit.register
+def stop_logging():
+    # Drains the queue into the file and stops the listener thread, also run at exit
+    global _listener, _queue_handler
+    if _listener is not None:
+        if _queue_handler is not None and _queue_handler.dropped:
+            logging.getLogger(__name__).warning(f'{_queue_handler.dropped} log records were dropped, the log queue was full')
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = _queue_handler = None
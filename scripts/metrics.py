@@ -0,0 +1,234 @@
+# scripts/metrics.py
+
+from contextlib import nullcontext
+from config import settings
+import threading
+import logging
+import bisect
+import json
+import time
+import os
+
+# Upper bounds in seconds, wide enough for a parse (ms) and a rate limited fetch (s)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# What a disabled registry hands out instead of a timer, reusable and free to enter
+_NO_TIMER = nullcontext()
+
+logger = logging.getLogger(__name__)
+
+class Histogram:
+    """ Counts of observations per bucket (cumulative only when exported), with their sum."""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list:
+        total, counts = 0, []
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+class _Timer:
+
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry: "MetricsRegistry", name: str, labels: dict):
+        self.registry, self.name, self.labels = registry, name, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+class MetricsRegistry:
+    """ Process-wide counters and histograms, keyed on a name and labels:
+            metrics.inc('http_responses_total', status='2xx')
+            with metrics.timer('parse_seconds', page='lyrics'): ...
+        Every call returns right away while the registry is disabled (the default, settings.METRICS_ENABLED),
+        so instrumented code costs an attribute check when nobody is looking."""
+
+    def __init__(self, enabled: bool = None, buckets: tuple = DEFAULT_BUCKETS):
+        self.enabled = settings.METRICS_ENABLED if enabled is None else enabled
+        self.buckets = buckets
+        self.counters = {}   # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> Histogram
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        with self.lock:
+            self.counters, self.histograms = {}, {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def timer(self, name: str, **labels):
+        """ Context manager observing the seconds its block took into the name histogram."""
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, name, labels)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': h.count, 'sum': h.sum,
+                           'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], h.cumulative()))}
+                          for (name, labels), h in sorted(self.histograms.items())]
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """ The Prometheus text exposition format."""
+        lines, typed = [], set()
+        for metric in self.to_dict()['counters']:
+            if metric['name'] not in typed:
+                typed.add(metric['name'])
+                lines.append(f"# TYPE {metric['name']} counter")
+            lines.append(f"{metric['name']}{_labels(metric['labels'])} {metric['value']}")
+        for metric in self.to_dict()['histograms']:
+            name, labels = metric['name'], metric['labels']
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            for bound, count in metric['buckets'].items():
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {metric['sum']}")
+            lines.append(f"{name}_count{_labels(labels)} {metric['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def report(self) -> str:
+        """ Plain-text summary for the end of a run: time spent per timer and every counter."""
+        data = self.to_dict()
+        lines = [f'{"timer":<48}{"count":>8}{"total s":>10}{"mean ms":>10}']
+        for metric in sorted(data['histograms'], key=lambda metric: -metric['sum']):
+            name = metric['name'] + _labels(metric['labels'])
+            lines.append(f"{name:<48}{metric['count']:>8}{metric['sum']:>10.2f}{metric['sum'] / metric['count'] * 1000:>10.1f}")
+        lines.append(f'{"counter":<48}{"value":>8}')
+        for metric in data['counters']:
+            lines.append(f"{metric['name'] + _labels(metric['labels']):<48}{metric['value']:>8g}")
+        return '\n'.join(lines)
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+def status_class(status: int) -> str:
+    # 200 -> '2xx', keeps the label set small
+    return f'{status // 100}xx'
+
+metrics = MetricsRegistry()
+
+class MetricsServer:
+    """ Serves the registry on 127.0.0.1:port while a run is going: /metrics as Prometheus text, /metrics.json as JSON."""
+
+    def __init__(self, registry: MetricsRegistry = None, port: int = None, host: str = '127.0.0.1'):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        registry = registry or metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = registry.to_prometheus(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = registry.to_json(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args): # Scrapes of the endpoint don't belong in the run's log
+                pass
+
+        self.server = ThreadingHTTPServer((host, settings.METRICS_PORT if port is None else port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/metrics'
+
+    def start(self):
+        self.thread.start()
+        logger.info(f'Serving metrics on {self.url}')
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class Profiler:
+    """ Profiles a main.py subcommand with cProfile, or pyinstrument when kind is 'pyinstrument' and it is installed.
+        stop() writes the profile next to the logs and returns a short report."""
+
+    def __init__(self, kind: str = 'cprofile'):
+        self.kind = kind
+        if kind == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler as Instrument
+            except ImportError:
+                raise ImportError('--profile pyinstrument needs pyinstrument, pip install pyinstrument') from None
+            self.profiler = Instrument()
+        else:
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+    def start(self):
+        if self.kind == 'pyinstrument':
+            self.profiler.start()
+        else:
+            self.profiler.enable()
+        return self
+
+    def stop(self, name: str, directory: str = 'logs', top: int = 25) -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'profile_{name}_{time.strftime("%Y%m%d_%H%M%S")}')
+        if self.kind == 'pyinstrument':
+            self.profiler.stop()
+            with open(path + '.html', 'w', encoding='utf-8') as f:
+                f.write(self.profiler.output_html())
+            return self.profiler.output_text()
+        import io
+        import pstats
+        self.profiler.disable()
+        self.profiler.dump_stats(path + '.prof')
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(top)
+        return f'Profile written to {path}.prof\n' + out.getvalue()
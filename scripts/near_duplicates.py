@@ -0,0 +1,229 @@
+# scripts/near_duplicates.py
+
+from pymongo import UpdateOne
+from config import settings
+from scripts.upload_to_mongodb import songs_collection
+from scripts.generate_embeddings import TOKEN_PATTERN, _batches
+from scripts.compact_storage import song_lyrics
+from bson import Binary
+import numpy as np
+import argparse
+import logging
+import zlib
+import re
+
+# Bracketed or dashed title suffixes AZLyrics uses for another recording of the same song
+VERSION_PATTERN = re.compile(
+    r"\s*(?:[(\[][^)\]]*\b(?:live|acoustic|remix|mix|demo|version|edit|remaster(?:ed)?|deluxe|unplugged|"
+    r"instrumental|session|stripped)\b[^)\]]*[)\]]|-\s+[^-]*\b(?:live|acoustic|remix|mix|demo|version|edit|"
+    r"remaster(?:ed)?|unplugged|stripped)\b.*)\s*$", re.IGNORECASE)
+
+# Odd 64-bit multiplier combining the word hashes of a shingle, every product wraps around in uint64
+_SHINGLE_PRIME = np.uint64(0x9E3779B97F4A7C15)
+_SHIFT = np.uint64(32)
+
+logger = logging.getLogger(__name__)
+
+def base_title(title: str) -> str:
+    """ The title without its live/acoustic/remix/... suffix, lowercased: 'Weightless (Live at Reading)' -> 'weightless'."""
+    previous = None
+    while previous != title: # 'Song (Live) [Remastered]'
+        previous, title = title, VERSION_PATTERN.sub('', title)
+    return title.strip().lower()
+
+def is_version(title: str) -> bool:
+    return base_title(title) != title.strip().lower()
+
+class MinHasher:
+    """ MinHash signatures of lyrics: word shingles hashed to 64 bits, then num_perm multiply-shift
+        hash functions, each keeping its minimum. The share of equal positions in two signatures
+        estimates the Jaccard similarity of the two shingle sets."""
+
+    def __init__(self, num_perm: int = None, shingle_size: int = None, seed: int = 1):
+        self.num_perm = num_perm or settings.DEDUP_NUM_PERM
+        self.shingle_size = shingle_size or settings.DEDUP_SHINGLE_SIZE
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2**63, self.num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2**63, self.num_perm, dtype=np.uint64)
+        self._token_hashes = {}
+
+    def shingles(self, text: str) -> np.ndarray:
+        cache = self._token_hashes
+        hashes = []
+        for token in TOKEN_PATTERN.findall((text or '').lower()):
+            h = cache.get(token)
+            if h is None:
+                h = cache[token] = zlib.crc32(token.encode('utf-8'))
+            hashes.append(h)
+        tokens = np.asarray(hashes, dtype=np.uint64)
+        k = min(self.shingle_size, len(tokens))
+        if not k:
+            return tokens
+        shingles = tokens[:len(tokens) - k + 1].copy()
+        for i in range(1, k):
+            shingles = shingles * _SHINGLE_PRIME + tokens[i:len(tokens) - k + 1 + i]
+        return np.unique(shingles)
+
+    def signature(self, text: str):
+        """ uint32 array of num_perm minimums, None for lyrics without a word."""
+        shingles = self.shingles(text)
+        if not len(shingles):
+            return None
+        return ((np.outer(self._a, shingles) + self._b[:, None]) >> _SHIFT).min(axis=1).astype(np.uint32)
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    # Estimated Jaccard similarity of the shingle sets behind two signatures
+    return float(np.count_nonzero(a == b)) / len(a)
+
+class DuplicateDetector:
+    """ Finds near-duplicate lyrics among one artist's songs. Signatures are split into bands of rows and
+        every band is a key in an in-memory LSH table, so a song is only compared with songs sharing at least
+        one band (likely above the threshold) instead of every song: the work grows linearly with the songs.
+        Only canonical songs, those not a duplicate themselves, are added to the table."""
+
+    def __init__(self, hasher: MinHasher = None, bands: int = None, threshold: float = None):
+        self.hasher = hasher or MinHasher()
+        self.bands = bands or settings.DEDUP_BANDS
+        self.threshold = threshold if threshold is not None else settings.DEDUP_THRESHOLD
+        self.rows = self.hasher.num_perm // self.bands
+        self.buckets = {}    # (band, band hash) -> [row of signatures]
+        self.signatures = np.empty((64, self.hasher.num_perm), dtype=np.uint32)
+        self.canonical = []  # Title of each row of signatures
+        self.titles = {}     # base_title -> title, of every canonical song
+        self._band_weights = np.random.default_rng(0).integers(1, 2**63, self.rows, dtype=np.uint64)
+        self.logger = logging.getLogger(__name__)
+
+    def _keys(self, signature: np.ndarray) -> list:
+        # One 64-bit hash per band, a rare collision only adds a candidate that fails the similarity check
+        hashes = (signature.reshape(self.bands, self.rows).astype(np.uint64) * self._band_weights).sum(axis=1)
+        return list(enumerate(hashes.tolist()))
+
+    def add(self, title: str, signature):
+        self.titles.setdefault(base_title(title), title)
+        if signature is None:
+            return
+        row = len(self.canonical)
+        if row == len(self.signatures):
+            self.signatures = np.concatenate([self.signatures, np.empty_like(self.signatures)])
+        self.signatures[row] = signature
+        self.canonical.append(title)
+        for key in self._keys(signature):
+            self.buckets.setdefault(key, []).append(row)
+
+    def match(self, signature) -> tuple:
+        """ (canonical title, estimated similarity) of the most similar song above the threshold, or None."""
+        if signature is None:
+            return None
+        candidates = list({row for key in self._keys(signature) for row in self.buckets.get(key, ())})
+        if not candidates:
+            return None
+        scores = np.count_nonzero(self.signatures[candidates] == signature, axis=1) / len(signature)
+        best = int(scores.argmax())
+        if scores[best] < self.threshold:
+            return None
+        return self.canonical[candidates[best]], float(scores[best])
+
+    def check(self, song_doc: dict, link: bool = False) -> dict:
+        """ Adds the MinHash signature to a freshly scraped song document and, when it nearly duplicates a canonical
+            song, duplicate_of (that song's title) and duplicate_similarity. With link, a duplicate's lyrics are
+            left out, the canonical song holds them. Otherwise the song becomes a canonical song itself."""
+        signature = self.hasher.signature(song_lyrics(song_doc))
+        if signature is not None:
+            song_doc['minhash'] = Binary(signature.tobytes())
+        match = self.match(signature)
+        if match is None:
+            self.add(song_doc['title'], signature)
+            return song_doc
+        canonical, score = match
+        self.logger.info(f"'{song_doc['title']}' by {song_doc['artist']} duplicates '{canonical}' ({score:.2f})")
+        song_doc.update(duplicate_of=canonical, duplicate_similarity=round(score, 3))
+        if link:
+            song_doc.pop('lyrics', None)
+        return song_doc
+
+    def likely_duplicates(self, titles) -> dict:
+        """ {title: canonical title} for the titles that are another version of a stored song, or of a title
+            without a version suffix among titles, judged from the titles alone."""
+        planned = {base_title(title): title for title in titles if not is_version(title)}
+        duplicates = {}
+        for title in filter(is_version, titles):
+            base = base_title(title)
+            canonical = self.titles.get(base) or planned.get(base)
+            if canonical is not None and canonical != title:
+                duplicates[title] = canonical
+        return duplicates
+
+    def _signature(self, stored) -> np.ndarray:
+        signature = np.frombuffer(stored, dtype=np.uint32) if stored else None
+        return signature if signature is not None and len(signature) == self.hasher.num_perm else None
+
+    @classmethod
+    def load(cls, artist_name: str, collection=None, batch_size: int = 1000, **kwargs) -> "DuplicateDetector":
+        """ A detector holding the artist's stored canonical songs. Songs stored without a signature
+            (or with one of another length) get one computed from their lyrics and saved."""
+        collection = collection if collection is not None else songs_collection()
+        detector = cls(**kwargs)
+        missing = []
+        for song in collection.find({'artist': artist_name, 'duplicate_of': {'$exists': False}}, {'title': 1, 'minhash': 1}):
+            signature = detector._signature(song.get('minhash'))
+            if signature is None:
+                missing.append(song['_id'])
+            else:
+                detector.add(song['title'], signature)
+        for chunk in _batches(missing, batch_size):
+            ops = []
+            for song in collection.find({'_id': {'$in': chunk}}, {'title': 1, 'lyrics': 1}):
+                signature = detector.hasher.signature(song_lyrics(song))
+                detector.add(song['title'], signature)
+                if signature is not None:
+                    ops.append(UpdateOne({'_id': song['_id']}, {'$set': {'minhash': Binary(signature.tobytes())}}))
+            if ops:
+                collection.bulk_write(ops, ordered=False)
+        return detector
+
+def linked_song_doc(artist_name: str, song: str, album_title: str, release_year: str, canonical: str) -> dict:
+    # A version that wasn't scraped, kept so the album lists it and later runs don't fetch it
+    return {'title': song, 'artist': artist_name, 'album': album_title, 'release_year': release_year,
+            'duplicate_of': canonical, 'duplicate_similarity': None}
+
+def find_duplicates(collection=None, artist_name: str = None, link: bool = False) -> int:
+    """
+    Flags the near-duplicates among songs already stored, artist by artist. Songs whose title has no version
+    suffix are taken as canonical first. With link, the lyrics of every duplicate are removed.
+    :return: Number of songs newly flagged.
+    """
+    collection = collection if collection is not None else songs_collection()
+    artists = [artist_name] if artist_name else collection.distinct('artist')
+    flagged = 0
+    for artist in artists:
+        detector = DuplicateDetector()
+        songs = list(collection.find({'artist': artist}, {'title': 1, 'lyrics': 1, 'duplicate_of': 1, 'minhash': 1}))
+        songs.sort(key=lambda song: (is_version(song['title']), str(song['_id'])))
+        ops = []
+        for song in songs:
+            if 'duplicate_of' in song:
+                if link and 'lyrics' in song:
+                    ops.append(UpdateOne({'_id': song['_id']}, {'$unset': {'lyrics': ''}}))
+                continue
+            doc = detector.check({'title': song['title'], 'artist': artist, 'lyrics': song.get('lyrics')}, link=link)
+            update = {'$set': {key: doc[key] for key in ('minhash', 'duplicate_of', 'duplicate_similarity') if key in doc}}
+            if update['$set'].get('minhash') == song.get('minhash'):
+                update['$set'].pop('minhash', None)
+            if 'duplicate_of' in doc:
+                flagged += 1
+                if link:
+                    update['$unset'] = {'lyrics': ''}
+            if update['$set'] or '$unset' in update:
+                ops.append(UpdateOne({'_id': song['_id']}, update))
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+    logger.info(f'{flagged} near-duplicate songs flagged')
+    return flagged
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Flag near-duplicate lyrics among the stored songs")
+    parser.add_argument('--artist', type=str, help="Only check this artist's songs")
+    parser.add_argument('--link', action='store_true', help="Remove the lyrics of duplicates, the canonical song keeps them")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(f"{find_duplicates(artist_name=args.artist, link=args.link)} near-duplicate songs flagged.")
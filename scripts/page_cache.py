@@ -0,0 +1,229 @@
+# scripts/page_cache.py
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from config import settings
+import threading
+import hashlib
+import logging
+import sqlite3
+import gzip
+import time
+import os
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    encoding TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at);
+CREATE INDEX IF NOT EXISTS pages_digest ON pages (digest);
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    bytes INTEGER NOT NULL
+);
+-- Caches from before the running total start from their stored bodies, each digest counted once
+INSERT OR IGNORE INTO totals (id, bytes) SELECT 0, COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM pages);
+"""
+
+class PageCache:
+    """ Persistent cache of raw pages keyed by the URL AZLyrics.url()/AZArtists.url() produce.
+        Bodies are gzip compressed and stored once per sha256 of their content under objects/,
+        while index.sqlite maps each URL to its body, validators and fetch/access timestamps.
+        Once the stored bodies outgrow max_bytes the least recently used URLs are evicted. Their total size is kept
+        in the index, updated as bodies are added and dropped, so a put never adds up the whole cache.
+        Every write runs in a BEGIN IMMEDIATE transaction, so processes sharing the directory are serialized by sqlite.
+
+        Entries are dicts with url, content (bytes), encoding, etag, last_modified and fetched_at."""
+
+    def __init__(self, directory: str = None, max_bytes: int = None):
+        self.directory = directory or settings.PAGE_CACHE_DIR
+        self.max_bytes = max_bytes or settings.PAGE_CACHE_MAX_BYTES
+        os.makedirs(os.path.join(self.directory, 'objects'), exist_ok=True)
+        # Autocommit mode, transactions are opened explicitly by _transaction()
+        self.db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), timeout=30, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock() # The connection is shared between threads
+        self.logger = logging.getLogger(__name__)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, 'objects', digest[:2], f'{digest}.gz')
+
+    @contextmanager
+    def _transaction(self):
+        # Takes the database write lock up front, so no other process can evict or insert until the commit
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def get(self, url: str) -> dict:
+        with self.lock:
+            row = self.db.execute(
+                'SELECT digest, encoding, etag, last_modified, fetched_at FROM pages WHERE url = ?', (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            digest, encoding, etag, last_modified, fetched_at = row
+            try:
+                with gzip.open(self._path(digest), 'rb') as f:
+                    content = f.read()
+            except (OSError, EOFError):
+                self.logger.warning(f'Cached body missing or corrupt for {url}, dropping it')
+                with self._transaction():
+                    # Unless another process stored the page again in the meantime
+                    if self.db.execute('SELECT 1 FROM pages WHERE url = ? AND digest = ?', (url, digest)).fetchone():
+                        self._delete(url)
+                return None
+            self.db.execute('UPDATE pages SET accessed_at = ? WHERE url = ?', (time.time(), url))
+        return {'url': url, 'content': content, 'encoding': encoding, 'etag': etag,
+                'last_modified': last_modified, 'fetched_at': fetched_at}
+
+    def fetched_at(self, url: str) -> float:
+        # When the page was stored or last revalidated, None if it isn't cached. Reads no body and writes nothing
+        with self.lock:
+            row = self.db.execute('SELECT fetched_at FROM pages WHERE url = ?', (url,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, url: str, content: bytes, encoding: str = None, etag: str = None, last_modified: str = None):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._path(digest)
+        body = gzip.compress(content) # Compressed outside the lock, only the file and index updates are serialized
+        now = time.time()
+        with self.lock, self._transaction():
+            # Checked, written and indexed in one transaction, so no eviction, from any process, can delete the body
+            # in between. Evictions remove bodies inside their own transaction, before another put can check for it
+            if not os.path.exists(path):
+                # Write to a temporary file first so a crash never leaves a truncated body behind
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(body)
+                os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+            stored = self.db.execute('SELECT 1 FROM pages WHERE digest = ? LIMIT 1', (digest,)).fetchone()
+            self._delete(url, keep=digest)
+            self.db.execute(
+                'INSERT INTO pages (url, digest, size, encoding, etag, last_modified, fetched_at, accessed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (url, digest, size, encoding, etag, last_modified, now, now)
+            )
+            if not stored:
+                self.db.execute('UPDATE totals SET bytes = bytes + ? WHERE id = 0', (size,))
+            self._evict(keep=url)
+
+    # Marks a cached page as fresh again, used after a 304
+    def touch(self, url: str):
+        with self.lock:
+            now = time.time()
+            self.db.execute('UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE url = ?', (now, now, url))
+
+    def delete(self, url: str):
+        with self.lock, self._transaction():
+            self._delete(url)
+
+    def urls(self, prefix: str = '') -> list:
+        with self.lock:
+            rows = self.db.execute('SELECT url FROM pages WHERE url LIKE ? ORDER BY url', (prefix + '%',)).fetchall()
+        return [row[0] for row in rows]
+
+    def size(self) -> int:
+        with self.lock:
+            return self._size()
+
+    # Removes pages fetched more than max_age seconds ago
+    def prune(self, max_age: float):
+        with self.lock, self._transaction():
+            cutoff = time.time() - max_age
+            rows = self.db.execute('SELECT url FROM pages WHERE fetched_at < ?', (cutoff,)).fetchall()
+            for url, in rows:
+                self._delete(url)
+        self.logger.info(f'Pruned {len(rows)} cached pages older than {max_age}s')
+
+    def _size(self) -> int:
+        # Identical bodies are stored once, so each digest is only counted once
+        return self.db.execute('SELECT bytes FROM totals WHERE id = 0').fetchone()[0]
+
+    def _evict(self, keep: str = None):
+        # The page that was just stored is never evicted, even when it alone is over budget
+        while self._size() > self.max_bytes:
+            rows = self.db.execute('SELECT url FROM pages WHERE url != ? ORDER BY accessed_at LIMIT 100', (keep,)).fetchall()
+            if not rows:
+                break
+            for url, in rows:
+                self._delete(url)
+                if self._size() <= self.max_bytes:
+                    break
+
+    def _delete(self, url: str, keep: str = None):
+        # Called inside a transaction. Removes a URL and its body when no other URL shares it, keep is a digest that is about to be reused
+        row = self.db.execute('SELECT digest, size FROM pages WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return
+        self.db.execute('DELETE FROM pages WHERE url = ?', (url,))
+        if row[0] != keep:
+            self._drop_orphan(*row)
+
+    def _drop_orphan(self, digest: str, size: int) -> bool:
+        # Deletes a body once no URL points at it anymore
+        if self.db.execute('SELECT 1 FROM pages WHERE digest = ? LIMIT 1', (digest,)).fetchone():
+            return False
+        self.db.execute('UPDATE totals SET bytes = bytes - ? WHERE id = 0', (size,))
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def close(self):
+        self.db.close()
+
+class MemoryPageCache:
+    """ Same interface as PageCache but kept in memory for a single run, bounded to max_entries pages."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, url: str) -> dict:
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+            return entry
+
+    def put(self, url: str, content: bytes, encoding: str = None, etag: str = None, last_modified: str = None):
+        with self.lock:
+            self.entries[url] = {'url': url, 'content': content, 'encoding': encoding, 'etag': etag,
+                                 'last_modified': last_modified, 'fetched_at': time.time()}
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def fetched_at(self, url: str) -> float:
+        entry = self.entries.get(url)
+        return entry['fetched_at'] if entry else None
+
+    def touch(self, url: str):
+        with self.lock:
+            if url in self.entries:
+                self.entries[url]['fetched_at'] = time.time()
+
+    def delete(self, url: str):
+        with self.lock:
+            self.entries.pop(url, None)
+
+    def urls(self, prefix: str = '') -> list:
+        with self.lock:
+            return sorted(url for url in self.entries if url.startswith(prefix))
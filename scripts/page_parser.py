@@ -0,0 +1,122 @@
+# scripts/page_parser.py
+
+from bs4 import BeautifulSoup, Tag
+import logging
+
+LYRICS_CONTAINER_CLASS = 'col-xs-12 col-lg-8 text-center'
+GENRE_MARKER = 'window.rtkGPTSlotsTargeting'
+GENRE_PREFIX = '["genre", "'
+
+class LyricsPageParser:
+    """ Extracts lyrics, genre, album and writers from an AZLyrics song page in a single parse.
+        Backends:
+            'html.parser' - BeautifulSoup with the stdlib parser (default, no extra dependencies)
+            'lxml'        - BeautifulSoup on top of lxml (pip install lxml)
+            'selectolax'  - lexbor based fast path that skips BeautifulSoup entirely (pip install selectolax),
+                            lyrics can differ from the other backends in leading/trailing whitespace"""
+
+    BACKENDS = ('html.parser', 'lxml', 'selectolax')
+
+    def __init__(self, backend: str = 'html.parser'):
+        if backend not in self.BACKENDS:
+            raise ValueError(f'Unknown parser backend {backend!r}, expected one of {self.BACKENDS}')
+        self.backend = backend
+        self.logger = logging.getLogger(__name__)
+        if backend == 'selectolax':
+            from selectolax.lexbor import LexborHTMLParser # Optional dependency, only imported when requested
+            self._selectolax = LexborHTMLParser
+
+    # Returns (lyrics, genre, album, writers) in the same shape AZLyrics.open_url always has
+    def parse(self, html: str) -> tuple:
+        if self.backend == 'selectolax':
+            return self._parse_selectolax(html)
+        return self._parse_soup(html)
+
+    # BeautifulSoup path, the DOM is built once and shared by every field
+    def _parse_soup(self, html: str) -> tuple:
+        dom = BeautifulSoup(html, self.backend)
+        return (self._soup_lyrics(dom), self._soup_genre(dom),
+                self._soup_album(dom), self._soup_writers(dom))
+
+    def _soup_lyrics(self, dom: BeautifulSoup) -> str:
+        container = dom.body.find_all('div', {'class': LYRICS_CONTAINER_CLASS})[0]
+
+        # The lyrics are the child with the most <br> tags, strings and comments are skipped
+        children = list(container.children)
+        target, most_br = 0, 0
+        for i, child in enumerate(children):
+            if isinstance(child, Tag):
+                n_br = len(child.find_all('br'))
+                if n_br > most_br:
+                    target, most_br = i, n_br
+        return children[target].text
+
+    def _soup_genre(self, dom: BeautifulSoup) -> str:
+        head = dom.head
+        script_tag = head.find('script', string=lambda t: t and GENRE_MARKER in t) if head else None
+        if script_tag:
+            return self._genre_from_script(script_tag.string)
+        self.logger.warning('Genre not found')
+        return "Genre not found"
+
+    def _soup_album(self, dom: BeautifulSoup) -> str:
+        album_div = dom.find('div', class_='songinalbum_title')
+        if album_div:
+            return album_div.get_text(strip=True).replace('album:', '').strip()
+        self.logger.warning('Album not found')
+        return "Album not found"
+
+    def _soup_writers(self, dom: BeautifulSoup) -> str:
+        for div in dom.find_all('div', class_='smt'):
+            small_tag = div.find('small')
+            if small_tag and 'Writer(s):' in small_tag.get_text(strip=True):
+                return small_tag.get_text(strip=True).replace('Writer(s):', '').strip()
+        self.logger.warning('Writers not found')
+        return "Writers not found"
+
+    # selectolax path, mirrors the BeautifulSoup rules above on lexbor nodes
+    def _parse_selectolax(self, html: str) -> tuple:
+        tree = self._selectolax(html)
+
+        container = tree.css_first('div.col-xs-12.col-lg-8.text-center')
+        if container is None:
+            raise IndexError('Lyrics container not found')
+        target, most_br = None, 0
+        for child in container.iter():
+            n_br = len(child.css('br'))
+            if n_br > most_br:
+                target, most_br = child, n_br
+        lyrics = target.text(deep=True) if target is not None else container.text(deep=True)
+
+        genre = "Genre not found"
+        for script in tree.css('head script'):
+            content = script.text(deep=True)
+            if GENRE_MARKER in content:
+                genre = self._genre_from_script(content)
+                break
+        else:
+            self.logger.warning('Genre not found')
+
+        album_div = tree.css_first('div.songinalbum_title')
+        if album_div is not None:
+            album = album_div.text(deep=True, separator='', strip=True).replace('album:', '').strip()
+        else:
+            self.logger.warning('Album not found')
+            album = "Album not found"
+
+        writers = "Writers not found"
+        for small_tag in tree.css('div.smt small'):
+            text = small_tag.text(deep=True, separator='', strip=True)
+            if 'Writer(s):' in text:
+                writers = text.replace('Writer(s):', '').strip()
+                break
+        else:
+            self.logger.warning('Writers not found')
+
+        return lyrics, genre, album, writers
+
+    @staticmethod
+    def _genre_from_script(script_content: str) -> str:
+        start_index = script_content.find(GENRE_PREFIX) + len(GENRE_PREFIX)
+        end_index = script_content.find('"]', start_index)
+        return script_content[start_index:end_index]
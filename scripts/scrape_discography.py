@@ -7,31 +7,48 @@ import logging
 import os
 import re
 import json
+from config import settings
+from scripts.http_transport import get_transport
+from scripts.metrics import metrics
+from scripts.services import registry
+from scripts.slug_index import guess_artist_slug, letter_of
 
 class AZArtists:
 
-    def __init__(self, artist: str):
+    def __init__(self, artist: str, fetcher=None, slugs=None):
         self.artist = artist
+        self.fetcher = fetcher or get_transport() # Anything with requests.get's signature, e.g. a FetchEngine
+        self.slugs = slugs or registry.get('slug_index') # Known artist slugs and song hrefs, see scripts/slug_index.py
         self.logger = logging.getLogger(__name__)
     
     # Artist formatting
     def _parse_artist(self) -> str: # _ denotes for coder to treat as private method. -> str, annotates return as a string
-        self.logger.info(f'Parsing artist {self.artist}')
-        return re.sub(r'[^a-z0-9\s]', '', self.artist.lower().replace(' ', ''))
+        self.logger.debug('Parsing artist %s', self.artist)
+        return guess_artist_slug(self.artist)
     
     # Dynamic URL method for artist discographies
     def url(self) -> str:
-        artist = self._parse_artist().replace('the','')
-        url = 'https://www.azlyrics.com/{}/{}.html'\
-                .format(artist[0], artist) # \ used to allow newline usage for readability
-        self.logger.info(f'Generated URL: {url}')
+        artist = self.slugs.artist_slug(self.artist) or self._parse_artist()
+        url = '{}/{}/{}.html'\
+                .format(settings.AZLYRICS_BASE_URL, letter_of(artist), artist) # \ used to allow newline usage for readability
+        self.logger.debug('Generated URL: %s', url)
         return url
     
-    # Method to make HTTP request to AZLyrics and return discography
+    # Method to make HTTP request to AZLyrics and save the discography to data/artists
     def open_url(self):
+        albums = self.fetch_albums()
+        if albums is not None:
+            self._save_to_file(albums)
+            self.logger.info(f'Successfully saved discography for {self.artist}')
+            print(f'Successfully saved discography for {self.artist}')
+        return albums
+
+    # Method to make HTTP request to AZLyrics and return the discography without saving it
+    def fetch_albums(self) -> list:
+        slug = self.slugs.resolve(self.artist, self.fetcher) # Reads the artist's letter index page the first time it is unknown
         url = self.url()
         try:
-            response = requests.get(url)
+            response = self.fetcher.get(url)
             response.raise_for_status() # Raises error for bad responses
             self.logger.info(f'Successfully opened URL: {url}')
         except requests.exceptions.HTTPError as http_err:
@@ -48,16 +65,20 @@ class AZArtists:
             return None
     
         if response.ok:
-            self._parse_albums(response)
-            self.logger.info(f'Successfully saved discography for {self.artist}')
-            print(f'Successfully saved discography for {self.artist}')
-        else:
-            self.logger.warning(f'Failed to retrive data for artist: {self.artist}')
-            print(f'Failed to retrive data for artist: {self.artist}')
-        
+            with metrics.timer('parse_seconds', page='discography'):
+                albums, hrefs = self._parse_albums(response)
+            metrics.inc('pages_scraped_total', page='discography')
+            # The page exists, so the slug is right, and its links are the lyrics URLs to request
+            self.slugs.add_artist(self.artist, slug)
+            self.slugs.add_songs(slug, hrefs)
+            return albums
+        self.logger.warning(f'Failed to retrive data for artist: {self.artist}')
+        print(f'Failed to retrive data for artist: {self.artist}')
+        return None
+
     def _save_to_file(self, data: list):
         # Set up the directory and file path
-        base_dir = r"C:\Users\wesma\OneDrive\Documents\Lyrical_Analysis\data\artists"
+        base_dir = settings.ARTISTS_DIR
         os.makedirs(base_dir, exist_ok=True)
         file_path = os.path.join(base_dir, f'{self.artist}.json')
 
@@ -66,10 +87,12 @@ class AZArtists:
             json.dump(data, f, ensure_ascii=False, indent=4)  # Pretty print with indent
             self.logger.info(f"Successfully wrote data to {file_path}")
     
-    def _parse_albums(self, r: Response) -> list:
+    # Returns the albums and a (title, href) pair for every song link
+    def _parse_albums(self, r: Response) -> tuple:
         dom = BeautifulSoup(r.text, 'html.parser')
         current_album = None
         albums = []
+        hrefs = []
 
         album_divs = dom.find_all('div', {'class': 'album'})
 
@@ -107,11 +130,12 @@ class AZArtists:
                     if song_link and song_link.get('href'):
                         song_title = song_link.get_text(strip=True)
                         current_album["songs"].append(song_title)
-                        self.logger.info(f'Found song: {song_title} under album {current_album["title"]}')
+                        hrefs.append((song_title, song_link['href']))
+                        self.logger.debug('Found song: %s under album %s', song_title, current_album['title'])
                     else:
                         self.logger.warning(f'Song link missing for a song in {current_album["title"]}')
                     next_div = next_div.find_next_sibling()
         
         self.logger.info(f'Parsed albums: {[album["title"] for album in albums]}')
-        self._save_to_file(albums)
+        return albums, hrefs
         
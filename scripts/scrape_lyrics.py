@@ -1,122 +1,67 @@
 # scripts/scrape_lyrics.py
 
 import requests
-from requests import Response
-from bs4 import BeautifulSoup
 import logging
 import re
+from config import settings
+from scripts.http_transport import get_transport
+from scripts.page_parser import LyricsPageParser
+from scripts.metrics import metrics
+from scripts.services import registry
+from scripts.slug_index import guess_artist_slug
 
 class AZLyrics:
 
-    def __init__(self, artist: str, song: str): # saves artist: str, song: str as an annotation (dictionary)
+    def __init__(self, artist: str, song: str, parser_backend: str = 'html.parser', fetcher=None, slugs=None): # saves artist: str, song: str as an annotation (dictionary)
         self.artist = artist
         self.song = song
+        self.fetcher = fetcher or get_transport() # Anything with requests.get's signature, e.g. a FetchEngine
+        self.slugs = slugs or registry.get('slug_index') # Known artist slugs and song hrefs, see scripts/slug_index.py
+        self.parser = LyricsPageParser(backend=parser_backend) # Parses each page once for every field
         self.logger = logging.getLogger(__name__) # Creates logger object
 
     # methods to prep the artist and song title field to search
     def _parse_artist(self) -> str: # _ denotes for coder to treat as private method. -> str, annotates return as a string
-        self.logger.info(f'Parsing artist {self.artist}')
-        return re.sub(r'[^a-z0-9\s]', '', self.artist.lower().replace(' ', ''))
+        self.logger.debug('Parsing artist %s', self.artist)
+        return guess_artist_slug(self.artist)
     
     def _parse_song(self) -> str:
-        self.logger.info(f'Paring song: {self.song}')
+        self.logger.debug('Parsing song: %s', self.song)
         return re.sub(r'[^a-z0-9\s]', '', self.song.lower().replace(' ', ''))
     
-    # method to prepare url to be used dynamically
+    # method to prepare url to be used dynamically, the href from the discography page when it has been seen
     def url(self) -> str:
-        url = 'https://www.azlyrics.com/lyrics/{}/{}.html'\
-                .format(self._parse_artist().replace('the',''), self._parse_song())
-        self.logger.info(f'Generated URL: {url}')
+        href = self.slugs.song_href(self.artist, self.song)
+        if href:
+            url = '{}/{}'.format(settings.AZLYRICS_BASE_URL, href)
+        else:
+            url = '{}/lyrics/{}/{}.html'\
+                    .format(settings.AZLYRICS_BASE_URL, self.slugs.artist_slug(self.artist) or self._parse_artist(), self._parse_song())
+        self.logger.debug('Generated URL: %s', url)
         return url
 
     # method to make an HTTP request to AZLyrics and return lyrics
     def open_url(self):
+        self.slugs.resolve(self.artist, self.fetcher) # Reads the artist's letter index page the first time it is unknown
         url = self.url()
         try:
-            response = requests.get(url)
+            response = self.fetcher.get(url)
             response.raise_for_status() # Raises error for bad responses
-            self.logger.info(f'Successfully opened URL: {url}')
+            self.logger.info('Successfully opened URL: %s', url)
         except requests.exceptions.RequestException as e:
             self.logger.error(f'Failed to open URL: {url}')
+            metrics.inc('scrape_failures_total', page='lyrics')
             return None
         
         lyrics = album = writers = genre = None
 
         if response.ok: # checks for errors with the request
-            lyrics = self._parse_lyrics(response)
-            genre = self._parse_genre(response)
-            album = self._parse_album(response)
-            writers = self._parse_writers(response)
+            with metrics.timer('parse_seconds', page='lyrics'):
+                lyrics, genre, album, writers = self.parser.parse(response.text)
+            metrics.inc('pages_scraped_total', page='lyrics')
         
-        self.logger.info(f'Lyrics: {lyrics}')
-        self.logger.info(f'Genre: {genre}')
-        self.logger.info(f'Album: {album}')
-        self.logger.info(f'Writers: {writers}')
+        # One record per song, rendered by the log listener and only when DEBUG is on; a whole lyric is cut by the formatter
+        self.logger.debug('Lyrics: %s', lyrics)
+        self.logger.debug('Genre: %s, album: %s, writers: %s', genre, album, writers)
 
         return lyrics, genre, album, writers
-    
-    def _parse_genre(self, r: Response) -> str:
-        dom = BeautifulSoup(r.text, 'html.parser')
-        header = dom.head
-        script_tag = header.find('script', text=lambda t: 'window.rtkGPTSlotsTargeting' in t)
-
-        if script_tag:
-            script_content = script_tag.string
-            start_index = script_content.find('["genre", "') + len('["genre", "')
-            end_index = script_content.find('"]', start_index)
-            genre = script_content[start_index:end_index]
-            self.logger.info(f'Genre found: {genre}')
-            return genre
-        self.logger.warning('Genre not found')
-        return "Genre not found"
-
-    def _parse_album(self, r: Response) -> str:
-        dom = BeautifulSoup(r.text, 'html.parser')
-        album_div = dom.find('div', class_='songinalbum_title')
-        if album_div:
-            album = album_div.get_text(strip=True)
-            album = album.replace('album:', '').strip()
-            self.logger.info(f'Album found: {album}')
-            return album
-        self.logger.warning(f'Album not found')
-        return "Album not found"
-    
-    def _parse_writers(self, r: Response) -> str:
-        dom = BeautifulSoup(r.text, 'html.parser')
-        smt_divs = dom.find_all('div', class_='smt')
-
-        for div in smt_divs:
-            small_tag = div.find('small')
-            if small_tag and 'Writer(s):' in small_tag.get_text(strip=True):
-                writers = small_tag.get_text(strip=True).replace('Writer(s):','').strip()
-                self.logger.info(f'Writer(s) found: {writers}')
-                return writers
-            
-        self.logger.warning(f'Writers not found')
-        return "Writers not found"    
-    
-    # method to isolate the lyrics from the rest of the html file
-    def _parse_lyrics(self, r: Response) -> str:
-        dom = BeautifulSoup(r.text, 'html.parser') # DOM stands for Document Object Model
-        body = dom.body # body section of the html file
-        
-        divs = body.find_all('div', {'class': 'col-xs-12 col-lg-8 text-center'})[0]
-
-        target = {0: 0}
-
-        for i, d in enumerate(divs):
-            try:
-                query = d.find_all('br')
-                n_br = len(query)
-                if n_br > list(target.values())[0]:
-                    target = {i: n_br}
-            except Exception as e:
-                self.logger.error(f'Error parsing div at index {i}: {e}')
-
-        target = list(target.keys())[0]
-        lyrics = list(divs.children)[target].text
-
-        self.logger.info('Lyrics successfully parsed')
-        return lyrics
-    
-    
\ No newline at end of file
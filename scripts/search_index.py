@@ -0,0 +1,411 @@
+# scripts/search_index.py
+
+from config import settings
+from scripts.upload_to_mongodb import songs_collection
+from scripts.generate_embeddings import TOKEN_PATTERN, _batches, _stale_songs
+from scripts.compact_storage import song_lyrics
+import numpy as np
+from collections import defaultdict
+import argparse
+import itertools
+import logging
+import sqlite3
+import shutil
+import re
+import os
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    doc INTEGER PRIMARY KEY,
+    song_id TEXT NOT NULL,
+    lyrics_hash TEXT NOT NULL,
+    artist TEXT,
+    title TEXT,
+    live INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS docs_song ON docs (song_id, live);
+CREATE INDEX IF NOT EXISTS docs_dead ON docs (doc) WHERE live = 0;
+CREATE TABLE IF NOT EXISTS segments (
+    segment INTEGER PRIMARY KEY,
+    docs INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    segment INTEGER NOT NULL,
+    doc_count INTEGER NOT NULL,
+    docs BLOB NOT NULL,
+    positions BLOB NOT NULL,
+    PRIMARY KEY (term, segment)
+) WITHOUT ROWID;
+"""
+
+# Quoted phrases, parentheses, and bare words, either of the first and last may carry a leading '-'
+QUERY_PATTERN = re.compile(r'-?"[^"]*"|\(|\)|-?[^\s()"]+')
+
+logger = logging.getLogger(__name__)
+
+def _varints(values) -> tuple:
+    # LEB128 bytes of every value, and how many bytes each one took
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += values >= np.uint64(1 << (7 * k))
+    starts = np.cumsum(nbytes) - nbytes
+    out = np.zeros(int(nbytes.sum()), dtype=np.uint8)
+    for j in range(int(nbytes.max(initial=0))):
+        has = nbytes > j
+        byte = (values[has] >> np.uint64(7 * j)) & np.uint64(127)
+        more = (nbytes[has] > j + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has] + j] = (byte | more).astype(np.uint8)
+    return out, nbytes
+
+def encode_varints(values) -> bytes:
+    """ LEB128: 7 bits per byte, the high bit set on every byte but a value's last."""
+    return _varints(values)[0].tobytes()
+
+def decode_varints(data: bytes) -> np.ndarray:
+    """ Inverse of encode_varints, vectorized: every byte is shifted into place and summed per value."""
+    b = np.frombuffer(data, dtype=np.uint8)
+    if not len(b):
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(b < 128)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = (np.arange(len(b)) - np.repeat(starts, ends - starts + 1)) * 7
+    return np.add.reduceat((b & 127).astype(np.int64) << shifts, starts)
+
+def _contained(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # Mask of the values of sorted a that occur in sorted b, a binary search each instead of np.isin's sort or hash
+    if not len(b):
+        return np.zeros(len(a), dtype=bool)
+    return b[np.minimum(np.searchsorted(b, a), len(b) - 1)] == a
+
+def tokenize(text: str) -> list:
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+class SearchIndex:
+    """ Inverted index over song lyrics in data/search/index.sqlite, for boolean and phrase queries
+        without reading a single lyric from MongoDB.
+        Every term maps to postings per segment: the ids of the songs it occurs in and its word positions in each,
+        both delta-encoded varints. A segment is one batch of songs, written once and never touched again, so
+        indexing new songs only appends. A song whose lyrics change gets a new doc id, its old one is marked dead
+        and filtered from results until compact() merges the segments and drops it.
+        A query costs one B-tree lookup per term plus that term's postings, not a scan of the corpus."""
+
+    def __init__(self, directory: str = None):
+        self.directory = directory or settings.SEARCH_INDEX_DIR
+        os.makedirs(self.directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), timeout=30, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.logger = logging.getLogger(__name__)
+
+    def __len__(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM docs WHERE live = 1').fetchone()[0]
+
+    def segment_count(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM segments').fetchone()[0]
+
+    def stale(self, songs: list) -> list:
+        """ The song ids among [(song_id, lyrics_hash)] that aren't indexed or were indexed from other lyrics."""
+        stored = {}
+        for start in range(0, len(songs), 500):
+            ids = [song_id for song_id, _ in songs[start:start + 500]]
+            query = f"SELECT song_id, lyrics_hash FROM docs WHERE live = 1 AND song_id IN ({','.join('?' * len(ids))})"
+            stored.update(self.db.execute(query, ids).fetchall())
+        return [song_id for song_id, digest in songs if stored.get(song_id) != digest]
+
+    def add_many(self, songs: list) -> int:
+        """ Indexes songs (dicts with _id, lyrics, lyrics_hash, artist and title) as one new segment."""
+        if not songs:
+            return 0
+        with self.db:
+            ids = [str(song['_id']) for song in songs]
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                self.db.execute(f"UPDATE docs SET live = 0 WHERE live = 1 AND song_id IN ({','.join('?' * len(chunk))})", chunk)
+            doc = self.db.execute('SELECT COALESCE(MAX(doc) + 1, 0) FROM docs').fetchone()[0]
+            # Term -> id in order of first use, ids are handed out by the counter on lookup
+            rows, vocabulary, term_ids, docs = [], defaultdict(itertools.count().__next__), [], []
+            for song_id, song in zip(ids, songs):
+                rows.append((doc, song_id, song['lyrics_hash'], song.get('artist'), song.get('title')))
+                tokens = [vocabulary[term] for term in tokenize(song_lyrics(song))]
+                term_ids.extend(tokens)
+                docs.extend([doc] * len(tokens))
+                doc += 1
+            self.db.executemany('INSERT INTO docs (doc, song_id, lyrics_hash, artist, title) VALUES (?, ?, ?, ?, ?)', rows)
+            segment = self.db.execute('INSERT INTO segments (docs) VALUES (?)', (len(rows),)).lastrowid
+            if term_ids:
+                # Every word of the batch as (term, doc, position), grouped by term with docs and positions ascending
+                term_ids, docs = np.array(term_ids, dtype=np.int64), np.array(docs, dtype=np.int64)
+                first = np.flatnonzero(np.diff(docs, prepend=-1))
+                positions = np.arange(len(docs)) - np.repeat(first, np.diff(np.append(first, len(docs))))
+                order = np.argsort(term_ids, kind='stable')
+                term_ids, docs, positions = term_ids[order], docs[order], positions[order]
+                pairs = np.flatnonzero((np.diff(term_ids, prepend=-1) != 0) | (np.diff(docs, prepend=-1) != 0))
+                counts = np.diff(np.append(pairs, len(docs)))
+                terms = list(vocabulary)
+                self.db.executemany('INSERT INTO postings (term, segment, doc_count, docs, positions) VALUES (?, ?, ?, ?, ?)',
+                                    ((terms[term], segment, *encoded) for term, encoded in zip(
+                                        np.unique(term_ids), self._encode(term_ids[pairs], docs[pairs], counts, positions))))
+        return len(rows)
+
+    @staticmethod
+    def _encode(terms: np.ndarray, docs: np.ndarray, counts: np.ndarray, positions: np.ndarray) -> list:
+        """ [(doc_count, docs blob, positions blob)] for each term, in order, from parallel arrays of
+            (term, doc, position count) grouped by term with docs ascending, and the positions of every pair in turn.
+            docs blob: doc id deltas then position counts, positions blob: position deltas restarting per doc.
+            Encoded in one pass for all terms, then cut up per term."""
+        first = np.flatnonzero(np.diff(terms, prepend=-1))
+        sizes = np.diff(np.append(first, len(terms)))
+        group = np.repeat(np.arange(len(first)), sizes)
+        doc_deltas = np.diff(docs, prepend=0)
+        doc_deltas[first] = docs[first]
+        # Each term's stretch of the stream holds its doc deltas, then its counts
+        slots = first[group] + np.arange(len(terms))
+        stream = np.empty(2 * len(terms), dtype=np.int64)
+        stream[slots], stream[slots + sizes[group]] = doc_deltas, counts
+        doc_bytes, doc_sizes = _varints(stream)
+        doc_offsets = np.concatenate(([0], np.cumsum(doc_sizes)))
+
+        occurrences = np.cumsum(counts) - counts
+        deltas = np.diff(positions, prepend=0)
+        deltas[occurrences] = positions[occurrences]
+        position_bytes, position_sizes = _varints(deltas)
+        position_offsets = np.concatenate(([0], np.cumsum(position_sizes)))
+        occurrences = np.append(occurrences, len(positions))
+
+        doc_bytes, position_bytes = doc_bytes.tobytes(), position_bytes.tobytes()
+        return [(int(size),
+                 doc_bytes[doc_offsets[2 * start]:doc_offsets[2 * (start + size)]],
+                 position_bytes[position_offsets[occurrences[start]]:position_offsets[occurrences[start + size]]])
+                for start, size in zip(first.tolist(), sizes.tolist())]
+
+    @staticmethod
+    def _decode(doc_count: int, docs: bytes, positions: bytes = None) -> tuple:
+        values = decode_varints(docs)
+        doc_ids, counts = np.cumsum(values[:doc_count]), values[doc_count:]
+        if positions is None:
+            return doc_ids, counts, None
+        deltas = decode_varints(positions)
+        # Running sum over all deltas, minus the running total where each doc's list began
+        totals = np.cumsum(deltas)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        offsets = np.concatenate(([0], totals[starts[1:] - 1])) if len(starts) else starts
+        return doc_ids, counts, totals - np.repeat(offsets, counts)
+
+    def postings(self, term: str, positions: bool = False) -> tuple:
+        """ (doc ids, position counts, positions) of a term across every segment, positions only when asked for."""
+        column = 'positions' if positions else 'NULL'
+        parts = [self._decode(doc_count, docs, blob) for doc_count, docs, blob in self.db.execute(
+            f'SELECT doc_count, docs, {column} FROM postings WHERE term = ? ORDER BY segment', (term,))]
+        if not parts:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, (empty if positions else None)
+        # Segments hold increasing doc ranges, concatenating them keeps the ids sorted
+        return (np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts]),
+                np.concatenate([p[2] for p in parts]) if positions else None)
+
+    def phrase(self, terms: list) -> np.ndarray:
+        """ Sorted ids of the docs containing terms as consecutive words."""
+        if len(terms) == 1:
+            return self.postings(terms[0])[0]
+        # Cheapest filter first: only docs holding every term are matched on positions
+        candidates = None
+        for term in terms:
+            docs = self.postings(term)[0]
+            candidates = docs if candidates is None else candidates[_contained(candidates, docs)]
+            if not len(candidates):
+                return candidates
+        matches = None
+        for offset, term in enumerate(terms):
+            docs, counts, positions = self.postings(term, positions=True)
+            keep = np.repeat(_contained(docs, candidates), counts)
+            # A match is a doc and the position its phrase starts at, sorted like the postings
+            keys = np.repeat(docs, counts)[keep] << 32 | (positions[keep] - offset + (1 << 31))
+            matches = keys if matches is None else matches[_contained(matches, keys)]
+        docs = matches >> 32
+        return docs[np.concatenate(([True], docs[1:] != docs[:-1]))] if len(docs) else docs
+
+    def _universe(self) -> np.ndarray:
+        return np.array([doc for doc, in self.db.execute('SELECT doc FROM docs WHERE live = 1 ORDER BY doc')], dtype=np.int64)
+
+    def _evaluate(self, node) -> np.ndarray:
+        kind, value = node
+        if kind == 'phrase':
+            return self.phrase(value)
+        if kind == 'or':
+            return np.unique(np.concatenate([self._evaluate(child) for child in value]))
+        if kind == 'not':
+            return np.setdiff1d(self._universe(), self._evaluate(value), assume_unique=True)
+        result = None
+        # 'and': intersect the positive parts, then subtract the negated ones
+        for child in sorted(value, key=lambda child: child[0] == 'not'):
+            if child[0] == 'not' and result is not None:
+                result = np.setdiff1d(result, self._evaluate(child[1]), assume_unique=True)
+            else:
+                docs = self._evaluate(child)
+                result = docs if result is None else result[_contained(result, docs)]
+        return result
+
+    def match(self, query: str) -> np.ndarray:
+        """ Sorted doc ids of the live songs matching query.
+            Words must all occur (AND is implied), "quoted phrases" must occur as written, OR joins alternatives,
+            NOT word or -word excludes, and parentheses group: '"other side" (love OR heart) -goodbye'."""
+        docs = self._evaluate(parse_query(query))
+        dead = np.array([doc for doc, in self.db.execute('SELECT doc FROM docs WHERE live = 0 ORDER BY doc')], dtype=np.int64)
+        return docs[~_contained(docs, dead)]
+
+    def songs(self, docs) -> list:
+        """ [(artist, title)] of the given doc ids, in order."""
+        found = {}
+        docs = [int(doc) for doc in docs]
+        for start in range(0, len(docs), 500):
+            chunk = docs[start:start + 500]
+            found.update((doc, (artist, title)) for doc, artist, title in self.db.execute(
+                f"SELECT doc, artist, title FROM docs WHERE doc IN ({','.join('?' * len(chunk))})", chunk))
+        return [found[doc] for doc in docs]
+
+    def search(self, query: str, limit: int = None) -> list:
+        """ [(artist, title)] of the songs matching query (see match), in the order they were indexed."""
+        return self.songs(self.match(query)[:limit])
+
+    def compact(self):
+        """ Merges every segment into one and drops the docs of replaced lyrics."""
+        with self.db:
+            dead = np.array([doc for doc, in self.db.execute('SELECT doc FROM docs WHERE live = 0 ORDER BY doc')], dtype=np.int64)
+            segment = self.db.execute('INSERT INTO segments (docs) VALUES (?)', (len(self),)).lastrowid
+            rows = self.db.execute('SELECT term, doc_count, docs, positions FROM postings WHERE segment < ? ORDER BY term, segment',
+                                   (segment,))
+            merged, current, parts, batch, pending = [], None, [], [], 0
+
+            def merge():
+                # One term's postings from every segment, without the dead docs
+                nonlocal pending
+                docs, counts, positions = (np.concatenate([p[i] for p in parts]) for i in range(3))
+                keep = ~_contained(docs, dead)
+                if keep.any():
+                    batch.append((current, docs[keep], counts[keep], positions[np.repeat(keep, counts)]))
+                    pending += len(batch[-1][3])
+
+            def write():
+                # Terms are encoded together, half a million positions at a time
+                nonlocal pending
+                terms = np.repeat(np.arange(len(batch)), [len(docs) for _, docs, _, _ in batch])
+                encoded = self._encode(terms, *(np.concatenate([entry[i] for entry in batch]) for i in (1, 2, 3)))
+                merged.extend((entry[0], segment, *blobs) for entry, blobs in zip(batch, encoded))
+                batch.clear()
+                pending = 0
+
+            for term, doc_count, docs, positions in rows:
+                if term != current and parts:
+                    merge()
+                    parts = []
+                    if pending > 500000:
+                        write()
+                current = term
+                parts.append(self._decode(doc_count, docs, positions))
+            if parts:
+                merge()
+            if batch:
+                write()
+            self.db.execute('DELETE FROM postings WHERE segment < ?', (segment,))
+            self.db.executemany('INSERT INTO postings (term, segment, doc_count, docs, positions) VALUES (?, ?, ?, ?, ?)', merged)
+            self.db.execute('DELETE FROM segments WHERE segment < ?', (segment,))
+            self.db.execute('DELETE FROM docs WHERE live = 0')
+        self.db.execute('VACUUM')
+        self.logger.info(f'Compacted the search index into one segment, {len(dead)} replaced songs dropped')
+
+    def close(self):
+        self.db.close()
+
+def parse_query(query: str):
+    """ Parses a search query into nested ('or' | 'and', [nodes]), ('not', node) and ('phrase', [terms])."""
+    tokens = QUERY_PATTERN.findall(query)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def parse_or():
+        nonlocal position
+        children = [parse_and()]
+        while peek() == 'OR':
+            position += 1
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else ('or', children)
+
+    def parse_and():
+        nonlocal position
+        children = []
+        while peek() not in (None, ')', 'OR'):
+            if peek() == 'AND':
+                position += 1
+                continue
+            node = parse_unary()
+            if node is not None:
+                children.append(node)
+        if not children:
+            raise ValueError(f'Nothing to search for in {query!r}')
+        return children[0] if len(children) == 1 else ('and', children)
+
+    def parse_unary():
+        nonlocal position
+        token = tokens[position]
+        position += 1
+        if token == 'NOT':
+            if peek() in (None, ')', 'OR'):
+                raise ValueError(f'NOT without a term in {query!r}')
+            node = parse_unary()
+            return None if node is None else ('not', node)
+        if token == '(':
+            node = parse_or()
+            if peek() != ')':
+                raise ValueError(f'Unbalanced parentheses in {query!r}')
+            position += 1
+            return node
+        if token == ')':
+            raise ValueError(f'Unbalanced parentheses in {query!r}')
+        negate = token.startswith('-') and len(token) > 1
+        terms = tokenize(token.lstrip('-').strip('"'))
+        # Punctuation only, there is nothing in the index to match it against
+        if not terms:
+            return None
+        node = ('phrase', terms)
+        return ('not', node) if negate else node
+
+    node = parse_or()
+    if position < len(tokens):
+        raise ValueError(f'Unbalanced parentheses in {query!r}')
+    return node
+
+def update_search_index(collection=None, index: SearchIndex = None, query: dict = None, batch_size: int = None) -> int:
+    """
+    Indexes every song matching query whose lyrics aren't in the index yet, one segment per batch,
+    and compacts once there are more than settings.SEARCH_MAX_SEGMENTS segments.
+    :return: Number of songs indexed.
+    """
+    collection = collection if collection is not None else songs_collection()
+    owns_index = index is None
+    index = SearchIndex() if owns_index else index
+    batch_size = batch_size or settings.SEARCH_BATCH_SIZE
+    indexed = 0
+    try:
+        for batch in _batches(_stale_songs(collection, index, query or {}, batch_size), batch_size):
+            indexed += index.add_many(batch)
+            logger.info(f'{indexed} songs added to the search index')
+        if index.segment_count() > settings.SEARCH_MAX_SEGMENTS:
+            index.compact()
+    finally:
+        if owns_index:
+            index.close()
+    return indexed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or update the lyrics search index from MongoDB")
+    parser.add_argument('--batch_size', type=int, help="Songs per index segment")
+    parser.add_argument('--rebuild', action='store_true', help="Start over from an empty index")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.rebuild:
+        shutil.rmtree(settings.SEARCH_INDEX_DIR, ignore_errors=True)
+    count = update_search_index(batch_size=args.batch_size)
+    print(f"Indexed {count} songs into {settings.SEARCH_INDEX_DIR}.")
@@ -1,19 +1,13 @@
-from pymongo import MongoClient
-import nltk
-from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
-from nrclex import NRCLex
+from scripts.services import registry
+from scripts.sentiment_engine import BatchSentimentEngine, scored_update
+from scripts.upload_to_mongodb import songs_collection, without_linked
+from scripts.compact_storage import song_lyrics
+from scripts.sentiment_rollups import refresh_rollups
+from scripts.metrics import metrics
+import argparse
 import logging
 
-# Download necessary NLTK resources for tokenization
-nltk.download('punkt')
-
-# Initiate Sentiment Analyzer
-vader_analyzer = SentimentIntensityAnalyzer() # Contains txt files with scores for different character combinations
-
-# MongoDB Connection
-client = MongoClient("mongodb://localhost:27017/")
-db = client.lyrical_analysis_db
-songs_collection = db.songs
+# The analyzer, the NRC lexicon and the MongoDB connection are created on first use, importing this module is free
 
 logger = logging.getLogger(__name__)
 
@@ -23,14 +17,16 @@ def analyze_sentiment_vader(text):
         Perform VADER sentiment analysis
         Gives basic scores: negative, positive, neutral, compound
     """
-    return vader_analyzer.polarity_scores(text)
+    return registry.get('vader_analyzer').polarity_scores(text)
 
 def analyze_sentiment_nrc(text):
     """
         Perform NRC Lexicon sentiment analysis
         Gives more specific scores
     """
-    # Perform NRC analysis
+    # Perform NRC analysis, NRCLex loads its lexicon on import and needs the punkt tokenizer
+    registry.get('punkt')
+    from nrclex import NRCLex
     nrc = NRCLex(text)
 
     # Initialize emotion scores to zero
@@ -48,25 +44,61 @@ def analyze_sentiment_nrc(text):
     return emotion_scores
 
 
-def update_song_with_sentiment(song):
-    lyrics = song.get("lyrics", "")
+def update_song_with_sentiment(song, rollups: bool = False):
+    # The song is left flagged for the next refresh_rollups, which recomputes each album, artist and year once
+    # for every song scored since. rollups: refresh its summaries right away, for a single song
+    lyrics = song_lyrics(song) or ""
     # Get VADER sentiment scores
-    vader_scores = analyze_sentiment_vader(lyrics)
+    with metrics.timer('sentiment_seconds', analyzer='vader'):
+        vader_scores = analyze_sentiment_vader(lyrics)
     # Get NRC Lexicon emotion scores
-    nrc_scores = analyze_sentiment_nrc(lyrics)
+    with metrics.timer('sentiment_seconds', analyzer='nrc'):
+        nrc_scores = analyze_sentiment_nrc(lyrics)
     
     # Update document with sentiment information
     sentiment_data = {
         "vader": vader_scores,
         "nrc": nrc_scores
     }
-    songs_collection.update_one(
-        {"_id": song["_id"]},
-        {"$set": {"sentiment": sentiment_data}}
-    )
+    fields, match = scored_update(dict(song, lyrics=lyrics), sentiment_data)
+    with metrics.timer('mongo_write_seconds', collection='songs', op='update_one'):
+        songs_collection().update_one({"_id": song["_id"], **match}, {"$set": fields})
+    metrics.inc('documents_updated_total', collection='songs')
+    if rollups:
+        refresh_rollups(query={"_id": song["_id"]})
 
-# Retrieve all songs and update with sentiment analysis
-for song in songs_collection.find():
-    update_song_with_sentiment(song)
-    
-"""Analyzes all of the songs listed in the collection and adds an additional section for sentiment scores"""
\ No newline at end of file
+def update_all_songs(batch: bool = True, processes: int = None, chunk_size: int = None, incremental: bool = True) -> int:
+    """
+    Analyzes the songs listed in the collection and adds an additional section for sentiment scores.
+    Incremental runs only score songs that are new, changed or scored by another analyzer version.
+    The album, artist and year summaries of the rescored songs are refreshed afterwards.
+    """
+    with metrics.timer('stage_seconds', stage='sentiment'):
+        if batch:
+            engine = BatchSentimentEngine(processes=processes, chunk_size=chunk_size)
+            updated = engine.update_collection(songs_collection(), incremental=incremental)
+        else:
+            # Original one song at a time path
+            updated = 0
+            if incremental:
+                BatchSentimentEngine.mark_stale(songs_collection())
+            for song in songs_collection().find(without_linked(BatchSentimentEngine.stale_filter() if incremental else None)):
+                update_song_with_sentiment(song, rollups=False)
+                updated += 1
+    with metrics.timer('stage_seconds', stage='rollups'):
+        refresh_rollups()
+    return updated
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Add sentiment scores to every song in MongoDB")
+    parser.add_argument('--per_song', action='store_true', help="Score and update one song at a time with VADER and NRCLex")
+    parser.add_argument('--processes', type=int, help="Scoring processes for the batch engine")
+    parser.add_argument('--chunk_size', type=int, help="Songs per batch engine task")
+    parser.add_argument('--full', action='store_true', help="Rescore every song, not only new and changed ones")
+    parser.add_argument('--metrics', action='store_true', help="Print time spent per stage and counters at the end")
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.enable()
+    update_all_songs(batch=not args.per_song, processes=args.processes, chunk_size=args.chunk_size, incremental=not args.full)
+    if args.metrics:
+        print(metrics.report())
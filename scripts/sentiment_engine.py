@@ -0,0 +1,391 @@
+# scripts/sentiment_engine.py
+
+from concurrent.futures import ProcessPoolExecutor
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from config import settings
+from scripts.services import registry
+from scripts.metrics import metrics
+from scripts.upload_to_mongodb import lyrics_hash, without_linked
+from scripts.compact_storage import song_lyrics, stored_sentiment
+from vaderSentiment.vaderSentiment import (SentimentIntensityAnalyzer, SentiText, BOOSTER_DICT, SPECIAL_CASES,
+                                           NEGATE, N_SCALAR, C_INCR, scalar_inc_dec)
+from importlib.metadata import version
+import numpy as np
+import itertools
+import logging
+import string
+
+NRC_EMOTIONS = ("anger", "anticipation", "disgust", "fear", "joy", "sadness", "surprise", "trust")
+NEGATE_WORDS = frozenset(NEGATE)
+
+# Stored with every score, bump SCORING_REVISION when the scores change for the same lyrics so stored songs get rescored
+SCORING_REVISION = 1
+SENTIMENT_VERSION = f"vader-{version('vaderSentiment')}/nrc-{version('NRCLex')}/{SCORING_REVISION}"
+
+logger = logging.getLogger(__name__)
+
+def _negated(word_lower: str) -> bool:
+    # vaderSentiment.negated for a single, already lowercased word
+    return word_lower in NEGATE_WORDS or "n't" in word_lower
+
+class FastVaderAnalyzer(SentimentIntensityAnalyzer):
+    """ SentimentIntensityAnalyzer with the same rules and the same scores, minus the per-word rework:
+        every word is lowercased once per song instead of once per rule check, which made the stock
+        analyzer quadratic in the length of the lyrics."""
+
+    def __init__(self):
+        super().__init__()
+        self._emoji_chars = frozenset(self.emojis)
+
+    def polarity_scores(self, text):
+        if self._emoji_chars.isdisjoint(text):
+            text = text.strip()
+        else: # Rare for lyrics, the stock character loop swaps emojis for their descriptions
+            text = self._replace_emojis(text)
+
+        sentitext = SentiText(text)
+        words = sentitext.words_and_emoticons
+        lower = [w.lower() for w in words]
+        is_cap_diff = sentitext.is_cap_diff
+        lexicon = self.lexicon
+        last = len(words) - 1
+
+        sentiments = []
+        for i, item_lower in enumerate(lower):
+            if item_lower in BOOSTER_DICT or (i < last and item_lower == "kind" and lower[i + 1] == "of"):
+                sentiments.append(0)
+            elif item_lower in lexicon:
+                sentiments.append(self._valence(words, lower, i, is_cap_diff))
+            else:
+                sentiments.append(0)
+
+        if "but" in lower:
+            sentiments = self._but_check(words, sentiments)
+        return self.score_valence(sentiments, text)
+
+    def _replace_emojis(self, text: str) -> str:
+        text_no_emoji = ""
+        prev_space = True
+        for chr in text:
+            if chr in self.emojis:
+                if not prev_space:
+                    text_no_emoji += ' '
+                text_no_emoji += self.emojis[chr]
+                prev_space = False
+            else:
+                text_no_emoji += chr
+                prev_space = chr == ' '
+        return text_no_emoji.strip()
+
+    # SentimentIntensityAnalyzer.sentiment_valence on the precomputed lowercase words
+    def _valence(self, words: list, lower: list, i: int, is_cap_diff: bool) -> float:
+        lexicon = self.lexicon
+        item, item_lower = words[i], lower[i]
+        valence = lexicon[item_lower]
+
+        if item_lower == "no" and i != len(words) - 1 and lower[i + 1] in lexicon:
+            valence = 0.0
+        if (i > 0 and lower[i - 1] == "no") or (i > 1 and lower[i - 2] == "no") \
+           or (i > 2 and lower[i - 3] == "no" and lower[i - 1] in ["or", "nor"]):
+            valence = lexicon[item_lower] * N_SCALAR
+
+        if item.isupper() and is_cap_diff:
+            if valence > 0:
+                valence += C_INCR
+            else:
+                valence -= C_INCR
+
+        for start_i in range(0, 3):
+            if i > start_i and lower[i - (start_i + 1)] not in lexicon:
+                s = scalar_inc_dec(words[i - (start_i + 1)], valence, is_cap_diff)
+                if start_i == 1 and s != 0:
+                    s = s * 0.95
+                if start_i == 2 and s != 0:
+                    s = s * 0.9
+                valence = valence + s
+                valence = self._fast_negation_check(valence, lower, start_i, i)
+                if start_i == 2:
+                    valence = self._fast_idioms_check(valence, lower, i)
+
+        # "least" as a negation, unless it is "at least" or "very least"
+        if i > 1 and lower[i - 1] not in lexicon and lower[i - 1] == "least":
+            if lower[i - 2] != "at" and lower[i - 2] != "very":
+                valence = valence * N_SCALAR
+        elif i > 0 and lower[i - 1] not in lexicon and lower[i - 1] == "least":
+            valence = valence * N_SCALAR
+        return valence
+
+    @staticmethod
+    def _fast_negation_check(valence: float, lower: list, start_i: int, i: int) -> float:
+        if start_i == 0:
+            if _negated(lower[i - 1]):
+                valence = valence * N_SCALAR
+        if start_i == 1:
+            if lower[i - 2] == "never" and (lower[i - 1] == "so" or lower[i - 1] == "this"):
+                valence = valence * 1.25
+            elif lower[i - 2] == "without" and lower[i - 1] == "doubt":
+                pass
+            elif _negated(lower[i - 2]):
+                valence = valence * N_SCALAR
+        if start_i == 2:
+            if lower[i - 3] == "never" and (lower[i - 2] == "so" or lower[i - 2] == "this") or \
+                    (lower[i - 1] == "so" or lower[i - 1] == "this"):
+                valence = valence * 1.25
+            elif lower[i - 3] == "without" and (lower[i - 2] == "doubt" or lower[i - 1] == "doubt"):
+                pass
+            elif _negated(lower[i - 3]):
+                valence = valence * N_SCALAR
+        return valence
+
+    @staticmethod
+    def _fast_idioms_check(valence: float, lower: list, i: int) -> float:
+        onezero = f"{lower[i - 1]} {lower[i]}"
+        twoonezero = f"{lower[i - 2]} {lower[i - 1]} {lower[i]}"
+        twoone = f"{lower[i - 2]} {lower[i - 1]}"
+        threetwoone = f"{lower[i - 3]} {lower[i - 2]} {lower[i - 1]}"
+        threetwo = f"{lower[i - 3]} {lower[i - 2]}"
+
+        for seq in (onezero, twoonezero, twoone, threetwoone, threetwo):
+            if seq in SPECIAL_CASES:
+                valence = SPECIAL_CASES[seq]
+                break
+
+        if len(lower) - 1 > i:
+            zeroone = f"{lower[i]} {lower[i + 1]}"
+            if zeroone in SPECIAL_CASES:
+                valence = SPECIAL_CASES[zeroone]
+        if len(lower) - 1 > i + 1:
+            zeroonetwo = f"{lower[i]} {lower[i + 1]} {lower[i + 2]}"
+            if zeroonetwo in SPECIAL_CASES:
+                valence = SPECIAL_CASES[zeroonetwo]
+
+        for n_gram in (threetwoone, threetwo, twoone):
+            if n_gram in BOOSTER_DICT:
+                valence = valence + BOOSTER_DICT[n_gram]
+        return valence
+
+class NRCScorer:
+    """ NRC emotion frequencies for many songs at once.
+        The lexicon is compiled into a word -> row table over a (words x emotions) count matrix, a chunk of songs
+        becomes one array of row ids and every song's counts are summed in a single np.add.reduceat.
+        Words are the ones TextBlob hands NRCLex (Treebank tokens with the surrounding punctuation stripped),
+        but tokenized line by line instead of punkt sentence by sentence, which only moves sentence-final
+        punctuation that is stripped anyway."""
+
+    LINE_CACHE_SIZE = 100000
+
+    def __init__(self, lexicon: dict = None):
+        if lexicon is None:
+            from nrclex import NRCLex # The lexicon ships inside nrclex, only needed to build the table
+            lexicon = NRCLex.lexicon
+        self.rows = {word: row for row, word in enumerate(lexicon)}
+        # One column per emotion we report, plus the total of every label, positive and negative included
+        self.counts = np.zeros((len(lexicon) + 1, len(NRC_EMOTIONS) + 1), dtype=np.int64)
+        for word, row in self.rows.items():
+            for emotion in lexicon[word]:
+                if emotion in NRC_EMOTIONS:
+                    self.counts[row, NRC_EMOTIONS.index(emotion)] += 1
+            self.counts[row, -1] = len(lexicon[word])
+        self.empty_row = len(lexicon) # All zeros, pads songs without a single lexicon word
+        from nltk.tokenize.destructive import NLTKWordTokenizer # nltk takes a third of a second to import
+        self.tokenizer = NLTKWordTokenizer()
+        self._line_cache = {}
+
+    def words(self, text: str) -> list:
+        tokens = self.tokenizer.tokenize(text)
+        return [token if token.startswith("'") else token.strip().strip(string.punctuation)
+                for token in tokens if token.strip().strip(string.punctuation)]
+
+    def line_ids(self, line: str) -> list:
+        # Lexicon rows of a lyric line, choruses repeat so lines are tokenized once and remembered
+        ids = self._line_cache.get(line)
+        if ids is None:
+            if len(self._line_cache) >= self.LINE_CACHE_SIZE:
+                self._line_cache.clear()
+            rows = self.rows
+            ids = self._line_cache[line] = [rows[word] for word in self.words(line) if word in rows]
+        return ids
+
+    def score_many(self, texts: list) -> list:
+        ids, starts = [], []
+        for text in texts:
+            starts.append(len(ids))
+            song_ids = [row for line in text.splitlines() for row in self.line_ids(line)]
+            ids.extend(song_ids or [self.empty_row])
+        totals = np.add.reduceat(self.counts[np.asarray(ids, dtype=np.intp)], np.asarray(starts, dtype=np.intp), axis=0) \
+            if texts else np.zeros((0, len(NRC_EMOTIONS) + 1), dtype=np.int64)
+
+        scores = np.zeros((len(texts), len(NRC_EMOTIONS)))
+        found = totals[:, -1] > 0
+        scores[found] = totals[found, :-1] / totals[found, -1:]
+        return [dict(zip(NRC_EMOTIONS, row)) for row in scores.tolist()]
+
+class BatchSentimentEngine:
+    """ Scores songs in chunks with FastVaderAnalyzer and NRCScorer, producing the same
+        {"vader": ..., "nrc": ...} documents as sentiment_analysis.update_song_with_sentiment.
+        With processes > 1 the chunks are spread over a process pool, each process builds the lexicons once."""
+
+    def __init__(self, processes: int = None, chunk_size: int = None, batch_size: int = None):
+        self.processes = processes or settings.SENTIMENT_PROCESSES
+        self.chunk_size = chunk_size or settings.SENTIMENT_CHUNK_SIZE
+        self.batch_size = batch_size or settings.MONGO_BATCH_SIZE
+        self.logger = logging.getLogger(__name__)
+        self._vader = None
+        self._nrc = None
+
+    def score_many(self, texts: list) -> list:
+        if self._vader is None:
+            self._vader, self._nrc = registry.get('fast_vader_analyzer'), registry.get('nrc_scorer')
+        texts = [text or "" for text in texts]
+        return [{"vader": self._vader.polarity_scores(text), "nrc": nrc}
+                for text, nrc in zip(texts, self._nrc.score_many(texts))]
+
+    def score(self, text: str) -> dict:
+        return self.score_many([text])[0]
+
+    def _chunks(self, songs):
+        songs = iter(songs)
+        while True:
+            chunk = list(itertools.islice(songs, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def score_songs(self, songs):
+        """ Yields (song, sentiment) for an iterable of {"_id", "lyrics"} documents, chunk by chunk."""
+        if self.processes <= 1:
+            for chunk in self._chunks(songs):
+                with metrics.timer('sentiment_chunk_seconds'):
+                    scores = self.score_many([song.get("lyrics") for song in chunk])
+                metrics.inc('songs_scored_total', len(chunk))
+                yield from zip(chunk, scores)
+            return
+        with ProcessPoolExecutor(max_workers=self.processes, initializer=_init_worker) as pool:
+            pending = []
+            for chunk in self._chunks(songs):
+                pending.append((chunk, pool.submit(_score_chunk, [song.get("lyrics") for song in chunk])))
+                # Keeps a couple of chunks per process queued so the cursor never runs far ahead of the pool
+                if len(pending) >= self.processes * 2:
+                    chunk, future = pending.pop(0)
+                    metrics.inc('songs_scored_total', len(chunk))
+                    yield from zip(chunk, future.result())
+            for chunk, future in pending:
+                metrics.inc('songs_scored_total', len(chunk))
+                yield from zip(chunk, future.result())
+
+    @staticmethod
+    def stale_filter() -> dict:
+        """ Songs whose stored sentiment is missing, from another analyzer version, or from other lyrics.
+            Songs are flagged when their lyrics are written and unflagged with their sentiment, so this is
+            an index lookup. Run mark_stale first, it flags what a new SENTIMENT_VERSION made stale."""
+        return {"sentiment_stale": True}
+
+    @staticmethod
+    def mark_stale(collection) -> int:
+        """ Flags the songs stale_filter misses: scored by another SENTIMENT_VERSION, or stored before songs
+            carried the flag. A full scan, so it only runs once per SENTIMENT_VERSION.
+            :return: Number of songs flagged."""
+        collection.create_index("sentiment_stale", partialFilterExpression={"sentiment_stale": True})
+        state = collection.database[settings.STATE_COLLECTION]
+        key = f"{collection.name}.sentiment_version"
+        if state.find_one({"_id": key, "version": SENTIMENT_VERSION}):
+            return 0
+        flagged = collection.update_many({"sentiment_stale": {"$ne": True}, "$or": [
+            {"sentiment_version": {"$ne": SENTIMENT_VERSION}},
+            {"sentiment_hash": {"$exists": False}},
+            {"lyrics_hash": {"$exists": False}}, # Stored before songs carried a hash, checked client side
+            {"$expr": {"$ne": ["$sentiment_hash", "$lyrics_hash"]}},
+        ]}, {"$set": {"sentiment_stale": True}}).modified_count
+        state.update_one({"_id": key}, {"$set": {"version": SENTIMENT_VERSION}}, upsert=True)
+        logger.info(f'{flagged} songs flagged for rescoring with {SENTIMENT_VERSION}')
+        return flagged
+
+    def _unscored(self, songs, writer: "SentimentWriter"):
+        # Songs from before lyrics_hash existed whose sentiment already matches their lyrics only get the hash
+        for song in songs:
+            song["lyrics"] = song_lyrics(song)
+            digest = lyrics_hash(song["lyrics"])
+            if "lyrics_hash" not in song and song.get("sentiment_hash") == digest \
+                    and song.get("sentiment_version") == SENTIMENT_VERSION:
+                writer.add(song["_id"], {"lyrics_hash": digest, "sentiment_stale": False}, match={"lyrics_hash": None})
+                continue
+            yield song
+
+    def update_collection(self, collection, query: dict = None, incremental: bool = False) -> int:
+        """ Scores every song matching query and writes the results back with batched bulk_write.
+            With incremental, only songs matching stale_filter are read, so a run costs time
+            in proportion to the new and changed songs rather than the whole collection.
+            :return: Number of songs updated."""
+        query = without_linked(query)
+        if incremental:
+            self.mark_stale(collection)
+            query = {"$and": [query, self.stale_filter()]}
+        cursor = collection.find(query, {"lyrics": 1, "lyrics_hash": 1, "sentiment_hash": 1, "sentiment_version": 1},
+                                 batch_size=self.chunk_size)
+        with SentimentWriter(collection, self.batch_size) as writer:
+            for song, sentiment in self.score_songs(self._unscored(cursor, writer)):
+                writer.add(song["_id"], *scored_update(song, sentiment))
+        self.logger.info(f'Sentiment written for {writer.written} songs')
+        return writer.written
+
+def sentiment_fields(sentiment: dict, digest: str) -> dict:
+    # What a song stores next to its sentiment, so incremental runs can tell whether it is still current
+    return {"sentiment": stored_sentiment(sentiment), "sentiment_hash": digest, "sentiment_version": SENTIMENT_VERSION,
+            "sentiment_stale": False, "rollup_stale": True}
+
+def scored_update(song: dict, sentiment: dict) -> tuple:
+    """ (fields, match) that store the sentiment of a song as read, with its lyrics. The update only applies while the
+        song still has the lyrics it was scored from: lyrics stored in between keep their hash and stale flag.
+        Songs from before lyrics_hash existed get it here."""
+    digest = lyrics_hash(song.get("lyrics"))
+    fields = sentiment_fields(sentiment, digest)
+    if song.get("lyrics_hash") is None:
+        fields["lyrics_hash"] = digest
+    return fields, {"lyrics_hash": song.get("lyrics_hash")}
+
+class SentimentWriter:
+    """ Buffers $set updates by _id and writes them as unordered bulk_write batches.
+        match narrows an update to a song still in the state it was read in."""
+
+    def __init__(self, collection, batch_size: int = None):
+        self.collection = collection
+        self.batch_size = batch_size or settings.MONGO_BATCH_SIZE
+        self.ops = []
+        self.written = 0
+        self.logger = logging.getLogger(__name__)
+
+    def add(self, song_id, fields: dict, match: dict = None):
+        self.ops.append(UpdateOne({"_id": song_id, **(match or {})}, {"$set": fields}))
+        if len(self.ops) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.ops:
+            return
+        ops, self.ops = self.ops, []
+        written = self.written
+        try:
+            with metrics.timer('mongo_write_seconds', collection=self.collection.name, op='update'):
+                self.written += self.collection.bulk_write(ops, ordered=False).matched_count
+        except BulkWriteError as e:
+            self.written += e.details.get('nMatched', 0)
+            self.logger.error(f"{len(e.details.get('writeErrors', []))} sentiment updates failed in a batch")
+        metrics.inc('documents_updated_total', self.written - written, collection=self.collection.name)
+        self.logger.debug(f'{self.written} songs scored')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+# Process pool workers keep one engine each, built by the initializer instead of once per chunk
+_worker_engine = None
+
+def _init_worker():
+    global _worker_engine
+    _worker_engine = BatchSentimentEngine(processes=1)
+
+def _score_chunk(texts: list) -> list:
+    return _worker_engine.score_many(texts)
@@ -0,0 +1,195 @@
+# scripts/sentiment_rollups.py
+
+from pymongo import UpdateOne
+from config import settings
+from scripts.upload_to_mongodb import songs_collection
+from scripts.sentiment_engine import NRC_EMOTIONS, SentimentWriter
+from scripts.compact_storage import song_sentiment, uses_compact_storage
+from datetime import datetime, timezone
+import argparse
+import logging
+
+# Summary collection per level, and the song fields its rows are grouped by
+LEVELS = {
+    'album': ('artist', 'album'),
+    'artist': ('artist',),
+    'year': ('release_year',),
+}
+GROUP_FIELDS = ('artist', 'album', 'release_year')
+
+logger = logging.getLogger(__name__)
+
+def rollup_collection(level: str, database=None):
+    # album_sentiment, artist_sentiment, year_sentiment, next to the songs collection by default
+    return (database if database is not None else songs_collection().database)[f'{level}_sentiment']
+
+def stale_filter() -> dict:
+    """ Songs whose sentiment changed since they were last counted in the rollups, or never were.
+        New songs and sentiment_fields set rollup_stale, counting the song clears it, so this is an index lookup.
+        rollup_groups is the song's artist, album and release_year when it was counted. Moving a song without
+        rescoring it isn't noticed until the next --full refresh."""
+    return {"rollup_stale": True}
+
+def mark_stale(collection) -> int:
+    """ Flags the songs stored before rollup_stale existed that were never counted, or were rescored since:
+        rollup_hash is the sentiment_hash a song had when counted. A full scan, run once per collection."""
+    state = collection.database[settings.STATE_COLLECTION]
+    key = f"{collection.name}.rollup_stale"
+    if state.find_one({"_id": key}):
+        return 0
+    flagged = collection.update_many({"rollup_stale": {"$exists": False}, "$or": [
+        {"rollup_hash": {"$exists": False}},
+        {"$and": [{"sentiment_hash": {"$exists": True}}, {"$expr": {"$ne": ["$rollup_hash", "$sentiment_hash"]}}]},
+    ]}, {"$set": {"rollup_stale": True}}).modified_count
+    state.update_one({"_id": key}, {"$set": {"marked_at": datetime.now(timezone.utc)}}, upsert=True)
+    return flagged
+
+def ensure_indexes(collection):
+    # Created with the first build and by --full, a per-song or incremental refresh never pays for them
+    collection.create_index('release_year')
+    collection.create_index('rollup_stale', partialFilterExpression={'rollup_stale': True})
+    for level, fields in LEVELS.items():
+        rollup_collection(level, collection.database).create_index(fields[0])
+
+def _pipeline(fields: tuple, match: dict = None) -> list:
+    # Summaries are computed by the server, only one row per group comes back
+    group = {
+        '_id': {field: f'${field}' for field in fields},
+        'songs': {'$sum': 1},
+        'scored': {'$sum': {'$cond': [{'$ifNull': ['$sentiment_hash', False]}, 1, 0]}},
+        'compound_mean': {'$avg': '$compound'},
+        'compound_square_mean': {'$avg': '$compound_square'},
+    }
+    group.update((f'nrc_{emotion}', {'$avg': f'$sentiment.nrc.{emotion}'}) for emotion in NRC_EMOTIONS)
+    project = {field: 1 for field in fields}
+    project.update(sentiment_hash=1, **{f'sentiment.nrc.{emotion}': 1 for emotion in NRC_EMOTIONS})
+    project.update(compound='$sentiment.vader.compound',
+                   compound_square={'$multiply': ['$sentiment.vader.compound', '$sentiment.vader.compound']})
+    return ([{'$match': match}] if match else []) + [{'$project': project}, {'$group': group}]
+
+def _packed_rows(collection, fields: tuple, match: dict = None):
+    """ The rows of _pipeline's $group, summed here: packed sentiment is binary the server can't average.
+        Each song sends 48 bytes of it, so the pass stays cheap."""
+    groups = {}
+    projection = {**{field: 1 for field in fields}, 'sentiment': 1, 'sentiment_hash': 1}
+    for song in collection.find(match or {}, projection):
+        key = tuple(song.get(field) for field in fields)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {'_id': {field: song[field] for field in fields if field in song}, 'songs': 0, 'scored': 0,
+                                   'sums': {}, 'counts': {}}
+        group['songs'] += 1
+        group['scored'] += 1 if song.get('sentiment_hash') else 0
+        sentiment = song_sentiment(song) or {}
+        compound = (sentiment.get('vader') or {}).get('compound')
+        values = {f'nrc_{emotion}': value for emotion, value in (sentiment.get('nrc') or {}).items()}
+        if compound is not None:
+            values.update(compound_mean=compound, compound_square_mean=compound * compound)
+        for name, value in values.items():
+            group['sums'][name] = group['sums'].get(name, 0.0) + value
+            group['counts'][name] = group['counts'].get(name, 0) + 1
+    for group in groups.values():
+        sums, counts = group.pop('sums'), group.pop('counts')
+        # $avg skips songs without the field and is null for a group where none has it
+        for name in ('compound_mean', 'compound_square_mean', *(f'nrc_{emotion}' for emotion in NRC_EMOTIONS)):
+            group[name] = sums[name] / counts[name] if counts.get(name) else None
+        yield group
+
+def _summary(row: dict) -> dict:
+    mean, square_mean = row['compound_mean'], row['compound_square_mean']
+    summary = dict(row['_id'])
+    summary.update(songs=row['songs'], scored=row['scored'], updated_at=datetime.now(timezone.utc))
+    # Population variance from E[x^2] - E[x]^2, clamped against rounding
+    summary['vader_compound'] = {'mean': mean, 'variance': None if mean is None else max(square_mean - mean * mean, 0.0)}
+    summary['nrc'] = {emotion: row[f'nrc_{emotion}'] for emotion in NRC_EMOTIONS}
+    return summary
+
+def _match(fields: tuple, keys: set) -> dict:
+    # Every song of the given groups (a superset for multi-field keys, recomputing extra groups is harmless)
+    return {field: {'$in': sorted({key[i] for key in keys}, key=str)} for i, field in enumerate(fields)}
+
+def refresh_level(level: str, keys: set = None, collection=None, batch_size: int = 1000) -> int:
+    """ Recomputes the given groups of one level (every group when keys is None) and upserts them,
+        groups left without songs are deleted. :return: Number of rows written."""
+    collection = collection if collection is not None else songs_collection()
+    fields, target = LEVELS[level], rollup_collection(level, collection.database)
+    if keys is not None and not keys:
+        return 0
+    ops, seen = [], set()
+    match = _match(fields, keys) if keys is not None else None
+    rows = _packed_rows(collection, fields, match) if uses_compact_storage(collection.database) else collection.aggregate(_pipeline(fields, match))
+    for row in rows:
+        key = tuple(row['_id'].get(field) for field in fields)
+        seen.add(key)
+        ops.append(UpdateOne({'_id': row['_id']}, {'$set': _summary(row)}, upsert=True))
+        if len(ops) >= batch_size:
+            target.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        target.bulk_write(ops, ordered=False)
+    # Groups whose last song moved away or was deleted
+    if keys is None:
+        gone = [row['_id'] for row in target.find({}, {'_id': 1}) if tuple(row['_id'].get(f) for f in fields) not in seen]
+    else:
+        gone = [dict(zip(fields, key)) for key in keys - seen]
+    if gone:
+        target.delete_many({'_id': {'$in': gone}})
+    return len(seen)
+
+def _mark_expression() -> dict:
+    # What a song is marked with once counted, evaluated by the server from the song's own fields
+    return {'rollup_hash': {'$ifNull': ['$sentiment_hash', '']}, 'rollup_stale': False,
+            'rollup_groups': {field: f'${field}' for field in GROUP_FIELDS}}
+
+def refresh_rollups(collection=None, query: dict = None, full: bool = False) -> int:
+    """
+    Brings album_sentiment, artist_sentiment and year_sentiment up to date with the songs collection.
+    Only the groups of songs matching stale_filter (and query) are recomputed, unless full or
+    no rollups were built yet. Scoring many songs then refreshing once recomputes each group once.
+    :return: Number of songs whose sentiment was newly counted.
+    """
+    collection = collection if collection is not None else songs_collection()
+    if query is None and not rollup_collection('album', collection.database).estimated_document_count():
+        full = True
+    if full:
+        ensure_indexes(collection)
+        # Every song is marked in one server-side update first, a song rescored while the groups are recomputed
+        # is flagged again and picked up by the next run
+        collection.update_many({}, [{'$set': _mark_expression()}])
+        mark_stale(collection) # Nothing left to flag, only recorded
+        for level in LEVELS:
+            logger.info(f'{refresh_level(level, None, collection)} {level} rollups refreshed')
+        return collection.count_documents({})
+
+    mark_stale(collection)
+    query = {'$and': [query, stale_filter()]} if query else stale_filter()
+    keys = {level: set() for level in LEVELS}
+    with SentimentWriter(collection) as writer:
+        marks = []
+        projection = {**{field: 1 for field in GROUP_FIELDS}, 'sentiment_hash': 1, 'sentiment_version': 1, 'rollup_groups': 1}
+        for song in collection.find(query, projection):
+            # The groups the song was counted in last time are refreshed too, in case it moved
+            for groups in (song, song.get('rollup_groups') or {}):
+                for level, fields in LEVELS.items():
+                    if groups:
+                        keys[level].add(tuple(groups.get(field) for field in fields))
+            marks.append((song['_id'], {'sentiment_hash': song.get('sentiment_hash'), 'sentiment_version': song.get('sentiment_version')},
+                          {'rollup_hash': song.get('sentiment_hash') or '', 'rollup_stale': False,
+                           'rollup_groups': {field: song[field] for field in GROUP_FIELDS if field in song}}))
+        for level in LEVELS:
+            logger.info(f'{refresh_level(level, keys[level], collection)} {level} rollups refreshed')
+        # Marked only once the rollups are written, a song rescored in the meantime keeps its flag
+        for song_id, scored, fields in marks:
+            writer.add(song_id, fields, match=scored)
+    return len(marks)
+
+def get_rollups(level: str, query: dict = None) -> list:
+    """ Precomputed summaries of a level, e.g. get_rollups('album', {'artist': 'All Time Low'})."""
+    return list(rollup_collection(level).find(query or {}, {'_id': 0}))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Refresh the album, artist and year sentiment summaries")
+    parser.add_argument('--full', action='store_true', help="Recompute every group, not only those with changed songs")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(f"Rollups refreshed for {refresh_rollups(full=args.full)} songs.")
@@ -0,0 +1,107 @@
+# scripts/services.py
+
+from contextlib import contextmanager
+from config import settings
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ServiceRegistry:
+    """ Shared, expensive objects (the MongoDB client, analyzers, lexicons) built on first use and cached per process.
+        Importing a module that needs one costs nothing, the connection or the lexicon load happens
+        the first time a command actually asks for it."""
+
+    def __init__(self):
+        self._factories = {}
+        self._instances = {}
+        # Reentrant, factories get the services they are built from
+        self._lock = threading.RLock()
+
+    def register(self, name: str, factory):
+        with self._lock:
+            self._factories[name] = factory
+            self._instances.pop(name, None)
+
+    def get(self, name: str):
+        try:
+            return self._instances[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._instances:
+                if name not in self._factories:
+                    raise KeyError(f'Unknown service {name!r}')
+                logger.debug(f'Creating service {name}')
+                self._instances[name] = self._factories[name]()
+            return self._instances[name]
+
+    def created(self) -> list:
+        # Services built so far in this process
+        return list(self._instances)
+
+    @contextmanager
+    def override(self, **instances):
+        """ Swaps in the given instances (e.g. a mongomock database) for the duration of the block.
+            Everything else is rebuilt from them on demand, so overriding 'db' also redirects every collection."""
+        with self._lock:
+            saved = self._instances
+            self._instances = dict(instances)
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._instances = saved
+
+    def reset(self):
+        # Drops every cached instance, e.g. in a child process that must not reuse its parent's MongoClient
+        with self._lock:
+            self._instances = {}
+
+registry = ServiceRegistry()
+
+def _mongo_client():
+    from pymongo import MongoClient
+    return MongoClient(settings.MONGO_URI)
+
+def _vader_analyzer():
+    from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+    return SentimentIntensityAnalyzer() # Contains txt files with scores for different character combinations
+
+def _fast_vader_analyzer():
+    from scripts.sentiment_engine import FastVaderAnalyzer
+    return FastVaderAnalyzer()
+
+def _nrc_scorer():
+    from scripts.sentiment_engine import NRCScorer
+    return NRCScorer()
+
+def _punkt():
+    # NRCLex tokenizes through TextBlob, which needs nltk's punkt models, only downloaded when missing
+    import nltk
+    for resource in settings.NLTK_RESOURCES:
+        try:
+            nltk.data.find(f'tokenizers/{resource}')
+        except LookupError:
+            nltk.download(resource, quiet=True)
+    return True
+
+def _slug_index():
+    from scripts.slug_index import SlugIndex
+    return SlugIndex()
+
+def _lyrics_codec():
+    from scripts.compact_storage import LyricsCodec
+    return LyricsCodec()
+
+registry.register('mongo_client', _mongo_client)
+registry.register('db', lambda: registry.get('mongo_client')[settings.MONGO_DB])
+registry.register('artists_collection', lambda: registry.get('db').artists)
+registry.register('albums_collection', lambda: registry.get('db').albums)
+registry.register('songs_collection', lambda: registry.get('db').songs)
+registry.register('vader_analyzer', _vader_analyzer)
+registry.register('fast_vader_analyzer', _fast_vader_analyzer)
+registry.register('nrc_scorer', _nrc_scorer)
+registry.register('punkt', _punkt)
+registry.register('slug_index', _slug_index)
+registry.register('lyrics_codec', _lyrics_codec)
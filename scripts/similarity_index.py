@@ -0,0 +1,186 @@
+# scripts/similarity_index.py
+
+from config import settings
+from scripts.generate_embeddings import EmbeddingStore
+import numpy as np
+import logging
+import json
+import os
+
+class IVFIndex:
+    """ Inverted-file index over the unit vectors of an EmbeddingStore, for "songs like this one" in milliseconds.
+        k-means splits the vectors into nlist clusters, a query only scores the songs in its nprobe closest clusters.
+        Files in the store's ivf/ directory:
+            centroids.npy        - (nlist, dim) cluster centres
+            offsets.npy, ids.npy - CSR lists: the store rows of cluster c are ids[offsets[c]:offsets[c + 1]]
+            appended.i64         - (row, cluster) pairs added since the last build, so inserts never rewrite the lists
+            meta.json            - rows covered, rows the centroids were trained on
+        Everything is loaded memory-mapped. Rows are scored against the store's current vectors, a song whose lyrics
+        changed stays in its old cluster until the next build, which happens once the store doubled since training."""
+
+    def __init__(self, store: EmbeddingStore, directory: str = None, nlist: int = None, nprobe: int = None):
+        self.store = store
+        self.directory = directory or os.path.join(store.directory, 'ivf')
+        self.nlist = nlist or settings.ANN_NLIST
+        self.nprobe = nprobe or settings.ANN_NPROBE
+        self.logger = logging.getLogger(__name__)
+        self.meta = None
+        self._load()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        if not os.path.exists(self._path('meta.json')):
+            return
+        with open(self._path('meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.centroids = np.load(self._path('centroids.npy'), mmap_mode='r')
+        self.offsets = np.load(self._path('offsets.npy'), mmap_mode='r')
+        self.ids = np.load(self._path('ids.npy'), mmap_mode='r')
+        self._load_appended()
+
+    def _load_appended(self):
+        path = self._path('appended.i64')
+        appended = np.fromfile(path, dtype=np.int64).reshape(-1, 2) if os.path.exists(path) else np.empty((0, 2), np.int64)
+        self.appended_rows, self.appended_lists = appended[:, 0], appended[:, 1]
+
+    @property
+    def built(self) -> bool:
+        return self.meta is not None
+
+    def _assign(self, vectors: np.ndarray, centroids: np.ndarray, chunk: int = 8192) -> np.ndarray:
+        # Nearest centroid by inner product, in chunks so a memory-mapped corpus is never loaded at once
+        lists = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk):
+            lists[start:start + chunk] = np.argmax(np.asarray(vectors[start:start + chunk]) @ centroids.T, axis=1)
+        return lists
+
+    def _train(self, vectors: np.ndarray, nlist: int, iterations: int = 10, sample: int = 50000) -> np.ndarray:
+        # Spherical k-means on a sample, the centroids only need to be good enough to route queries
+        rng = np.random.default_rng(0)
+        rows = np.sort(rng.choice(len(vectors), size=min(sample, len(vectors)), replace=False))
+        data = np.asarray(vectors[rows], dtype=np.float32)
+        centroids = data[rng.choice(len(data), size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            lists = self._assign(data, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, lists, data)
+            counts = np.bincount(lists, minlength=nlist)
+            empty = counts == 0
+            sums[empty] = data[rng.choice(len(data), size=int(empty.sum()))] # Reseed clusters that lost every point
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.where(norms > 0, norms, 1)
+        return centroids.astype(np.float32)
+
+    def build(self):
+        """ Trains the centroids and lays out every stored vector in its cluster list."""
+        vectors = self.store.vectors()
+        if not len(vectors):
+            raise ValueError('The embedding store is empty, generate embeddings first')
+        nlist = max(1, min(self.nlist, int(np.sqrt(len(vectors)))))
+        centroids = self._train(vectors, nlist)
+        lists = self._assign(vectors, centroids)
+        order = np.argsort(lists, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=nlist))]).astype(np.int64)
+
+        os.makedirs(self.directory, exist_ok=True)
+        # Written beside the live files and swapped in, readers never see half an index
+        for name, array in (('centroids.npy', centroids), ('offsets.npy', offsets), ('ids.npy', order.astype(np.int64))):
+            with open(self._path(name + '.tmp'), 'wb') as f:
+                np.save(f, array)
+            os.replace(self._path(name + '.tmp'), self._path(name))
+        if os.path.exists(self._path('appended.i64')):
+            os.remove(self._path('appended.i64'))
+        meta = {'rows': len(vectors), 'trained_rows': len(vectors), 'nlist': nlist, 'dim': self.store.dim}
+        with open(self._path('meta.json.tmp'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(self._path('meta.json.tmp'), self._path('meta.json'))
+        self._load()
+        self.logger.info(f'Built IVF index: {len(vectors)} songs in {nlist} clusters')
+
+    def add(self, rows) -> int:
+        """ Files store rows under their nearest centroid without touching the existing lists."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return 0
+        lists = self._assign(self.store.vectors()[rows], np.asarray(self.centroids))
+        with open(self._path('appended.i64'), 'ab') as f:
+            np.column_stack([rows, lists]).astype(np.int64).tofile(f)
+        self.meta['rows'] = max(self.meta['rows'], int(rows.max()) + 1)
+        with open(self._path('meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        self._load_appended()
+        return len(rows)
+
+    def update(self) -> int:
+        """ Brings the index up to date with the store: a full build the first time or once the store has
+            doubled since the centroids were trained, otherwise only the new rows are added."""
+        if not self.built or len(self.store) >= 2 * self.meta['trained_rows'] or self.meta['dim'] != self.store.dim:
+            self.build()
+            return len(self.store)
+        return self.add(np.arange(self.meta['rows'], len(self.store)))
+
+    def search(self, vector: np.ndarray, k: int = 10, nprobe: int = None, exclude: int = None) -> list:
+        """ [(row, cosine similarity)] of the k best songs among the nprobe clusters closest to vector,
+            and among the rows stored since the index was last updated, which are all scored."""
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probe = np.argpartition(-(np.asarray(self.centroids) @ vector), nprobe - 1)[:nprobe]
+        candidates = [self.ids[self.offsets[c]:self.offsets[c + 1]] for c in probe]
+        candidates.append(self.appended_rows[np.isin(self.appended_lists, probe)])
+        candidates.append(np.arange(self.meta['rows'], len(self.store), dtype=np.int64))
+        candidates = np.unique(np.concatenate(candidates))
+        if exclude is not None:
+            candidates = candidates[candidates != exclude]
+        if not len(candidates):
+            return []
+        scores = np.asarray(self.store.vectors()[candidates]) @ vector
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(candidates[i]), float(scores[i])) for i in top]
+
+def exact_search(vectors: np.ndarray, vector: np.ndarray, k: int = 10, exclude: int = None) -> list:
+    """ Brute-force reference for IVFIndex.search, scores every stored vector."""
+    scores = np.asarray(vectors) @ vector
+    rows = np.arange(len(scores))
+    if exclude is not None:
+        rows, scores = np.delete(rows, exclude), np.delete(scores, exclude)
+    if not len(scores):
+        return []
+    top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [(int(rows[i]), float(scores[i])) for i in top]
+
+def similar_songs(artist: str, title: str, k: int = 10, nprobe: int = None) -> list:
+    """ [(artist, title, similarity)] of the k songs whose lyrics are closest to the given song.
+        Read only: songs embedded since the index was updated are scored exactly, without a store
+        that was never indexed every song is. update_index runs after uploads and generate_embeddings.
+        Empty until the first songs were embedded."""
+    try:
+        store = EmbeddingStore(read_only=True)
+    except FileNotFoundError:
+        return []
+    try:
+        row = store.row_of(artist, title)
+        if row is None:
+            raise KeyError(f'{artist} - {title} has no embedding, upload it or run generate_embeddings first')
+        index = IVFIndex(store)
+        vector = np.asarray(store.vectors()[row])
+        if index.built:
+            hits = index.search(vector, k=k, nprobe=nprobe, exclude=row)
+        else:
+            hits = exact_search(store.vectors(), vector, k=k, exclude=row)
+        songs = store.songs([hit_row for hit_row, _ in hits])
+        return [(*song, score) for song, (_, score) in zip(songs, hits)]
+    finally:
+        store.close()
+
+def update_index(store: EmbeddingStore = None) -> int:
+    # Called after new songs were embedded, see upload_to_mongodb.index_new_songs
+    owns_store = store is None
+    store = EmbeddingStore() if owns_store else store
+    try:
+        return IVFIndex(store).update()
+    finally:
+        if owns_store:
+            store.close()
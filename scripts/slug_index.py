@@ -0,0 +1,191 @@
+# scripts/slug_index.py
+
+from bs4 import BeautifulSoup
+from config import settings
+from scripts.metrics import metrics
+import threading
+import argparse
+import requests
+import logging
+import sqlite3
+import string
+import time
+import re
+import os
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artists (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    slug TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS songs (
+    artist_slug TEXT NOT NULL,
+    key TEXT NOT NULL,
+    title TEXT NOT NULL,
+    href TEXT NOT NULL,
+    PRIMARY KEY (artist_slug, key)
+);
+CREATE TABLE IF NOT EXISTS letters (
+    letter TEXT PRIMARY KEY,
+    artists INTEGER NOT NULL,
+    fetched_at REAL NOT NULL
+);
+"""
+
+# Every letter page of the artist index, artists starting with a digit or a symbol are on 19.html
+LETTERS = tuple(string.ascii_lowercase) + ('19',)
+
+ARTIST_HREF = re.compile(r'(?:^|/)(19|[a-z])/([a-z0-9]+)\.html$')
+SONG_HREF = re.compile(r'(?:^|/)(lyrics/[a-z0-9]+/[a-z0-9]+\.html)$')
+
+def name_key(name: str) -> str:
+    # What two spellings of a name have in common: lowercase letters and digits only
+    return re.sub(r'[^a-z0-9]', '', name.lower())
+
+def guess_artist_slug(name: str) -> str:
+    # AZLyrics drops a leading "The", only as a whole word so "Theory of a Deadman" keeps its letters
+    return name_key(re.sub(r'^\s*the\s+', '', name.lower()))
+
+def letter_of(slug: str) -> str:
+    return slug[0] if slug and slug[0] in string.ascii_lowercase else '19'
+
+class SlugIndex:
+    """ Persistent map of artist names to their AZLyrics slugs and of song titles to the exact hrefs their
+        discography page links to, so scrapers request URLs that exist instead of guessing them.
+        Artist slugs come from the letter index pages (a.html ... 19.html), each read once and refreshed after ttl,
+        and from every discography page fetched. SLUG_INDEX_PATH keeps them between runs; lookups are dict reads."""
+
+    def __init__(self, path: str = None, ttl: float = None):
+        self.path = path or settings.SLUG_INDEX_PATH or ':memory:'
+        self.ttl = settings.SLUG_INDEX_TTL if ttl is None else ttl
+        if self.path != ':memory:':
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.loading = threading.Lock() # One letter page fetch at a time, concurrent scrapers wait for it
+        self.failed = set() # Letter pages that couldn't be fetched this run, not retried until the next one
+        self.artists = dict(self.db.execute('SELECT key, slug FROM artists'))
+        self.songs = {(slug, key): href for slug, key, href in self.db.execute('SELECT artist_slug, key, href FROM songs')}
+        self.letters = dict(self.db.execute('SELECT letter, fetched_at FROM letters'))
+        self.logger = logging.getLogger(__name__)
+
+    def artist_slug(self, name: str) -> str:
+        # The known slug, or None. Names are looked up as written and without a leading "The"
+        return self.artists.get(name_key(name)) or self.artists.get(guess_artist_slug(name))
+
+    def song_href(self, artist: str, title: str) -> str:
+        # Path of the song page relative to the site root, e.g. lyrics/alltimelow/weightless.html, or None
+        slug = self.artist_slug(artist)
+        return self.songs.get((slug, name_key(title))) if slug else None
+
+    def add_artists(self, artists: list):
+        # [(name, slug)]
+        rows = [(name_key(name), name, slug) for name, slug in artists if name_key(name)]
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO artists (key, name, slug) VALUES (?, ?, ?)', rows)
+            self.db.commit()
+            self.artists.update((key, slug) for key, _, slug in rows)
+
+    def add_artist(self, name: str, slug: str):
+        self.add_artists([(name, slug)])
+
+    def add_songs(self, artist_slug: str, songs: list):
+        # [(title, href)], hrefs as they appear on the discography page
+        rows = []
+        for title, href in songs:
+            match = SONG_HREF.search(href.split('?')[0])
+            if match and name_key(title):
+                rows.append((artist_slug, name_key(title), title, match.group(1)))
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO songs (artist_slug, key, title, href) VALUES (?, ?, ?, ?)', rows)
+            self.db.commit()
+            self.songs.update(((slug, key), href) for slug, key, _, href in rows)
+
+    def _is_fresh(self, letter: str) -> bool:
+        fetched_at = self.letters.get(letter)
+        return letter in self.failed or (fetched_at is not None and time.time() - fetched_at < self.ttl)
+
+    def resolve(self, name: str, fetcher) -> str:
+        """
+        The artist's slug, reading the letter index page it would be listed on when the name isn't known yet
+        and that page hasn't been read within ttl. Falls back to guess_artist_slug when the page doesn't list it.
+        :param fetcher: Anything with requests.get's signature, the scraper's own so rate limits and caches apply
+        """
+        slug = self.artist_slug(name)
+        if slug:
+            return slug
+        guess = guess_artist_slug(name)
+        letters = dict.fromkeys((letter_of(guess), letter_of(name_key(name)))) # "The Academy Is..." could be under a or t
+        for letter in letters:
+            if self._is_fresh(letter):
+                continue
+            with self.loading:
+                if not self._is_fresh(letter):
+                    self.load_letter(letter, fetcher)
+            slug = self.artist_slug(name)
+            if slug:
+                return slug
+        return guess
+
+    def load_letter(self, letter: str, fetcher) -> int:
+        # Reads one letter index page into the index, :return: the number of artists it lists, None if it failed
+        url = f'{settings.AZLYRICS_BASE_URL}/{letter}.html'
+        try:
+            response = fetcher.get(url)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self.logger.warning(f'Could not read the artist index {url}: {e}')
+            metrics.inc('scrape_failures_total', page='letter')
+            self.failed.add(letter)
+            return None
+        with metrics.timer('parse_seconds', page='letter'):
+            artists = parse_letter_page(response.text, letter)
+        metrics.inc('pages_scraped_total', page='letter')
+        self.add_artists(artists)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO letters (letter, artists, fetched_at) VALUES (?, ?, ?)',
+                            (letter, len(artists), time.time()))
+            self.db.commit()
+            self.letters[letter] = time.time()
+        self.logger.info(f'Indexed {len(artists)} artists from {url}')
+        return len(artists)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def parse_letter_page(html: str, letter: str) -> list:
+    # [(name, slug)] for every artist link on a letter page, the site navigation links to other letters are left out
+    dom = BeautifulSoup(html, 'html.parser')
+    artists = []
+    for link in dom.find_all('a', href=True):
+        match = ARTIST_HREF.search(link['href'])
+        name = re.sub(r'^(.+),\s*the$', r'The \1', link.get_text(strip=True), flags=re.IGNORECASE) # "ACADEMY IS..., THE"
+        if match and match.group(1) == letter and name:
+            artists.append((name, match.group(2)))
+    return artists
+
+if __name__ == '__main__':
+    from scripts.fetch_engine import FetchEngine
+    from scripts.services import registry
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Read AZLyrics letter index pages into the slug index")
+    parser.add_argument('letters', nargs='*', default=LETTERS, help="Letter pages to read, default all of them")
+    parser.add_argument('--lookup', type=str, help="Print the slug and known songs of an artist instead")
+    args = parser.parse_args()
+
+    index = registry.get('slug_index')
+    if args.lookup:
+        slug = index.artist_slug(args.lookup)
+        print(slug or f'{args.lookup} is not indexed, it would be guessed as {guess_artist_slug(args.lookup)}')
+        for (artist_slug, _), href in sorted(index.songs.items()):
+            if artist_slug == slug:
+                print(f'  {href}')
+    else:
+        with FetchEngine(max_workers=1) as engine: # Rate limited like any scrape
+            for letter in args.letters:
+                count = index.load_letter(letter, engine)
+                print(f'{letter}: {"failed" if count is None else f"{count} artists"}')
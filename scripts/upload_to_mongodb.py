@@ -1,106 +1,337 @@
 # scripts/upload_to_mongodb.py
 
-from pymongo import MongoClient
+from pymongo import UpdateOne, ASCENDING
+from pymongo.errors import BulkWriteError, OperationFailure
+from config import settings
+from scripts.services import registry
 import os
 from scripts.scrape_lyrics import AZLyrics
+from scripts.fetch_engine import FetchEngine
+from scripts.http_transport import HttpTransport, get_transport
+from scripts.metrics import metrics
+from scripts.compact_storage import stored_lyrics
 import json
+import hashlib
+import itertools
+import threading
 import logging
-import time
-import random
-
-def random_delay(min_delay=3, max_delay=15):
-    delay = random.uniform(min_delay, max_delay)
-    time.sleep(delay)
 
 # TODO: When script ran, the artist name was added, but the Albums array was empty
 
 logger = logging.getLogger(__name__)
 
-# Connect to MongoDB Client
-client = MongoClient("mongodb://localhost:27017/")
+# MongoDB operates on a lazy creation model, and so does this module: the client for the
+# "lyrical_analysis_db" database (settings.MONGO_URI / MONGO_DB) is only created by the first
+# command that reads or writes a collection
+def artists_collection():
+    return registry.get('artists_collection')
 
-# MongoDB operates on a lazy creation model, which will only connect
-# if the database doesn't exist already
+def songs_collection():
+    return registry.get('songs_collection')
 
-# Connect to database called "lyrical_analysis_db"
-db = client.lyrical_analysis_db
+def albums_collection():
+    return registry.get('albums_collection')
 
-# Connect to collections within the database
-artists_collection = db.artists
-songs_collection = db.songs
-albums_collection = db.albums
+def ensure_indexes():
+    # Unique keys turn every existence check and upsert into an index lookup instead of a collection scan
+    for collection, keys in ((songs_collection(), [('artist', ASCENDING), ('title', ASCENDING)]),
+                             (albums_collection(), [('artist', ASCENDING), ('title', ASCENDING)]),
+                             (artists_collection(), [('name', ASCENDING)])):
+        try:
+            collection.create_index(keys, unique=True)
+        except OperationFailure as e: # Usually duplicates left over from before the index existed
+            logger.error(f"Could not create unique index on {collection.name}: {e}")
 
-def add_artist_to_db(artist_file, num_albums:int = None, album_title: str = None):
-    """
-    Adds an artist, albums, and songs to the MongoDB collections from a file.
-    :param artist_file: Path to the artist's file containing album and song info.
-    :param num_albums: Optionally limit to the top n albums.
-    :param album_title: Optionally specify a single album to add.
-    """
+# Near-duplicates linked to their canonical song are stored without lyrics, there is nothing to score, embed or index
+LINKED_DUPLICATE = {'duplicate_of': {'$exists': True}, 'lyrics': {'$exists': False}}
 
-    # Load artist data from input file
-    artist_name = os.path.basename(artist_file).replace('.json','')
+def without_linked(query: dict = None) -> dict:
+    return {'$and': [query, {'$nor': [LINKED_DUPLICATE]}]} if query else {'$nor': [LINKED_DUPLICATE]}
 
-    with open(artist_file, 'r', encoding='utf-8') as f:
-        artist_data = json.load(f)
+def _existing_titles(collection, artist_name: str) -> set:
+    # One query for every title the artist already has, instead of a find_one per album or song
+    return {doc['title'] for doc in collection.find({'artist': artist_name}, {'title': 1, '_id': 0})}
+
+class BulkUpserter:
+    """ Buffers documents keyed on (artist, title) and writes them as unordered bulk_write upserts, batch_size at a time.
+        $setOnInsert keeps whatever is already stored, so re-running an artist never overwrites songs."""
+
+    def __init__(self, collection, batch_size: int = None):
+        self.collection = collection
+        self.batch_size = batch_size or settings.MONGO_BATCH_SIZE
+        self.ops = []
+        self.keys = []
+        self.written = 0
+        self.failed = 0 # Songs that couldn't be written, not counting keys another process upserted first
+        self.refused = [] # (artist, title) of those songs
 
-    albums_to_add = []
-    
+    def add(self, doc: dict):
+        self.ops.append(UpdateOne({'artist': doc['artist'], 'title': doc['title']}, {'$setOnInsert': doc}, upsert=True))
+        self.keys.append((doc['artist'], doc['title']))
+        if len(self.ops) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.ops:
+            return
+        ops, self.ops = self.ops, []
+        keys, self.keys = self.keys, []
+        written = self.written
+        try:
+            with metrics.timer('mongo_write_seconds', collection=self.collection.name, op='bulk_write'):
+                result = self.collection.bulk_write(ops, ordered=False)
+            self.written += result.upserted_count
+        except BulkWriteError as e: # Another process upserted the same key first, the rest of the batch still went in
+            self.written += e.details.get('nUpserted', 0)
+            refused = [keys[error['index']] for error in e.details.get('writeErrors', []) if error.get('code') != 11000]
+            self.failed += len(refused)
+            self.refused.extend(refused)
+            logger.error(f"{len(e.details.get('writeErrors', []))} writes failed in a batch for {self.collection.name}")
+        metrics.inc('documents_written_total', self.written - written, collection=self.collection.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+def _scrape_song(engine: FetchEngine, artist_name: str, song: str):
+    # Runs on an engine worker thread, the engine spaces the requests so less chance of website blocking IP
+    azlyrics = AZLyrics(artist=artist_name, song=song, fetcher=engine)
+    return azlyrics.open_url()
+
+def select_albums(artist_name: str, artist_data: list, num_albums: int = None, album_title: str = None) -> list:
     # If album_title is provided, only add that album
     if album_title:
-        logger.info("Album: {album_title} provided.")
+        logger.info(f"Album: {album_title} provided.")
         albums_to_add = [album for album in artist_data if album['title'] == album_title]
         if not albums_to_add:
             logger.error(f"ERROR: Album '{album_title}' not found for {artist_name}.")
-            return
-    else:
-        albums_to_add = artist_data[:num_albums] if num_albums else artist_data
-        logger.info(f"Adding top {num_albums if num_albums else 'all'} albums from {artist_name}'s discography.")
+            return None
+        return albums_to_add
+    logger.info(f"Adding top {num_albums if num_albums else 'all'} albums from {artist_name}'s discography.")
+    return artist_data[:num_albums] if num_albums else artist_data
 
-        # Add artist to DB if not already present
-    if not artists_collection.find_one({'name': artist_name}):
+def add_artist_and_albums(artist_name: str, albums_to_add: list, bulk: bool = False, batch_size: int = None) -> dict:
+    """
+    Adds the artist and its albums, and works out which songs still need scraping.
+    :return: {song title: (album title, release year)} for every song not stored yet.
+    """
+    # Add artist to DB if not already present
+    if not artists_collection().find_one({'name': artist_name}):
         artist_doc = {
             'name': artist_name,
             'albums': [album['title'] for album in albums_to_add]
         }
-        artists_collection.insert_one(artist_doc)
+        artists_collection().insert_one(artist_doc)
+
+    if bulk:
+        ensure_indexes()
+    existing_albums = _existing_titles(albums_collection(), artist_name)
+    existing_songs = _existing_titles(songs_collection(), artist_name)
 
-    # Loop through albums and add them to the 'albums' collection
+    # Loop through albums and add them to the 'albums' collection, collecting the songs that still need scraping
+    album_writer = BulkUpserter(albums_collection(), batch_size) if bulk else None
+    songs_to_scrape = {}
     for album in albums_to_add:
         album_title = album['title']
         release_year = album.get('release_year', 'Unknown')  # Extract release year if available
         
         # Add album to MongoDB if not already present
-        if not albums_collection.find_one({'title': album_title, 'artist': artist_name}):
+        if album_title not in existing_albums:
             album_doc = {
                 'title': album_title,
                 'artist': artist_name,
                 'release_year': release_year,
                 'songs': album.get('songs', [])
             }
-            albums_collection.insert_one(album_doc)
+            if album_writer:
+                album_writer.add(album_doc)
+            else:
+                albums_collection().insert_one(album_doc)
+            existing_albums.add(album_title)
 
-        # Loop through songs in the album and add them to the 'songs' collection
+        # A song listed on several albums is kept under the first one, same as the old serial loop
         for song in album.get('songs', []):
-            try:
-                if not songs_collection.find_one({'title': song, 'artist': artist_name}):
-                    random_delay() # Randomizes the requests so that less chance of website blocking IP
-                    # Use the AZLyrics class to scrape extra info if needed (e.g., lyrics, genre)
-                    azlyrics = AZLyrics(artist=artist_name, song=song)
-                    lyrics, genre, _, writers = azlyrics.open_url()
-
-                    song_doc = {
-                        'title': song,
-                        'artist': artist_name,
-                        'album': album_title,
-                        'release_year': release_year,
-                        'lyrics': lyrics,
-                        'genre': genre,
-                        'writers': writers
-                    }
-                    songs_collection.insert_one(song_doc)
-            except Exception as e:
-                logger.error(f"An error occurred while processing the song '{song}': {e}")
-                print(f"Skipping song '{song}' due to an error.")
+            if song not in songs_to_scrape and song not in existing_songs:
+                songs_to_scrape[song] = (album_title, release_year)
+    if album_writer:
+        album_writer.flush()
+    return songs_to_scrape
+
+def lyrics_hash(lyrics: str) -> str:
+    # Stored next to the lyrics so derived data (sentiment) can tell when it was computed from other lyrics
+    return hashlib.sha256((lyrics or '').encode('utf-8')).hexdigest()
+
+def make_song_doc(artist_name: str, song: str, album_title: str, release_year: str, result: tuple) -> dict:
+    # result is what AZLyrics.open_url returns
+    lyrics, genre, _, writers = result
+    return {
+        'title': song,
+        'artist': artist_name,
+        'album': album_title,
+        'release_year': release_year,
+        'lyrics': stored_lyrics(lyrics),
+        'lyrics_hash': lyrics_hash(lyrics),
+        'sentiment_stale': True, # Cleared once the sentiment is scored from these lyrics
+        'rollup_stale': True,    # Cleared once the song is counted in the album, artist and year rollups
+        'genre': genre,
+        'writers': writers
+    }
+
+def scrape_songs(engine: FetchEngine, artist_name: str, songs_to_scrape: dict, max_pending: int = None):
+    """
+    Scrapes songs concurrently on the engine and yields a song document for each one as soon as it arrives.
+    Songs that fail are logged and skipped. At most max_pending songs are in flight at once.
+    """
+    scrape = lambda song: _scrape_song(engine, artist_name, song)
+    for song, future in engine.imap_unordered(scrape, songs_to_scrape, max_pending=max_pending):
+        album_title, release_year = songs_to_scrape[song]
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"An error occurred while processing the song '{song}': {e}")
+            print(f"Skipping song '{song}' due to an error.")
+            continue
+        if result is None:
+            logger.error(f"Could not retrieve lyrics for the song '{song}'")
+            print(f"Skipping song '{song}' due to an error.")
+            continue
+        yield make_song_doc(artist_name, song, album_title, release_year, result)
+
+def plan_duplicates(artist_name: str, songs_to_scrape: dict, skip_duplicates: bool = None, link_duplicates: bool = None) -> tuple:
+    """
+    Near-duplicate handling of an upload with DEDUP_ON_UPLOAD, shared by every ingest path.
+    Takes the songs that won't be fetched (skip_duplicates) and the titles with a version suffix out of songs_to_scrape.
+    :return: (detector to check each scraped song with or None, linked song docs to store instead of skipped songs,
+              {version title: (album, release_year)} to scrape after the rest so originals become the canonical songs)
+    """
+    if not settings.DEDUP_ON_UPLOAD:
+        return None, [], {}
+    from scripts.near_duplicates import DuplicateDetector, is_version, linked_song_doc
+    skip_duplicates = settings.DEDUP_SKIP_TITLES if skip_duplicates is None else skip_duplicates
+    link_duplicates = settings.DEDUP_LINK if link_duplicates is None else link_duplicates
+    detector, linked = DuplicateDetector.load(artist_name), []
+    if skip_duplicates:
+        skipped = detector.likely_duplicates(list(songs_to_scrape))
+        for song, canonical in skipped.items():
+            album, release_year = songs_to_scrape.pop(song)
+            if link_duplicates:
+                linked.append(linked_song_doc(artist_name, song, album, release_year, canonical))
+        logger.info(f"Not fetching {len(skipped)} other versions of {artist_name}'s songs")
+    versions = {song: songs_to_scrape.pop(song) for song in list(songs_to_scrape) if is_version(song)}
+    return detector, linked, versions
+
+def add_artist_to_db(artist_file, num_albums:int = None, album_title: str = None, engine: FetchEngine = None,
+                     bulk: bool = False, batch_size: int = None, skip_duplicates: bool = None, link_duplicates: bool = None):
+    """
+    Adds an artist, albums, and songs to the MongoDB collections from a file.
+    :param artist_file: Path to the artist's file containing album and song info.
+    :param num_albums: Optionally limit to the top n albums.
+    :param album_title: Optionally specify a single album to add.
+    :param engine: Optionally share a FetchEngine (and its per-host rate limit) between several artists.
+    :param bulk: Create the unique indexes and write albums and songs as batched upserts.
+    :param batch_size: Songs per bulk_write in bulk mode, defaults to settings.MONGO_BATCH_SIZE.
+    :param skip_duplicates: Don't fetch songs whose title marks another version (live, acoustic, remix...) of a song
+                            the artist has, defaults to settings.DEDUP_SKIP_TITLES.
+    :param link_duplicates: Store near-duplicate songs without lyrics, pointing to their canonical song,
+                            defaults to settings.DEDUP_LINK.
+    """
+
+    # Load artist data from input file
+    artist_name = os.path.basename(artist_file).replace('.json','')
+
+    with open(artist_file, 'r', encoding='utf-8') as f:
+        artist_data = json.load(f)
+
+    albums_to_add = select_albums(artist_name, artist_data, num_albums, album_title)
+    if albums_to_add is None:
+        return
+    with metrics.timer('stage_seconds', stage='plan'):
+        songs_to_scrape = add_artist_and_albums(artist_name, albums_to_add, bulk=bulk, batch_size=batch_size)
+
+    link_duplicates = settings.DEDUP_LINK if link_duplicates is None else link_duplicates
+    detector, linked, versions = plan_duplicates(artist_name, songs_to_scrape, skip_duplicates, link_duplicates)
 
+    # Scrape songs concurrently and write each one as soon as it arrives
+    owns_engine = engine is None
+    engine = engine or FetchEngine()
+    song_writer = BulkUpserter(songs_collection(), batch_size) if bulk else None
+    # Scraping and writing overlap, the stage is the whole stream
+    with metrics.timer('stage_seconds', stage='scrape'):
+        try:
+            scraped = (scrape_songs(engine, artist_name, songs) for songs in (songs_to_scrape, versions) if songs)
+            for song_doc in itertools.chain(linked, *scraped):
+                try:
+                    if detector is not None and 'duplicate_of' not in song_doc:
+                        song_doc = detector.check(song_doc, link=link_duplicates)
+                    if song_writer:
+                        song_writer.add(song_doc)
+                    else:
+                        with metrics.timer('mongo_write_seconds', collection='songs', op='insert_one'):
+                            songs_collection().insert_one(song_doc)
+                        metrics.inc('documents_written_total', collection='songs')
+                except Exception as e:
+                    logger.error(f"An error occurred while processing the song '{song_doc['title']}': {e}")
+                    print(f"Skipping song '{song_doc['title']}' due to an error.")
+        finally:
+            if song_writer:
+                song_writer.flush()
+            if owns_engine:
+                engine.close()
+
+    with metrics.timer('stage_seconds', stage='index'):
+        index_new_songs(artist_name)
     print(f"Successfully added {artist_name} to MongoDB.")
+
+# Artists upload side by side, one at a time may append to the embedding store
+_index_lock = threading.Lock()
+
+def index_new_songs(artist_name: str = None):
+    # Adds an artist's new or changed songs (everyone's without artist_name) to the similarity and search indexes,
+    # a failure here never fails the upload. The lock only covers this process, worker processes leave it to their parent
+    if not settings.INDEX_ON_UPLOAD:
+        return
+    from scripts.generate_embeddings import generate_embeddings
+    from scripts.similarity_index import update_index
+    from scripts.search_index import update_search_index
+    query = {'artist': artist_name} if artist_name else {}
+    label = f'the songs of {artist_name}' if artist_name else 'new songs'
+    with _index_lock:
+        try:
+            # A whole batch is embedded on EMBEDDING_PROCESSES, one artist inline
+            if generate_embeddings(query=query, processes=1 if artist_name else None):
+                update_index()
+        except Exception as e:
+            logger.error(f"Could not add {label} to the similarity index: {e}")
+        try:
+            update_search_index(query=query)
+        except Exception as e:
+            logger.error(f"Could not add {label} to the search index: {e}")
+
+def reparse_cached_songs(artist_name: str = None, parser_backend: str = 'html.parser') -> int:
+    """
+    Re-extracts lyrics, genre and writers of stored songs from the page cache, without any network traffic.
+    Useful after a parser fix. Songs whose page isn't cached, and linked duplicates, are left alone.
+    Lyrics are only rewritten, and flagged for re-scoring, when their hash changed.
+    :param artist_name: Optionally limit to one artist.
+    :return: Number of songs updated.
+    """
+    offline = HttpTransport(cache=get_transport().cache, offline=True)
+    query = {'artist': artist_name} if artist_name else None
+    updated = 0
+    projection = {'title': 1, 'artist': 1, 'lyrics_hash': 1, 'duplicate_of': 1}
+    for song in songs_collection().find(without_linked(query), projection):
+        azlyrics = AZLyrics(artist=song['artist'], song=song['title'], parser_backend=parser_backend, fetcher=offline)
+        result = azlyrics.open_url()
+        if result is None:
+            continue
+        lyrics, genre, _, writers = result
+        fields = {'genre': genre, 'writers': writers}
+        digest = lyrics_hash(lyrics)
+        if digest != song.get('lyrics_hash'):
+            fields.update(lyrics=stored_lyrics(lyrics), lyrics_hash=digest, sentiment_stale=True)
+        songs_collection().update_one({'_id': song['_id']}, {'$set': fields})
+        updated += 1
+    logger.info(f"Re-parsed {updated} cached songs")
+    return updated
@@ -0,0 +1,69 @@
+# tests/record_fixtures.py
+
+"""Records live AZLyrics pages into the fixture corpus the StubServer replays: the artist's letter index page,
+   the discography page and some of its lyrics pages, each saved under the name fixture_routes maps back to its path.
+   Requests go through a rate limited FetchEngine like any scrape.
+
+   Usage: python -m tests.record_fixtures "All Time Low" [--songs "Weightless" ...] [--max_songs N] [--directory DIR]"""
+
+from urllib.parse import urlparse
+import argparse
+import logging
+import os
+from scripts.fetch_engine import FetchEngine
+from scripts.slug_index import SlugIndex
+from scripts.scrape_discography import AZArtists
+from scripts.scrape_lyrics import AZLyrics
+from tests.stub_server import FIXTURE_DIR
+
+def fixture_name(path: str) -> str:
+    # The inverse of fixture_routes: /lyrics/<artist>/<song>.html, /<letter>/<artist>.html or /<letter>.html
+    parts = path.strip('/')[:-len('.html')].split('/')
+    if parts[0] == 'lyrics' and len(parts) == 3:
+        return f'lyrics_{parts[1]}_{parts[2]}.html'
+    if len(parts) == 2:
+        return f'discography_{parts[1]}.html'
+    return f'letter_{parts[0]}.html'
+
+class Recorder:
+    """ Fetcher wrapper saving the body of every successful page it gets into directory."""
+
+    def __init__(self, fetcher, directory: str = FIXTURE_DIR):
+        self.fetcher = fetcher
+        self.directory = directory
+        self.saved = []
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, url: str, **kwargs):
+        response = self.fetcher.get(url, **kwargs)
+        if response.ok:
+            path = os.path.join(self.directory, fixture_name(urlparse(url).path))
+            with open(path, 'wb') as f:
+                f.write(response.content)
+            self.saved.append(path)
+        return response
+
+def record_artist(artist: str, fetcher, songs: list = None, max_songs: int = 3, directory: str = FIXTURE_DIR) -> list:
+    """ Saves the artist's pages, the given songs or else the first max_songs of the discography. :return: Saved paths."""
+    recorder = Recorder(fetcher, directory)
+    slugs = SlugIndex(':memory:') # Resolves the slug through the letter page, which gets recorded too
+    albums = AZArtists(artist, fetcher=recorder, slugs=slugs).fetch_albums()
+    if albums is None:
+        raise ValueError(f'No discography found for {artist}')
+    if not songs:
+        songs = list(dict.fromkeys(song for album in albums for song in album['songs']))[:max_songs]
+    for song in songs:
+        AZLyrics(artist, song, fetcher=recorder, slugs=slugs).open_url()
+    return recorder.saved
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Record AZLyrics pages as test fixtures")
+    parser.add_argument('artist', type=str, help="Artist's name")
+    parser.add_argument('--songs', type=str, nargs='+', help="Song titles to record, default the first --max_songs")
+    parser.add_argument('--max_songs', type=int, default=3, help="Songs recorded when --songs isn't given")
+    parser.add_argument('--directory', type=str, default=FIXTURE_DIR, help="Where the pages are saved")
+    args = parser.parse_args()
+    with FetchEngine(max_workers=1) as engine:
+        for path in record_artist(args.artist, engine, songs=args.songs, max_songs=args.max_songs, directory=args.directory):
+            print(f'Saved {path}')
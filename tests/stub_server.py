@@ -0,0 +1,110 @@
+# tests/stub_server.py
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import random
+import hashlib
+import glob
+import time
+import os
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'pages')
+
+def fixture_routes(directory: str = FIXTURE_DIR) -> dict:
+    """ Maps AZLyrics paths to the saved fixture pages:
+        lyrics_<artist>_<song>.html -> /lyrics/<artist>/<song>.html
+        discography_<artist>.html   -> /<first letter>/<artist>.html
+        letter_<letter>.html        -> /<letter>.html"""
+    routes = {}
+    for path in glob.glob(os.path.join(directory, '*.html')):
+        name = os.path.basename(path)[:-len('.html')]
+        kind, _, rest = name.partition('_')
+        if kind == 'lyrics':
+            artist, _, song = rest.partition('_')
+            routes[f'/lyrics/{artist}/{song}.html'] = path
+        elif kind == 'discography':
+            routes[f'/{rest[0]}/{rest}.html'] = path
+        elif kind == 'letter':
+            routes[f'/{rest}.html'] = path
+    return routes
+
+class StubServer:
+    """ Local HTTP server replaying the fixture pages, so scrapers can be tested without azlyrics.com.
+        Every request is recorded in hits as (monotonic time, path); latency delays each response, by a fixed
+        number of seconds or a random (low, high) range. errors maps a path to a list of status codes served
+        (and used up) before the real page, and error_rate answers that share of all other requests with a 503.
+        Random draws come from seed, so a run can be repeated.
+        Pages carry an ETag and If-None-Match is answered with 304 unless etags is False."""
+
+    def __init__(self, routes: dict = None, latency=0.0, errors: dict = None, etags: bool = True,
+                 error_rate: float = 0.0, seed: int = 0):
+        self.routes = routes if routes is not None else fixture_routes()
+        self.latency = latency
+        self.errors = {path: list(statuses) for path, statuses in (errors or {}).items()}
+        self.etags = etags
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.hits = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub.lock:
+                    stub.hits.append((time.monotonic(), self.path))
+                    injected = stub.errors.get(self.path)
+                    status = injected.pop(0) if injected else None
+                    if status is None and stub.error_rate and stub.random.random() < stub.error_rate:
+                        status = 503
+                    latency = stub.random.uniform(*stub.latency) if isinstance(stub.latency, tuple) else stub.latency
+                if latency:
+                    time.sleep(latency)
+                if status:
+                    self.send_error(status)
+                    return
+                path = stub.routes.get(self.path)
+                if path is None:
+                    self.send_error(404)
+                    return
+                with open(path, 'rb') as f:
+                    body = f.read()
+                etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+                if stub.etags and self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                if stub.etags:
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args): # Keep test output quiet
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
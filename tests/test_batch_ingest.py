@@ -0,0 +1,117 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import mongomock
+from config import settings
+from scripts.services import registry
+from scripts.slug_index import SlugIndex
+from scripts.batch_ingest import ArtistWorkTable, BatchWorker, read_artist_list, worker_rate, PENDING, IN_FLIGHT, DONE, FAILED
+from scripts.fetch_engine import FetchEngine
+from scripts.http_transport import HttpTransport
+from scripts.search_index import SearchIndex
+from scripts.upload_to_mongodb import index_new_songs
+from tests.stub_server import StubServer
+
+class TestArtistWorkTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = ArtistWorkTable('test', collection=mongomock.MongoClient().db.batch_artists, max_attempts=2, retry_backoff=0)
+
+    def test_claims_are_exclusive_and_leases_expire(self):
+        self.assertEqual(self.table.add(['A', 'B', 'C']), 3)
+        self.assertEqual(self.table.add(['B', 'D']), 1)
+        claimed = [self.table.claim(f'w{i}')['artist'] for i in range(4)]
+        self.assertEqual(claimed, ['A', 'B', 'C', 'D'])
+        self.assertIsNone(self.table.claim('w5'))
+
+        # w0 died, its artist goes to the next claimer and w0 can no longer finish it
+        self.table.collection.update_one({'artist': 'A'}, {'$set': {'lease_expires': 0}})
+        doc = self.table.claim('w5')
+        self.assertEqual((doc['artist'], doc['attempts']), ('A', 2))
+        self.assertFalse(self.table.complete(doc['_id'], 'w0', 3, 3))
+        self.assertTrue(self.table.complete(doc['_id'], 'w5', 3, 2))
+        self.assertEqual(self.table.worker_totals(), {'w5': {'artists': 1, 'songs': 2, 'missed': 1}})
+
+    def test_failures_are_retried_then_kept(self):
+        self.table.add(['A'])
+        for attempt in range(2):
+            doc = self.table.claim('w0')
+            self.assertTrue(self.table.fail(doc['_id'], 'w0', 'discography not found'))
+        self.assertEqual(self.table.counts(), {PENDING: 0, IN_FLIGHT: 0, DONE: 0, FAILED: 1})
+        self.assertEqual(self.table.failures(), [{'artist': 'A', 'attempts': 2, 'error': 'discography not found'}])
+        self.assertEqual(self.table.retry_failed(), 1)
+        self.assertEqual(self.table.counts()[PENDING], 1)
+
+    def test_artist_list_and_rates(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'artists.txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('# Pop punk\nAll Time Low\n\nParamore  # 2005\nAll Time Low\n')
+            self.assertEqual(read_artist_list(path), ['All Time Low', 'Paramore'])
+        with mock.patch.object(settings, 'REQUESTS_PER_SECOND', 1):
+            self.assertEqual(worker_rate(4), 0.25)
+            self.assertEqual(worker_rate(4, ['p1', 'p2', 'p3', 'p4']), 1)
+            self.assertEqual(worker_rate(4, ['p1', 'p2']), 0.5)
+
+class TestBatchWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().lyrical_analysis_db
+        self.enterContext(registry.override(db=self.db, slug_index=SlugIndex(':memory:')))
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        patcher = mock.patch.object(settings, 'AZLYRICS_BASE_URL', self.server.base_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name in ('EMBEDDINGS_DIR', 'SEARCH_INDEX_DIR'):
+            patcher = mock.patch.object(settings, name, os.path.join(tmp.name, name.lower()))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_batch_to_database(self):
+        table = ArtistWorkTable('test', max_attempts=1)
+        table.add(['All Time Low', 'Nobody'])
+        with FetchEngine(max_workers=2, rate=1000, jitter=(0, 0), session=HttpTransport()) as engine:
+            self.assertEqual(BatchWorker(table, engine, worker_id='w1').run(poll_interval=0.01), 2)
+        self.assertEqual(table.counts(), {PENDING: 0, IN_FLIGHT: 0, DONE: 1, FAILED: 1})
+        # Three of the nine songs on the fixture discography have lyrics pages
+        self.assertEqual(table.worker_totals(), {'w1': {'artists': 1, 'songs': 3, 'missed': 6}})
+        self.assertEqual(table.failures()[0]['error'], 'discography not found')
+        self.assertEqual(self.db.songs.count_documents({'artist': 'All Time Low'}), 3)
+        # Ingested like an upload: signatures for near-duplicate checks. Workers leave indexing to main.py batch,
+        # which indexes once after every worker process finished
+        self.assertEqual(self.db.songs.count_documents({'minhash': {'$exists': True}}), 3)
+        self.assertFalse(os.path.exists(settings.EMBEDDINGS_DIR))
+        index_new_songs()
+        index = SearchIndex()
+        self.addCleanup(index.close)
+        self.assertEqual(index.search('"On the other side"'), [('All Time Low', 'The Other Side')])
+
+    def test_failed_writes_fail_the_artist(self):
+        table = ArtistWorkTable('test', max_attempts=1)
+        table.add(['All Time Low'])
+        sink_error = mock.patch('scripts.upload_to_mongodb.BulkUpserter.flush', side_effect=RuntimeError('not primary'))
+        with FetchEngine(max_workers=2, rate=1000, jitter=(0, 0), session=HttpTransport()) as engine, sink_error:
+            BatchWorker(table, engine, worker_id='w1').run(poll_interval=0.01)
+        self.assertEqual(table.counts()[FAILED], 1)
+        self.assertIn('not primary', table.failures()[0]['error'])
+
+    def test_refused_writes_fail_the_artist(self):
+        table = ArtistWorkTable('test', max_attempts=1)
+        table.add(['All Time Low'])
+
+        def refuse(writer):
+            writer.failed += len(writer.ops)
+            writer.ops = []
+
+        with FetchEngine(max_workers=2, rate=1000, jitter=(0, 0), session=HttpTransport()) as engine, \
+                mock.patch('scripts.upload_to_mongodb.BulkUpserter.flush', refuse):
+            BatchWorker(table, engine, worker_id='w1').run(poll_interval=0.01)
+        self.assertEqual(table.counts()[FAILED], 1)
+        self.assertIn('3 of 9 songs could not be written', table.failures()[0]['error'])
+
+if __name__ == '__main__':
+    unittest.main()
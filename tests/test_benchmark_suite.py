@@ -0,0 +1,44 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from benchmarks.suite import baseline, check_failures, compare, load_history, runner_id
+
+class TestRegressionCheck(unittest.TestCase):
+
+    def test_baseline_is_the_recent_median_on_this_machine(self):
+        history = [{'machine': 'ci', 'results': {'parse': value, 'scrape': 100}} for value in (50, 10, 11, 9, 12, 10)]
+        history.append({'machine': 'laptop', 'results': {'parse': 1, 'scrape': 1}})
+        self.assertEqual(baseline(history, 'ci'), {'parse': 10, 'scrape': 100}) # The oldest run fell out of the window
+        self.assertEqual(baseline(history, 'other'), {})
+
+    def test_regressions_depend_on_direction(self):
+        rows = compare({'parse': 13.0, 'scrape': 70.0, 'ingest': 50.0}, {'parse': 10.0, 'scrape': 100.0}, threshold=0.25)
+        regressed = {name: (round(change, 2) if change is not None else None, flag) for name, _, _, change, flag in rows}
+        # parse is ms/page, 30% slower; scrape is songs/s, 30% fewer; ingest has no history yet
+        self.assertEqual(regressed, {'parse': (-0.3, True), 'scrape': (-0.3, True), 'ingest': (None, False)})
+        rows = compare({'parse': 8.0, 'scrape': 90.0}, {'parse': 10.0, 'scrape': 100.0}, threshold=0.25)
+        self.assertFalse(any(row[4] for row in rows))
+
+    def test_check_without_a_baseline(self):
+        rows = compare({'parse': 10.0, 'scrape': 100.0}, {'parse': 10.0})
+        self.assertIn('No baseline for scrape', check_failures(rows, 0.25, save=False)[0])
+        # The first saved run becomes the baseline
+        self.assertEqual(check_failures(rows, 0.25, save=True), [])
+
+    def test_runner_id(self):
+        with mock.patch.dict(os.environ, {'BENCH_RUNNER': 'ci-large'}):
+            self.assertTrue(runner_id().startswith('ci-large-'))
+            self.assertTrue(runner_id('nightly').startswith('nightly-'))
+
+    def test_history_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'history.jsonl')
+            self.assertEqual(load_history(path), [])
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'machine': 'ci', 'results': {'parse': 1.0}}) + '\n\n')
+            self.assertEqual(load_history(path), [{'machine': 'ci', 'results': {'parse': 1.0}}])
+
+if __name__ == '__main__':
+    unittest.main()
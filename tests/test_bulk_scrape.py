@@ -0,0 +1,70 @@
+import os
+import time
+import tempfile
+import unittest
+from unittest import mock
+import mongomock
+from config import settings
+import scripts.upload_to_mongodb as upload
+from scripts.services import registry
+from scripts.slug_index import SlugIndex
+from scripts.bulk_scrape_lyrics import BulkScraper
+from scripts.fetch_engine import FetchEngine
+from scripts.http_transport import HttpTransport
+from tests.stub_server import StubServer
+
+class TestBulkScraper(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().lyrical_analysis_db
+        self.enterContext(registry.override(db=self.db, slug_index=SlugIndex(':memory:')))
+
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        patcher = mock.patch.object(settings, 'AZLYRICS_BASE_URL', self.server.base_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name in ('EMBEDDINGS_DIR', 'SEARCH_INDEX_DIR'):
+            patcher = mock.patch.object(settings, name, os.path.join(tmp.name, name.lower()))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.engine = FetchEngine(max_workers=2, rate=1000, jitter=(0, 0), session=HttpTransport())
+        self.addCleanup(self.engine.close)
+
+    def test_discography_to_database(self):
+        written = BulkScraper('All Time Low', engine=self.engine, batch_size=2, queue_size=2).run()
+        # Only three songs of the fixture discography have lyrics pages, the rest are skipped
+        self.assertEqual(written, 3)
+        titles = {song['title'] for song in self.db.songs.find()}
+        self.assertEqual(titles, {'Weightless', 'The Other Side', 'Dear Maria, Count Me In'})
+        self.assertEqual(self.db.albums.count_documents({'artist': 'All Time Low'}), 4)
+        self.assertEqual(self.db.songs.find_one({'title': 'Weightless'})['album'], 'Nothing Personal')
+
+    def test_partial_batches_flush_early(self):
+        scraper = BulkScraper('All Time Low', engine=self.engine, batch_size=100, flush_interval=0.05)
+        original = upload.scrape_songs
+
+        def slow_tail(*args, **kwargs):
+            for i, song_doc in enumerate(original(*args, **kwargs)):
+                yield song_doc
+                if i == 0:
+                    time.sleep(0.5) # Give the sink time to write the first song before the stream ends
+                    self.assertEqual(self.db.songs.count_documents({}), 1)
+
+        with mock.patch('scripts.bulk_scrape_lyrics.scrape_songs', slow_tail):
+            self.assertEqual(scraper.run(), 3)
+
+    def test_sink_failure_is_raised(self):
+        scraper = BulkScraper('All Time Low', engine=self.engine, batch_size=100)
+        with mock.patch.object(upload.BulkUpserter, 'flush', side_effect=RuntimeError('not primary')), \
+                mock.patch('builtins.print') as printed:
+            with self.assertRaisesRegex(RuntimeError, 'not primary'):
+                scraper.run()
+        printed.assert_not_called()
+        self.assertEqual(scraper.written, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+from unittest import mock
+import mongomock
+from config import settings
+from scripts.compact_storage import (SENTIMENT_LAYOUT, LyricsCodec, compact_collection, expand_collection,
+                                     pack_sentiment, song_lyrics, song_sentiment, storage_stats, unpack_sentiment)
+from scripts.sentiment_engine import NRC_EMOTIONS, BatchSentimentEngine
+from scripts.sentiment_rollups import get_rollups, refresh_rollups
+from scripts.upload_to_mongodb import lyrics_hash, make_song_doc
+from scripts.services import registry
+from benchmarks.bench_sentiment import make_lyrics
+
+class TestCompactStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().lyrical_analysis_db
+        self.enterContext(registry.override(db=self.db))
+        self.lyrics = make_lyrics(200)
+        self.db.songs.insert_many([{'title': f'Song {i}', 'artist': 'Artist', 'album': f'Album {i % 4}',
+                                    'release_year': '2009', 'lyrics': text, 'lyrics_hash': lyrics_hash(text)}
+                                   for i, text in enumerate(self.lyrics)])
+        BatchSentimentEngine(processes=1).update_collection(self.db.songs)
+
+    def test_sentiment_layout(self):
+        self.assertEqual([field for group, field in SENTIMENT_LAYOUT if group == 'nrc'], list(NRC_EMOTIONS))
+        sentiment = {'vader': {'neg': 0.1, 'neu': 0.7, 'pos': 0.2, 'compound': -0.5}, 'nrc': {'joy': 0.25}}
+        packed = pack_sentiment(sentiment)
+        self.assertEqual(len(packed), 4 * len(SENTIMENT_LAYOUT))
+        unpacked = unpack_sentiment(packed)
+        self.assertEqual(unpacked['nrc'], {'joy': 0.25}) # Emotions the song wasn't scored on stay missing
+        for field, value in sentiment['vader'].items():
+            self.assertAlmostEqual(unpacked['vader'][field], value, places=6)
+
+    def test_compact_and_expand(self):
+        plain = {song['title']: song for song in self.db.songs.find()}
+        before = storage_stats()
+        self.assertEqual(compact_collection(samples=200), 200)
+        after = storage_stats()
+        self.assertLess(after['lyrics_bytes'], before['lyrics_bytes'] / 3)
+        self.assertLess(after['sentiment_bytes'], before['sentiment_bytes'])
+
+        for song in self.db.songs.find():
+            self.assertIsInstance(song['lyrics'], bytes)
+            self.assertEqual(song_lyrics(song), plain[song['title']]['lyrics'])
+            self.assertAlmostEqual(song_sentiment(song)['vader']['compound'],
+                                   plain[song['title']]['sentiment']['vader']['compound'], places=6)
+        # Already compressed with the newest dictionary, nothing to do
+        self.assertEqual(compact_collection(train=False), 0)
+
+        # A fresh codec, as in another process, loads the dictionary from MongoDB
+        with registry.override(db=self.db):
+            self.assertEqual(song_lyrics(self.db.songs.find_one({'title': 'Song 5'})), self.lyrics[5])
+
+        self.assertEqual(expand_collection(), 200)
+        song = self.db.songs.find_one({'title': 'Song 5'})
+        self.assertEqual(song['lyrics'], self.lyrics[5])
+        self.assertIsInstance(song['sentiment'], dict)
+
+    def test_too_few_songs_for_a_dictionary(self):
+        self.db.songs.delete_many({'title': {'$ne': 'Song 0'}})
+        self.assertEqual(compact_collection(), 0)
+        self.assertEqual(self.db.songs.find_one()['lyrics'], self.lyrics[0])
+
+    def test_writers_in_compact_mode(self):
+        compact_collection(samples=200)
+        with mock.patch.object(settings, 'COMPACT_STORAGE', True):
+            doc = make_song_doc('Artist', 'New', 'Album 0', '2009', (self.lyrics[0], 'Rock', 'Album 0', 'Someone'))
+            self.assertIsInstance(doc['lyrics'], bytes)
+            self.assertEqual(doc['lyrics_hash'], lyrics_hash(self.lyrics[0]))
+            self.db.songs.insert_one(doc)
+            self.assertEqual(BatchSentimentEngine(processes=1).update_collection(self.db.songs, incremental=True), 1)
+        song = self.db.songs.find_one({'title': 'New'})
+        self.assertIsInstance(song['sentiment'], bytes)
+        self.assertEqual(song_lyrics(song), self.lyrics[0])
+
+    def test_rollups_of_packed_sentiment(self):
+        refresh_rollups()
+        plain = {row['album']: row for row in get_rollups('album')}
+        compact_collection(samples=200)
+        refresh_rollups(full=True)
+        for row in get_rollups('album'):
+            self.assertEqual((row['songs'], row['scored']), (plain[row['album']]['songs'], plain[row['album']]['scored']))
+            self.assertAlmostEqual(row['vader_compound']['mean'], plain[row['album']]['vader_compound']['mean'], places=5)
+            self.assertAlmostEqual(row['nrc']['joy'], plain[row['album']]['nrc']['joy'], places=5)
+
+    def test_codec_without_dictionary(self):
+        codec = LyricsCodec(self.db.lyrics_dictionaries)
+        frame = codec.compress(self.lyrics[0])
+        self.assertEqual(codec.dict_id_of(frame), 0)
+        self.assertEqual(codec.decompress(frame), self.lyrics[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import glob
+import os
+import tempfile
+import unittest
+import mongomock
+from scripts.services import registry
+from scripts.sentiment_engine import NRC_EMOTIONS
+
+try:
+    import pyarrow.compute as pc
+    from scripts.export_parquet import export_all, export_songs, songs_dataset
+except ImportError:
+    pc = None
+
+def song(title: str, artist: str = 'Artist', year: str = '2009', compound: float = 0.5) -> dict:
+    return {'title': title, 'artist': artist, 'album': 'Album', 'release_year': year, 'lyrics': f'{title} lyrics',
+            'lyrics_hash': title, 'genre': 'Pop', 'writers': 'Someone',
+            'sentiment': {'vader': {'neg': 0.0, 'neu': 0.5, 'pos': 0.5, 'compound': compound},
+                          'nrc': dict.fromkeys(NRC_EMOTIONS, 0.1)}}
+
+@unittest.skipIf(pc is None, "The Parquet export needs pyarrow")
+class TestExportParquet(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.db = mongomock.MongoClient().lyrical_analysis_db
+        self.enterContext(registry.override(db=self.db))
+        self.db.songs.insert_many([song('A'), song('B', year='2011'), song('C', artist='All/Other', year=None)])
+        self.db.albums.insert_one({'title': 'Album', 'artist': 'Artist', 'release_year': '2009', 'songs': ['A']})
+        self.db.artists.insert_one({'name': 'Artist', 'albums': ['Album']})
+
+    def songs(self) -> dict:
+        table = songs_dataset(self.directory).to_table(columns=['title', 'artist', 'release_year', 'vader_compound'])
+        return {row['title']: row for row in table.to_pylist()}
+
+    def files(self) -> list:
+        return sorted(glob.glob(os.path.join(self.directory, 'songs', '*', '*', '*.parquet')))
+
+    def test_full_export(self):
+        stats = export_all(self.directory)
+        self.assertEqual((stats['songs'], stats['albums'], stats['artists']), (3, 1, 1))
+        songs = self.songs()
+        self.assertEqual(songs['C'], {'title': 'C', 'artist': 'All/Other', 'release_year': 'Unknown', 'vader_compound': 0.5})
+        self.assertEqual(len(self.files()), 3) # One per artist and year
+        # Column pruned and partition filtered scan
+        table = songs_dataset(self.directory).to_table(columns=['nrc_joy'], filter=pc.field('release_year') == '2011')
+        self.assertEqual(table.column_names, ['nrc_joy'])
+        self.assertEqual(table.num_rows, 1)
+
+    def test_incremental_sync(self):
+        export_songs(self.db.songs, self.directory)
+        files = self.files()
+        self.assertEqual(export_songs(self.db.songs, self.directory), {'appended': 0, 'rewritten': 0, 'songs': 0})
+
+        self.db.songs.insert_one(song('D'))
+        self.assertEqual(export_songs(self.db.songs, self.directory), {'appended': 1, 'rewritten': 0, 'songs': 1})
+        self.assertEqual(len(self.files()), len(files) + 1)
+        self.assertTrue(set(files) <= set(self.files())) # Appended, nothing rewritten
+
+        # A rescored song rewrites its partition, a moved one both partitions
+        self.db.songs.update_one({'title': 'A'}, {'$set': {'sentiment.vader.compound': -0.9}})
+        self.db.songs.update_one({'title': 'B'}, {'$set': {'release_year': '2009'}})
+        self.assertEqual(export_songs(self.db.songs, self.directory), {'appended': 0, 'rewritten': 2, 'songs': 3})
+        songs = self.songs()
+        self.assertEqual(len(songs), 4)
+        self.assertEqual((songs['A']['vader_compound'], songs['B']['release_year']), (-0.9, '2009'))
+
+        self.assertEqual(export_songs(self.db.songs, self.directory, full=True)['songs'], 4)
+        self.assertEqual(len(self.files()), 2)
+
+if __name__ == '__main__':
+    unittest.main()
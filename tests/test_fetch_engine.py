@@ -0,0 +1,80 @@
+import time
+import unittest
+from unittest import mock
+from config import settings
+from scripts.fetch_engine import TokenBucket, FetchEngine
+from scripts.http_transport import HttpTransport
+from scripts.scrape_lyrics import AZLyrics
+from scripts.services import registry
+from scripts.slug_index import SlugIndex
+from tests.stub_server import StubServer
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_spacing(self):
+        bucket = TokenBucket(rate=50, capacity=1)
+        start = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        # First token is free, the next five are 20ms apart
+        self.assertGreaterEqual(time.monotonic() - start, 0.095)
+
+    def test_jitter_adds_to_spacing(self):
+        bucket = TokenBucket(rate=1000, capacity=1, jitter=(0.05, 0.05))
+        bucket.reserve()
+        self.assertAlmostEqual(bucket.reserve(), 0.101, delta=0.01)
+
+class TestFetchEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer(latency=0.2).start()
+        patcher = mock.patch.object(settings, 'AZLYRICS_BASE_URL', self.server.base_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.server.stop)
+        self.transport = HttpTransport(ttl=0) # In-memory cache that always revalidates
+        self.enterContext(registry.override(slug_index=SlugIndex(':memory:')))
+
+    def engine(self, **kwargs) -> FetchEngine:
+        return FetchEngine(jitter=(0, 0), session=self.transport, **kwargs)
+
+    def test_requests_overlap(self):
+        with self.engine(max_workers=4, rate=1000) as engine:
+            start = time.monotonic()
+            urls = [self.server.base_url + '/lyrics/alltimelow/weightless.html'] * 8
+            results = [future.result() for _, future in engine.imap_unordered(engine.get, urls)]
+            elapsed = time.monotonic() - start
+        self.assertTrue(all(r.status_code == 200 for r in results))
+        self.assertLess(elapsed, 8 * 0.2 / 2) # Serial would take 1.6s
+
+    def test_per_host_rate_limit(self):
+        with self.engine(max_workers=4, rate=10) as engine:
+            urls = [self.server.base_url + '/lyrics/alltimelow/weightless.html'] * 4
+            for _, future in engine.imap_unordered(engine.get, urls):
+                future.result()
+        times = sorted(t for t, _ in self.server.hits)
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        self.assertTrue(all(gap >= 0.09 for gap in gaps), gaps)
+
+    def test_azlyrics_with_engine(self):
+        with self.engine(max_workers=2, rate=1000) as engine:
+            az = AZLyrics(artist='All Time Low', song='The Other Side', fetcher=engine)
+            lyrics, genre, album, writers = engine.submit(az.open_url).result()
+        self.assertIn('On the other side', lyrics)
+        self.assertEqual(genre, 'Pop')
+
+    def test_cached_pages_skip_rate_limit(self):
+        url = self.server.base_url + '/lyrics/alltimelow/weightless.html'
+        with FetchEngine(max_workers=1, rate=0.1, jitter=(0, 0), session=HttpTransport()) as engine:
+            engine.get(url)
+            start = time.monotonic()
+            engine.get(url) # Bucket is empty, only a cache hit returns right away
+            self.assertLess(time.monotonic() - start, 1)
+
+    def test_missing_page(self):
+        with self.engine(max_workers=1, rate=1000) as engine:
+            az = AZLyrics(artist='All Time Low', song='Not A Song', fetcher=engine)
+            self.assertIsNone(az.open_url())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import tempfile
+import unittest
+from unittest import mock
+import mongomock
+import numpy as np
+from scripts.generate_embeddings import EmbeddingStore, HashedNgramEmbedder, generate_embeddings
+from scripts.upload_to_mongodb import lyrics_hash
+
+def song(i: int, lyrics: str) -> dict:
+    return {'artist': 'Artist', 'title': f'Song {i}', 'lyrics': lyrics, 'lyrics_hash': lyrics_hash(lyrics)}
+
+class TestHashedNgramEmbedder(unittest.TestCase):
+
+    def test_vectors(self):
+        texts = ["Burning down the house tonight", "burning down the HOUSE, tonight!", "Sweet summer rain", "", "the and you"]
+        vectors = HashedNgramEmbedder(dim=64).embed_many(texts)
+        self.assertEqual(vectors.shape, (5, 64))
+        self.assertEqual(vectors.dtype, np.float32)
+        self.assertAlmostEqual(float(vectors[0] @ vectors[1]), 1.0, places=5)
+        self.assertLess(float(vectors[0] @ vectors[2]), 0.5)
+        # No words left after stopwords gives a zero vector
+        self.assertFalse(vectors[3].any() or vectors[4].any())
+        # Stable across processes and instances, there is no fitted state
+        np.testing.assert_array_equal(HashedNgramEmbedder(dim=64).embed_many(texts[:1]), vectors[:1])
+
+class TestEmbeddingStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_grows_and_reopens(self):
+        store = EmbeddingStore(self.directory.name, dim=8, model='test')
+        with mock.patch.object(EmbeddingStore, 'GROWTH_ROWS', 4):
+            for start in range(0, 10, 3):
+                ids = range(start, min(start + 3, 10))
+                store.put_many([(f'id{i}', 'h', 'Artist', f'Song {i}') for i in ids],
+                               np.array([[i] * 8 for i in ids], dtype=np.float32))
+        store.close()
+        store = EmbeddingStore(self.directory.name)
+        self.addCleanup(store.close)
+        self.assertEqual((len(store), store.dim), (10, 8))
+        self.assertEqual(store.vectors()[7].tolist(), [7.0] * 8)
+        self.assertEqual(store.songs([store.row_of('Artist', 'Song 9')]), [('Artist', 'Song 9')])
+        self.assertEqual(store.stale([('id1', 'h'), ('id2', 'other'), ('id99', 'h')]), ['id2', 'id99'])
+        with self.assertRaises(ValueError):
+            EmbeddingStore(self.directory.name, dim=16, model='other')
+
+class TestGenerateEmbeddings(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.songs = mongomock.MongoClient().lyrical_analysis_db.songs
+        self.songs.insert_many([song(i, f'line {i} about love and loss\nanother line {i}') for i in range(25)])
+        self.embedder = HashedNgramEmbedder(dim=32)
+        self.store = EmbeddingStore(self.directory.name, dim=32, model=self.embedder.name)
+        self.addCleanup(self.store.close)
+
+    def run_embeddings(self, processes: int = 1) -> int:
+        return generate_embeddings(self.songs, store=self.store, embedder=self.embedder, batch_size=10, processes=processes)
+
+    def test_only_new_and_changed_songs(self):
+        self.assertEqual(self.run_embeddings(), 25)
+        self.assertEqual(self.run_embeddings(), 0)
+
+        self.songs.update_one({'title': 'Song 3'}, {'$set': {'lyrics': 'rain', 'lyrics_hash': lyrics_hash('rain')}})
+        self.songs.insert_one(song(99, 'rain'))
+        self.assertEqual(self.run_embeddings(), 2)
+        self.assertEqual(len(self.store), 26)
+        rain = self.embedder.embed_many(['rain'])[0]
+        np.testing.assert_array_equal(self.store.vectors()[self.store.row_of('Artist', 'Song 3')], rain)
+        np.testing.assert_array_equal(self.store.vectors()[self.store.row_of('Artist', 'Song 99')], rain)
+
+    def test_process_pool(self):
+        self.assertEqual(self.run_embeddings(processes=2), 25)
+        expected = self.embedder.embed_many([f'line {i} about love and loss\nanother line {i}' for i in range(25)])
+        rows = [self.store.row_of('Artist', f'Song {i}') for i in range(25)]
+        np.testing.assert_array_equal(self.store.vectors()[rows], expected)
+
+if __name__ == '__main__':
+    unittest.main()
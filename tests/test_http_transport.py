@@ -0,0 +1,70 @@
+import tempfile
+import unittest
+import requests
+from scripts.http_transport import HttpTransport
+from scripts.page_cache import PageCache
+from tests.stub_server import StubServer
+
+PAGE = '/lyrics/alltimelow/theotherside.html'
+
+class TestHttpTransport(unittest.TestCase):
+
+    def test_conditional_get(self):
+        with StubServer() as server:
+            transport = HttpTransport(backoff_factor=0, ttl=0) # Always revalidate
+            first = transport.get(server.base_url + PAGE)
+            second = transport.get(server.base_url + PAGE)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertTrue(getattr(second, 'revalidated', False))
+        self.assertEqual(first.text, second.text)
+
+    def test_fresh_pages_skip_the_network(self):
+        with StubServer() as server:
+            transport = HttpTransport()
+            transport.get(server.base_url + PAGE)
+            self.assertTrue(transport.is_cached(server.base_url + PAGE))
+            second = transport.get(server.base_url + PAGE)
+        self.assertTrue(getattr(second, 'from_cache', False))
+        self.assertEqual(len(server.hits), 1)
+
+    def test_offline_reads_disk_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with StubServer() as server:
+                HttpTransport(cache=PageCache(directory)).get(server.base_url + PAGE)
+            # Server is gone, a new transport over the same directory still answers
+            offline = HttpTransport(cache=PageCache(directory), offline=True)
+            self.assertIn('On the other side', offline.get(server.base_url + PAGE).text)
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                offline.get(server.base_url + '/lyrics/alltimelow/weightless.html')
+
+    def test_retries_server_errors(self):
+        with StubServer(errors={PAGE: [503, 429]}) as server:
+            transport = HttpTransport(retries=3, backoff_factor=0)
+            response = transport.get(server.base_url + PAGE)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(server.hits), 3)
+
+    def test_gives_up_after_retries(self):
+        with StubServer(errors={PAGE: [500] * 5}) as server:
+            transport = HttpTransport(retries=2, backoff_factor=0)
+            with self.assertRaises(requests.exceptions.RetryError):
+                transport.get(server.base_url + PAGE)
+        self.assertEqual(len(server.hits), 3)
+
+    def test_random_errors_are_retried(self):
+        pages = ['/lyrics/alltimelow/theotherside.html', '/lyrics/alltimelow/weightless.html', '/lyrics/alltimelow/dearmariacountmein.html']
+        with StubServer(error_rate=0.3, seed=0) as server:
+            transport = HttpTransport(retries=10, backoff_factor=0, ttl=0)
+            responses = [transport.get(server.base_url + page) for page in pages * 4]
+        self.assertTrue(all(response.status_code == 200 for response in responses))
+        self.assertGreater(len(server.hits), len(responses))
+
+    def test_read_timeout(self):
+        with StubServer(latency=0.5) as server:
+            transport = HttpTransport(read_timeout=0.1, retries=0)
+            with self.assertRaises(requests.exceptions.RequestException):
+                transport.get(server.base_url + PAGE)
+
+if __name__ == '__main__':
+    unittest.main()
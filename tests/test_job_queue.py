@@ -0,0 +1,168 @@
+import os
+import time
+import tempfile
+import unittest
+import multiprocessing
+from unittest import mock
+import mongomock
+from pymongo.errors import BulkWriteError
+from config import settings
+import scripts.upload_to_mongodb as upload
+from scripts.services import registry
+from scripts.slug_index import SlugIndex
+from scripts.job_queue import JobQueue, QueueWorker, enqueue_artist, PENDING, IN_FLIGHT, DONE, FAILED
+from scripts.fetch_engine import FetchEngine
+from scripts.http_transport import HttpTransport
+from tests.stub_server import StubServer
+
+def drain(path, results):
+    # Claims jobs one at a time from a separate process until the queue is empty
+    queue = JobQueue(path)
+    worker_id = f'proc-{os.getpid()}'
+    while True:
+        jobs = queue.claim(worker_id)
+        if not jobs:
+            break
+        for job in jobs:
+            results.append(job['id'])
+            queue.complete(job['id'], worker_id)
+    queue.close()
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'jobs.sqlite')
+        self.queue = JobQueue(self.path, lease_seconds=60, max_attempts=2, retry_backoff=0)
+        self.addCleanup(self.queue.close)
+
+    def test_enqueue_ignores_duplicates(self):
+        self.assertTrue(self.queue.enqueue('A', 'Album', 'Song'))
+        self.assertFalse(self.queue.enqueue('A', 'Other Album', 'Song'))
+        self.assertEqual(self.queue.counts()[PENDING], 1)
+
+    def test_claim_complete(self):
+        self.queue.enqueue_many([('A', 'Album', f'Song {i}', '2020') for i in range(3)])
+        jobs = self.queue.claim('w1', limit=2)
+        self.assertEqual([job['song'] for job in jobs], ['Song 0', 'Song 1'])
+        self.assertEqual(len(self.queue.claim('w2', limit=5)), 1) # Leased jobs aren't handed out twice
+        self.assertTrue(self.queue.complete(jobs[0]['id'], 'w1'))
+        self.assertFalse(self.queue.complete(jobs[1]['id'], 'w2')) # Not w2's lease
+        self.assertEqual(self.queue.counts(), {PENDING: 0, IN_FLIGHT: 2, DONE: 1, FAILED: 0})
+
+    def test_fail_retries_then_gives_up(self):
+        self.queue.enqueue('A', 'Album', 'Song')
+        job = self.queue.claim('w1')[0]
+        self.queue.fail(job['id'], 'w1', 'boom')
+        self.assertEqual(self.queue.counts()[PENDING], 1)
+        job = self.queue.claim('w1')[0]
+        self.assertEqual(job['attempts'], 2)
+        self.queue.fail(job['id'], 'w1', 'boom again')
+        self.assertEqual(self.queue.counts()[FAILED], 1)
+        self.assertEqual(self.queue.failures()[0]['last_error'], 'boom again')
+        self.assertEqual(self.queue.retry_failed(), 1)
+
+    def test_expired_lease_is_reclaimed(self):
+        queue = JobQueue(self.path, lease_seconds=0.05, max_attempts=3)
+        self.addCleanup(queue.close)
+        queue.enqueue('A', 'Album', 'Song')
+        job = queue.claim('dead-worker')[0]
+        time.sleep(0.1)
+        reclaimed = queue.claim('w2')
+        self.assertEqual([j['id'] for j in reclaimed], [job['id']])
+        self.assertFalse(queue.complete(job['id'], 'dead-worker'))
+
+    def test_renew_extends_held_leases(self):
+        queue = JobQueue(self.path, lease_seconds=0.1)
+        self.addCleanup(queue.close)
+        queue.enqueue_many([('A', 'Album', f'Song {i}', None) for i in range(2)])
+        jobs = queue.claim('w1', limit=2)
+        self.assertEqual(queue.renew([job['id'] for job in jobs], 'w1'), 2)
+        self.assertEqual(queue.renew([job['id'] for job in jobs], 'w2'), 0)
+
+    def test_processes_never_share_jobs(self):
+        self.queue.enqueue_many([('A', 'Album', f'Song {i}', None) for i in range(60)])
+        with multiprocessing.Manager() as manager:
+            results = manager.list()
+            procs = [multiprocessing.Process(target=drain, args=(self.path, results)) for _ in range(3)]
+            for proc in procs:
+                proc.start()
+            for proc in procs:
+                proc.join()
+            claimed = list(results)
+        self.assertEqual(sorted(claimed), sorted(set(claimed)))
+        self.assertEqual(len(claimed), 60)
+        self.assertEqual(self.queue.counts()[DONE], 60)
+
+class TestQueueWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().lyrical_analysis_db
+        self.enterContext(registry.override(db=self.db, slug_index=SlugIndex(':memory:')))
+        server = StubServer().start()
+        self.addCleanup(server.stop)
+        patcher = mock.patch.object(settings, 'AZLYRICS_BASE_URL', server.base_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.queue = JobQueue(os.path.join(tmp.name, 'jobs.sqlite'), max_attempts=1)
+        self.addCleanup(self.queue.close)
+
+    def test_enqueue_and_work(self):
+        albums = [{'title': 'Nothing Personal', 'songs': ['Weightless', 'The Other Side', 'Missing Song'], 'release_year': '2009'}]
+        self.assertEqual(enqueue_artist(self.queue, 'All Time Low', albums), 3)
+        with FetchEngine(max_workers=2, rate=1000, jitter=(0, 0), session=HttpTransport()) as engine:
+            QueueWorker(self.queue, engine, worker_id='w1').run(poll_interval=0.01)
+        self.assertEqual(self.queue.counts(), {PENDING: 0, IN_FLIGHT: 0, DONE: 2, FAILED: 1})
+        self.assertEqual({song['title'] for song in self.db.songs.find()}, {'Weightless', 'The Other Side'})
+        # Checked for near-duplicates like an upload
+        self.assertEqual(self.db.songs.count_documents({'minhash': {'$exists': True}}), 2)
+        # Songs already stored aren't queued again
+        self.assertEqual(enqueue_artist(self.queue, 'All Time Low', albums), 0)
+
+    def test_refused_songs_fail_their_job(self):
+        self.queue.enqueue_many([('All Time Low', 'Nothing Personal', song, '2009') for song in ('Weightless', 'The Other Side')])
+        refused = BulkWriteError({'nUpserted': 1, 'writeErrors': [{'index': 0, 'code': 121, 'errmsg': 'validation failed'}]})
+        with FetchEngine(max_workers=1, rate=1000, jitter=(0, 0), session=HttpTransport()) as engine, \
+                mock.patch.object(type(self.db.songs), 'bulk_write', side_effect=refused):
+            QueueWorker(self.queue, engine, worker_id='w1').run_batch()
+        self.assertEqual((self.queue.counts()[DONE], self.queue.counts()[FAILED]), (1, 1))
+        self.assertEqual(self.queue.failures()[0]['last_error'], 'the database refused the song')
+
+    def test_slow_batch_keeps_its_lease(self):
+        queue = JobQueue(self.queue.path, lease_seconds=0.15, max_attempts=1)
+        self.addCleanup(queue.close)
+        queue.enqueue('All Time Low', 'Nothing Personal', 'Weightless')
+        claimed = []
+
+        def slow_scrape(worker, job):
+            # Outlasts the lease several times over, meanwhile another worker finds nothing to claim
+            time.sleep(0.3)
+            other = JobQueue(self.queue.path)
+            claimed.extend(other.claim('w2'))
+            other.close()
+            time.sleep(0.2)
+            return 'la la la', 'Rock', None, 'Someone'
+
+        with FetchEngine(max_workers=1, rate=1000, jitter=(0, 0), session=HttpTransport()) as engine, \
+                mock.patch.object(QueueWorker, '_scrape', slow_scrape):
+            worker = QueueWorker(queue, engine, worker_id='w1')
+            self.assertEqual(worker.run_batch(), 1)
+        self.assertEqual(claimed, [])
+        self.assertEqual(worker.lost, 0)
+        self.assertEqual(queue.counts()[DONE], 1)
+
+    def test_lost_leases_are_counted(self):
+        self.queue.enqueue('All Time Low', 'Nothing Personal', 'Weightless')
+        with FetchEngine(max_workers=1, rate=1000, jitter=(0, 0), session=HttpTransport()) as engine, \
+                mock.patch.object(JobQueue, 'complete', return_value=False), \
+                self.assertLogs('scripts.job_queue', 'WARNING') as logs:
+            worker = QueueWorker(self.queue, engine, worker_id='w1')
+            worker.run_batch()
+        self.assertEqual(worker.lost, 1)
+        self.assertIn('lost the lease on 1 of 1 jobs', logs.output[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import unittest
+from scripts.log_config import JsonFormatter, LazyQueueHandler, SamplingFilter, TruncatingFormatter, setup_logging, stop_logging
+
+def log_in_child():
+    logger = logging.getLogger('tests.log_config')
+    logger.info('From the child: info')
+    logger.warning('From the child: warning')
+
+class TestLogConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        def restore():
+            stop_logging()
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+                handler.close()
+            for handler in handlers:
+                root.addHandler(handler)
+            root.setLevel(level)
+        self.addCleanup(restore)
+        self.logger = logging.getLogger('tests.log_config')
+
+    def record(self, msg: str, *args, level: int = logging.INFO, **extra) -> logging.LogRecord:
+        return self.logger.makeRecord(self.logger.name, level, __file__, 0, msg, args, None, extra=extra)
+
+    def test_json_records_carry_extras_and_are_truncated(self):
+        line = JsonFormatter(max_chars=10).format(self.record('Lyrics: %s', 'a' * 50, artist='ATL', song_id=7))
+        entry = json.loads(line)
+        self.assertEqual((entry['level'], entry['logger'], entry['artist'], entry['song_id']), ('INFO', 'tests.log_config', 'ATL', 7))
+        self.assertEqual(entry['message'], 'Lyrics: aa... [48 more chars]')
+
+        text = TruncatingFormatter(fmt='%(message)s', max_chars=5).format(self.record('abcdefgh'))
+        self.assertEqual(text, 'abcde... [3 more chars]')
+
+    def test_sampling_keeps_warnings(self):
+        sampler = SamplingFilter(every=3)
+        kept = [sampler.filter(self.record('Found song: %s', i)) for i in range(6)]
+        self.assertEqual(kept, [True, False, False, True, False, False])
+        self.assertTrue(all(sampler.filter(self.record('Failed: %s', i, level=logging.WARNING)) for i in range(3)))
+
+    def test_queue_handler_defers_formatting(self):
+        class Lyrics:
+            rendered = 0
+            def __str__(self):
+                Lyrics.rendered += 1
+                return 'la la la'
+        handler = LazyQueueHandler(queue.Queue(maxsize=1))
+        handler.handle(self.record('Lyrics: %s', Lyrics()))
+        handler.handle(self.record('Lyrics: %s', Lyrics()))
+        self.assertEqual((Lyrics.rendered, handler.dropped), (0, 1))
+        self.assertEqual(handler.queue.get_nowait().getMessage(), 'Lyrics: la la la')
+
+    def test_full_queue_keeps_warnings_and_reports_drops(self):
+        path = os.path.join(self.dir, 'scraping.log')
+        handler = setup_logging(path, level='DEBUG', use_queue=True)
+        handler.queue.maxsize = 1 # The listener can't keep up: debug lines are dropped, warnings wait for room
+        for i in range(200):
+            self.logger.debug('Found song: %s', i)
+            self.logger.warning('Failed: %s', i)
+        stop_logging()
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+        self.assertEqual(text.count('Failed: '), 200)
+        self.assertIn(f'{handler.dropped} log records were dropped', text)
+
+    def test_warnings_wait_for_room_only_so_long(self):
+        handler = LazyQueueHandler(queue.Queue(maxsize=1), timeout=0.05)
+        handler.handle(self.record('Failed: %s', 1, level=logging.WARNING))
+        handler.handle(self.record('Failed: %s', 2, level=logging.WARNING)) # Nobody reads the queue
+        self.assertEqual(handler.dropped, 1)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_forked_workers_log_to_the_file(self):
+        path = os.path.join(self.dir, 'scraping.log')
+        setup_logging(path, level='INFO', use_queue=True)
+        context = multiprocessing.get_context('fork')
+        child = context.Process(target=log_in_child)
+        child.start()
+        child.join(10)
+        self.assertEqual(child.exitcode, 0)
+        self.logger.info('From the parent')
+        stop_logging()
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+        self.assertIn('From the parent', text)
+        self.assertIn('From the child: info', text)
+        self.assertIn('From the child: warning', text)
+
+    def test_async_file_is_rotated(self):
+        path = os.path.join(self.dir, 'scraping.jsonl')
+        setup_logging(path, level='DEBUG', json_format=True, use_queue=True, max_bytes=2000, backups=2)
+        for i in range(100):
+            self.logger.debug('Found song: %s', i, extra={'album': 'Nothing Personal'})
+        stop_logging()
+        files = sorted(glob.glob(path + '*'))
+        self.assertEqual(len(files), 3)
+        with open(path, encoding='utf-8') as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual((entries[-1]['message'], entries[-1]['album']), ('Found song: 99', 'Nothing Personal'))
+
+if __name__ == '__main__':
+    unittest.main()
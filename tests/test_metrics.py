@@ -0,0 +1,81 @@
+import json
+import unittest
+import urllib.request
+from unittest import mock
+from config import settings
+from scripts.metrics import MetricsRegistry, MetricsServer, metrics
+from scripts.http_transport import HttpTransport
+from scripts.scrape_lyrics import AZLyrics
+from scripts.services import registry
+from scripts.slug_index import SlugIndex
+from tests.stub_server import StubServer
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def test_disabled_records_nothing(self):
+        registry = MetricsRegistry(enabled=False)
+        registry.inc('requests_total')
+        registry.observe('parse_seconds', 0.5)
+        with registry.timer('stage_seconds', stage='scrape'):
+            pass
+        self.assertEqual(registry.to_dict(), {'counters': [], 'histograms': []})
+
+    def test_counters_and_histograms(self):
+        registry = MetricsRegistry(enabled=True, buckets=(0.1, 1))
+        registry.inc('http_responses_total', status='2xx')
+        registry.inc('http_responses_total', 2, status='2xx')
+        registry.inc('http_responses_total', status='5xx')
+        for value in (0.05, 0.5, 5):
+            registry.observe('parse_seconds', value, page='lyrics')
+        with registry.timer('parse_seconds', page='lyrics'):
+            pass
+        data = registry.to_dict()
+        self.assertEqual([(c['labels'], c['value']) for c in data['counters']], [({'status': '2xx'}, 3), ({'status': '5xx'}, 1)])
+        histogram, = data['histograms']
+        self.assertEqual((histogram['count'], histogram['buckets']), (4, {'0.1': 2, '1': 3, '+Inf': 4}))
+
+        text = registry.to_prometheus()
+        self.assertIn('# TYPE http_responses_total counter\nhttp_responses_total{status="2xx"} 3\n', text)
+        self.assertIn('parse_seconds_bucket{page="lyrics",le="+Inf"} 4\n', text)
+        self.assertIn('parse_seconds_count{page="lyrics"} 4\n', text)
+        self.assertIn('parse_seconds{page="lyrics"}', registry.report())
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        patcher = mock.patch.object(settings, 'AZLYRICS_BASE_URL', self.server.base_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        slugs = SlugIndex(':memory:')
+        slugs.add_artist('All Time Low', 'alltimelow') # Known, so only lyrics pages are requested
+        self.enterContext(registry.override(slug_index=slugs))
+        metrics.reset()
+        metrics.enable()
+        self.addCleanup(setattr, metrics, 'enabled', False)
+        self.addCleanup(metrics.reset)
+
+    def value(self, name: str, **labels) -> float:
+        return sum(c['value'] for c in metrics.to_dict()['counters'] if c['name'] == name and labels.items() <= c['labels'].items())
+
+    def test_scrape_is_counted_and_served(self):
+        transport = HttpTransport(retries=0)
+        for song in ('Weightless', 'Weightless', 'Missing Song'):
+            AZLyrics('All Time Low', song, fetcher=transport).open_url()
+        self.assertEqual(self.value('http_responses_total', status='2xx'), 1)
+        self.assertEqual(self.value('http_responses_total', status='4xx'), 1)
+        self.assertEqual(self.value('page_cache_total', result='hit'), 1)
+        self.assertEqual(self.value('pages_scraped_total', page='lyrics'), 2)
+        self.assertEqual(self.value('scrape_failures_total', page='lyrics'), 1)
+
+        server = MetricsServer(port=0).start()
+        self.addCleanup(server.stop)
+        with urllib.request.urlopen(server.url) as response:
+            self.assertIn('http_request_seconds_count 2', response.read().decode('utf-8'))
+        with urllib.request.urlopen(server.url + '.json') as response:
+            histograms = {h['name'] for h in json.load(response)['histograms']}
+        self.assertEqual(histograms, {'http_request_seconds', 'parse_seconds'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import mongomock
+from scripts.near_duplicates import DuplicateDetector, MinHasher, base_title, find_duplicates, similarity
+from scripts.services import registry
+from tests.test_sentiment_engine import fixture_lyrics
+
+def live_version(lyrics: str) -> str:
+    # What a live page looks like: a spoken intro, one line dropped and a chorus repeated
+    lines = lyrics.split('\n')
+    return '\n'.join(['Thank you Reading, this one is for you!'] + lines[:5] + lines[6:] + lines[-4:])
+
+class TestMinHash(unittest.TestCase):
+
+    def setUp(self):
+        self.hasher = MinHasher()
+        self.lyrics = fixture_lyrics()
+
+    def test_similarity(self):
+        signatures = [self.hasher.signature(text) for text in self.lyrics]
+        self.assertEqual(similarity(signatures[0], self.hasher.signature(self.lyrics[0])), 1.0)
+        self.assertGreater(similarity(signatures[0], self.hasher.signature(live_version(self.lyrics[0]))), 0.7)
+        self.assertLess(similarity(signatures[0], signatures[1]), 0.2)
+        self.assertIsNone(self.hasher.signature(''))
+
+    def test_base_title(self):
+        for title in ('Weightless (Live)', 'Weightless [Acoustic Version]', 'Weightless - Live At Reading',
+                      'Weightless (Remix) [Remastered]', 'weightless'):
+            self.assertEqual(base_title(title), 'weightless', title)
+        self.assertEqual(base_title('Mix Tape'), 'mix tape')
+        self.assertEqual(base_title('Therapy (Reprise)'), 'therapy (reprise)')
+
+class TestDuplicateDetector(unittest.TestCase):
+
+    def setUp(self):
+        self.lyrics = fixture_lyrics()
+        self.detector = DuplicateDetector()
+
+    def song(self, title: str, lyrics: str) -> dict:
+        return {'title': title, 'artist': 'Artist', 'lyrics': lyrics}
+
+    def test_check(self):
+        for i, text in enumerate(self.lyrics):
+            doc = self.detector.check(self.song(f'Song {i}', text))
+            self.assertNotIn('duplicate_of', doc)
+            self.assertEqual(len(doc['minhash']), 4 * self.detector.hasher.num_perm)
+        doc = self.detector.check(self.song('Song 0 (Live)', live_version(self.lyrics[0])))
+        self.assertEqual(doc['duplicate_of'], 'Song 0')
+        self.assertGreater(doc['duplicate_similarity'], 0.7)
+        self.assertIn('lyrics', doc)
+        linked = self.detector.check(self.song('Song 1 (Acoustic)', self.lyrics[1]), link=True)
+        self.assertEqual((linked['duplicate_of'], linked['duplicate_similarity']), ('Song 1', 1.0))
+        self.assertNotIn('lyrics', linked)
+
+    def test_likely_duplicates(self):
+        self.detector.add('Weightless', None)
+        titles = ['Weightless (Live)', 'Damned If I Do Ya (Acoustic)', 'Damned If I Do Ya', 'Remembering Sunday (Live)']
+        self.assertEqual(self.detector.likely_duplicates(titles),
+                         {'Weightless (Live)': 'Weightless', 'Damned If I Do Ya (Acoustic)': 'Damned If I Do Ya'})
+
+    def test_load_and_find_duplicates(self):
+        db = mongomock.MongoClient().lyrical_analysis_db
+        self.enterContext(registry.override(db=db))
+        # The version is stored first, the original still ends up canonical
+        db.songs.insert_many([self.song('Song 0 (Live)', live_version(self.lyrics[0]))]
+                             + [self.song(f'Song {i}', text) for i, text in enumerate(self.lyrics)])
+        self.assertEqual(find_duplicates(link=True), 1)
+        live = db.songs.find_one({'title': 'Song 0 (Live)'})
+        self.assertEqual(live['duplicate_of'], 'Song 0')
+        self.assertNotIn('lyrics', live)
+        self.assertEqual(find_duplicates(), 0)
+
+        detector = DuplicateDetector.load('Artist')
+        self.assertEqual(set(detector.canonical), {f'Song {i}' for i in range(len(self.lyrics))})
+        self.assertEqual(detector.match(detector.hasher.signature(self.lyrics[2]))[0], 'Song 2')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from scripts.page_cache import PageCache
+
+def put_shared_pages(directory: str, worker: int):
+    # Every process stores the same few bodies under its own URLs, on a budget that keeps evicting them
+    cache = PageCache(directory, max_bytes=6000)
+    for i in range(60):
+        cache.put(f'http://x/{worker}/{i}.html', bytes([i % 4]) * 4000 + os.urandom(500 * (i % 2)))
+    cache.close()
+
+class TestPageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache = PageCache(self.tmp.name)
+        self.addCleanup(self.cache.close)
+
+    def test_round_trip(self):
+        self.cache.put('http://x/a.html', b'<html>a</html>', encoding='utf-8', etag='"1"')
+        entry = self.cache.get('http://x/a.html')
+        self.assertEqual(entry['content'], b'<html>a</html>')
+        self.assertEqual(entry['etag'], '"1"')
+        self.assertIsNone(self.cache.get('http://x/b.html'))
+
+    def test_persists_between_instances(self):
+        self.cache.put('http://x/a.html', b'body')
+        other = PageCache(self.tmp.name)
+        self.assertEqual(other.get('http://x/a.html')['content'], b'body')
+        other.close()
+
+    def test_identical_bodies_stored_once(self):
+        self.cache.put('http://x/a.html', b'same body')
+        self.cache.put('http://x/b.html', b'same body')
+        objects = [f for _, _, files in os.walk(os.path.join(self.tmp.name, 'objects')) for f in files]
+        self.assertEqual(len(objects), 1)
+        self.cache.delete('http://x/a.html')
+        self.assertEqual(self.cache.get('http://x/b.html')['content'], b'same body')
+
+    def test_lru_eviction(self):
+        cache = PageCache(self.tmp.name, max_bytes=1)
+        self.addCleanup(cache.close)
+        cache.put('http://x/a.html', os.urandom(2000))
+        cache.put('http://x/b.html', os.urandom(2000))
+        # Over budget, only the most recently used page survives
+        self.assertEqual(cache.urls(), ['http://x/b.html'])
+
+    def test_running_size(self):
+        self.cache.put('http://x/a.html', os.urandom(1000))
+        self.cache.put('http://x/b.html', os.urandom(1000))
+        self.cache.put('http://x/c.html', os.urandom(1000))
+        self.cache.put('http://x/a.html', os.urandom(500))  # Replaced, the old body is dropped
+        self.cache.put('http://x/d.html', self.cache.get('http://x/b.html')['content']) # Shared, counted once
+        self.cache.delete('http://x/c.html')
+        on_disk = sum(os.path.getsize(os.path.join(root, name))
+                      for root, _, files in os.walk(os.path.join(self.tmp.name, 'objects')) for name in files)
+        self.assertEqual(self.cache.size(), on_disk)
+        other = PageCache(self.tmp.name)
+        self.assertEqual(other.size(), on_disk)
+        other.close()
+
+    def test_processes_share_the_cache(self):
+        with ProcessPoolExecutor(max_workers=3) as pool:
+            list(pool.map(put_shared_pages, [self.tmp.name] * 3, range(3)))
+        # No indexed page lost its body to another process's eviction, and the running total still adds up
+        for url in self.cache.urls():
+            self.assertIsNotNone(self.cache.get(url), url)
+        on_disk = sum(os.path.getsize(os.path.join(root, name))
+                      for root, _, files in os.walk(os.path.join(self.tmp.name, 'objects')) for name in files)
+        self.assertEqual(self.cache.size(), on_disk)
+
+    def test_freshness_without_reading_the_body(self):
+        self.assertIsNone(self.cache.fetched_at('http://x/a.html'))
+        self.cache.put('http://x/a.html', b'body')
+        accessed = self.cache.db.execute('SELECT accessed_at FROM pages').fetchone()
+        self.assertIsNotNone(self.cache.fetched_at('http://x/a.html'))
+        self.assertEqual(self.cache.db.execute('SELECT accessed_at FROM pages').fetchone(), accessed)
+
+    def test_prune(self):
+        self.cache.put('http://x/a.html', b'old')
+        self.cache.prune(max_age=0)
+        self.assertEqual(self.cache.urls(), [])
+
+if __name__ == '__main__':
+    unittest.main()
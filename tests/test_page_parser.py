@@ -0,0 +1,51 @@
+import os
+import unittest
+from scripts.page_parser import LyricsPageParser
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'pages')
+
+def load_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURE_DIR, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+class TestLyricsPageParser(unittest.TestCase):
+
+    def setUp(self):
+        self.html = load_fixture('lyrics_alltimelow_theotherside.html')
+
+    def test_parse_fields(self):
+        lyrics, genre, album, writers = LyricsPageParser().parse(self.html)
+        self.assertIn('On the other side', lyrics)
+        self.assertEqual(genre, 'Pop')
+        self.assertEqual(album, """Tell Me I'm Alive"(2023)""")
+        self.assertEqual(writers, 'Bonnie Leigh McKee, Zakk Cervini, Jack Barakat, Alex Gaskarth')
+
+    def test_missing_fields(self):
+        html = '<html><head></head><body><div class="col-xs-12 col-lg-8 text-center"><div>a<br>b</div></div></body></html>'
+        lyrics, genre, album, writers = LyricsPageParser().parse(html)
+        self.assertEqual(lyrics, 'ab')
+        self.assertEqual(genre, 'Genre not found')
+        self.assertEqual(album, 'Album not found')
+        self.assertEqual(writers, 'Writers not found')
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            LyricsPageParser(backend='regex')
+
+    def test_backends_agree(self):
+        # Optional backends are only checked when installed
+        expected = LyricsPageParser().parse(self.html)
+        for backend in ('lxml', 'selectolax'):
+            with self.subTest(backend=backend):
+                try:
+                    page_parser = LyricsPageParser(backend=backend)
+                    if backend == 'lxml':
+                        import lxml # BeautifulSoup only looks for it when parsing
+                except ImportError:
+                    self.skipTest(f'{backend} is not installed')
+                result = page_parser.parse(self.html)
+                self.assertEqual(result[0].strip(), expected[0].strip())
+                self.assertEqual(result[1:], expected[1:])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from config import settings
+from scripts.http_transport import HttpTransport
+from tests.record_fixtures import record_artist
+from tests.stub_server import StubServer, fixture_routes
+
+class TestRecordFixtures(unittest.TestCase):
+
+    def test_recorded_pages_are_replayed_under_the_same_paths(self):
+        with tempfile.TemporaryDirectory() as directory, StubServer() as server, \
+                mock.patch.object(settings, 'AZLYRICS_BASE_URL', server.base_url):
+            saved = record_artist('All Time Low', HttpTransport(retries=0), songs=['Weightless', 'Missing Song'], directory=directory)
+            self.assertEqual(sorted(os.path.basename(path) for path in saved),
+                             ['discography_alltimelow.html', 'letter_a.html', 'lyrics_alltimelow_weightless.html'])
+            recorded = fixture_routes(directory)
+            self.assertEqual(set(recorded), {'/a.html', '/a/alltimelow.html', '/lyrics/alltimelow/weightless.html'})
+            for route, path in recorded.items():
+                with open(path, 'rb') as copy, open(server.routes[route], 'rb') as original:
+                    self.assertEqual(copy.read(), original.read())
+
+if __name__ == '__main__':
+    unittest.main()
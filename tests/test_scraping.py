@@ -1,10 +1,17 @@
 import unittest
+from unittest import mock
+from config import settings
 from scripts.scrape_lyrics import AZLyrics
+from scripts.http_transport import HttpTransport
+from scripts.services import registry
+from scripts.slug_index import SlugIndex
+from tests.stub_server import StubServer
 
 class TestAZLyrics(unittest.TestCase):
 
     def setUp(self):
         # Setup runs before each test case
+        self.enterContext(registry.override(slug_index=SlugIndex(':memory:')))
         self.az = AZLyrics(artist='All Time Low', song='The Other Side')
 
     def test_parse_artist(self):
@@ -21,8 +28,10 @@ class TestAZLyrics(unittest.TestCase):
         self.assertEqual(self.az.url(), expected_url)
 
     def test_open_url(self):
-        # Test if the lyrics and genre are correctly scraped
-        lyrics, genre, album, writers = self.az.open_url()
+        # Test if the lyrics and genre are correctly scraped, from the saved page replayed by a local server
+        with StubServer() as server, mock.patch.object(settings, 'AZLYRICS_BASE_URL', server.base_url):
+            az = AZLyrics(artist='All Time Low', song='The Other Side', fetcher=HttpTransport(retries=0))
+            lyrics, genre, album, writers = az.open_url()
         self.assertIsNotNone(lyrics)
         self.assertIsNotNone(genre)
         self.assertIsNotNone(album)
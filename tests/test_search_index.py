@@ -0,0 +1,76 @@
+import tempfile
+import unittest
+import mongomock
+import numpy as np
+from scripts.search_index import SearchIndex, decode_varints, encode_varints, parse_query, update_search_index
+from scripts.upload_to_mongodb import lyrics_hash
+
+LYRICS = {
+    'The Other Side': "On the other side of the world\nI'll be waiting on the other side",
+    'Weightless': "Maybe it's not my weekend\nBut it's gonna be my year",
+    'Side Effects': "The side effects of love\nthe other one",
+    'Heartbreak': "Don't you know the other day\nyou broke my heart",
+}
+
+def song(title: str, lyrics: str) -> dict:
+    return {'artist': 'Artist', 'title': title, 'lyrics': lyrics, 'lyrics_hash': lyrics_hash(lyrics)}
+
+class TestVarints(unittest.TestCase):
+
+    def test_round_trip(self):
+        values = [0, 1, 127, 128, 300, 16383, 16384, 2 ** 31, 2 ** 62]
+        data = encode_varints(values)
+        self.assertEqual(len(data), 1 + 1 + 1 + 2 + 2 + 2 + 3 + 5 + 9)
+        self.assertEqual(decode_varints(data).tolist(), values)
+        self.assertEqual(decode_varints(encode_varints([])).tolist(), [])
+
+class TestSearchIndex(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.songs = mongomock.MongoClient().lyrical_analysis_db.songs
+        self.songs.insert_many([song(title, lyrics) for title, lyrics in LYRICS.items()])
+        self.index = SearchIndex(directory.name)
+        self.addCleanup(self.index.close)
+        # Two songs per segment
+        self.assertEqual(update_search_index(self.songs, self.index, batch_size=2), 4)
+
+    def titles(self, query: str) -> set:
+        return {title for _, title in self.index.search(query)}
+
+    def test_queries(self):
+        self.assertEqual(self.titles('"On the other side"'), {'The Other Side'})
+        self.assertEqual(self.titles('"the other"'), {'The Other Side', 'Side Effects', 'Heartbreak'})
+        self.assertEqual(self.titles('other side'), {'The Other Side', 'Side Effects'})
+        self.assertEqual(self.titles('"other side" OR weekend'), {'The Other Side', 'Weightless'})
+        self.assertEqual(self.titles('"the other" -side'), {'Heartbreak'})
+        self.assertEqual(self.titles('"the other" NOT (love OR world)'), {'Heartbreak'})
+        self.assertEqual(self.titles('NOT other'), {'Weightless'})
+        self.assertEqual(self.titles("don't AND heart"), {'Heartbreak'})
+        self.assertEqual(self.titles('"side the"'), set())
+        self.assertEqual(self.titles('missing'), set())
+        for query in ('', '(other', 'other)', 'NOT'):
+            with self.assertRaises(ValueError):
+                parse_query(query)
+
+    def test_incremental_updates_and_compaction(self):
+        self.assertEqual(update_search_index(self.songs, self.index), 0)
+        lyrics = 'Nothing left on the other side'
+        self.songs.update_one({'title': 'Weightless'}, {'$set': {'lyrics': lyrics, 'lyrics_hash': lyrics_hash(lyrics)}})
+        self.songs.insert_one(song('New', 'a brand new song'))
+        self.assertEqual(update_search_index(self.songs, self.index), 2)
+        self.assertEqual(self.titles('"on the other side"'), {'The Other Side', 'Weightless'})
+        self.assertEqual(self.titles('weekend'), set()) # The replaced lyrics no longer match
+        self.assertEqual(self.index.segment_count(), 3)
+
+        expected = {query: self.index.search(query) for query in ('"the other"', 'new', 'NOT side', 'weekend')}
+        self.index.compact()
+        self.assertEqual(self.index.segment_count(), 1)
+        self.assertEqual({query: self.index.search(query) for query in expected}, expected)
+        doc_count, docs, _ = self.index.db.execute("SELECT doc_count, docs, positions FROM postings WHERE term = 'other'").fetchone()
+        self.assertEqual(doc_count, 4)
+        self.assertTrue(np.all(np.diff(SearchIndex._decode(doc_count, docs)[0]) > 0))
+
+if __name__ == '__main__':
+    unittest.main()
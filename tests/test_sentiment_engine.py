@@ -0,0 +1,146 @@
+import os
+import unittest
+from unittest import mock
+import mongomock
+import nltk
+from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+from scripts.page_parser import LyricsPageParser
+import scripts.sentiment_engine as sentiment_engine
+from scripts.sentiment_engine import BatchSentimentEngine, FastVaderAnalyzer, NRCScorer, NRC_EMOTIONS
+from scripts.upload_to_mongodb import lyrics_hash
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'pages')
+
+TRICKY = [
+    "VADER is VERY SMART, uber handsome, and FRIGGIN FUNNY!!!",
+    "VADER is not smart, handsome, nor funny.",
+    "At least it isn't a horrible book.",
+    "The book was only kind of good.",
+    "The plot was good, but the characters are uncompelling and the dialog is not great.",
+    "Today only kinda sux! But I'll get by, lol",
+    "Catch utf-8 emoji such as 💘 and 💋 and 😁",
+    "Sentiment analysis has never been this good!",
+    "With VADER, sentiment analysis is the shit!",
+    "Without a doubt, an excellent idea.",
+    "Roger Dodger is one of the least compelling variations on this theme.",
+    "no love no hate, no or nor good ???",
+    "",
+]
+
+def fixture_lyrics() -> list:
+    page_parser = LyricsPageParser()
+    lyrics = []
+    for name in sorted(os.listdir(FIXTURE_DIR)):
+        if name.startswith('lyrics_'):
+            with open(os.path.join(FIXTURE_DIR, name), 'r', encoding='utf-8') as f:
+                lyrics.append(page_parser.parse(f.read())[0])
+    return lyrics
+
+def has_punkt() -> bool:
+    try:
+        nltk.data.find('tokenizers/punkt_tab')
+        return True
+    except LookupError:
+        return False
+
+class TestSentimentParity(unittest.TestCase):
+
+    def setUp(self):
+        self.texts = fixture_lyrics() + TRICKY
+
+    def test_vader_matches_stock_analyzer(self):
+        stock, fast = SentimentIntensityAnalyzer(), FastVaderAnalyzer()
+        for text in self.texts:
+            self.assertEqual(fast.polarity_scores(text), stock.polarity_scores(text), text)
+
+    @unittest.skipUnless(has_punkt(), "NRCLex needs the nltk punkt tokenizer")
+    def test_nrc_matches_nrclex(self):
+        from scripts.sentiment_analysis import analyze_sentiment_nrc
+        scores = NRCScorer().score_many(self.texts)
+        for text, score in zip(self.texts, scores):
+            self.assertEqual(score, analyze_sentiment_nrc(text), text)
+
+    def test_nrc_frequencies(self):
+        scorer = NRCScorer({'abandon': ['fear', 'negative', 'sadness'], 'joy': ['joy', 'positive']})
+        score = scorer.score_many(["Abandon, abandon\nall joy.", "nothing here"])
+        # Lookups are case sensitive like NRCLex, totals include positive and negative
+        self.assertEqual(score[0], dict.fromkeys(NRC_EMOTIONS, 0.0) | {'fear': 0.2, 'sadness': 0.2, 'joy': 0.2})
+        self.assertEqual(score[1], dict.fromkeys(NRC_EMOTIONS, 0.0))
+
+class TestBatchSentimentEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.songs = mongomock.MongoClient().lyrical_analysis_db.songs
+        texts = fixture_lyrics() + TRICKY
+        self.songs.insert_many([{'title': f'Song {i}', 'artist': 'Artist', 'lyrics': text} for i, text in enumerate(texts)])
+        self.songs.insert_one({'title': 'No lyrics', 'artist': 'Artist'})
+
+    def test_update_collection(self):
+        updated = BatchSentimentEngine(processes=1, chunk_size=4, batch_size=3).update_collection(self.songs)
+        self.assertEqual(updated, self.songs.count_documents({}))
+        stock = SentimentIntensityAnalyzer()
+        for song in self.songs.find():
+            self.assertEqual(song['sentiment']['vader'], stock.polarity_scores(song.get('lyrics', '')))
+            self.assertEqual(set(song['sentiment']['nrc']), set(NRC_EMOTIONS))
+
+    def test_process_pool_matches_inline(self):
+        songs = list(self.songs.find())
+        inline = {song['_id']: s for song, s in BatchSentimentEngine(processes=1, chunk_size=4).score_songs(songs)}
+        pooled = {song['_id']: s for song, s in BatchSentimentEngine(processes=2, chunk_size=4).score_songs(songs)}
+        self.assertEqual(pooled, inline)
+
+    def test_incremental_scores_only_new_and_changed_songs(self):
+        engine = BatchSentimentEngine(processes=1, chunk_size=4)
+        total = self.songs.count_documents({})
+        self.assertEqual(engine.update_collection(self.songs, incremental=True), total)
+        self.assertEqual(engine.update_collection(self.songs, incremental=True), 0)
+
+        # Writers flag the songs whose lyrics they store, like make_song_doc and reparse_cached_songs
+        self.songs.update_one({'title': 'Song 0'}, {'$set': {'lyrics': 'I love it', 'lyrics_hash': lyrics_hash('I love it'),
+                                                             'sentiment_stale': True}})
+        self.songs.insert_one({'title': 'New', 'artist': 'Artist', 'lyrics': 'so sad', 'lyrics_hash': lyrics_hash('so sad'),
+                               'sentiment_stale': True})
+        self.assertEqual(engine.update_collection(self.songs, incremental=True), 2)
+        self.assertGreater(self.songs.find_one({'title': 'Song 0'})['sentiment']['vader']['pos'], 0)
+        self.assertEqual(self.songs.count_documents({'sentiment_stale': True}), 0)
+
+        # A new analyzer version flags every song once, later runs only read the flagged ones
+        with mock.patch.object(sentiment_engine, 'SENTIMENT_VERSION', 'next'):
+            self.assertEqual(engine.update_collection(self.songs, incremental=True), total + 1)
+            self.assertEqual(BatchSentimentEngine.mark_stale(self.songs), 0)
+        self.assertEqual(self.songs.count_documents({'sentiment_version': 'next'}), total + 1)
+
+    def test_lyrics_stored_while_scoring_stay_stale(self):
+        engine = BatchSentimentEngine(processes=1, chunk_size=4)
+        original = engine.score_songs
+        song_id = self.songs.find_one({'title': 'Song 0'})['_id']
+
+        def reparsed_meanwhile(songs):
+            for song, sentiment in original(songs):
+                if song['_id'] == song_id:
+                    self.songs.update_one({'_id': song['_id']}, {'$set': {'lyrics': 'new', 'lyrics_hash': lyrics_hash('new'),
+                                                                           'sentiment_stale': True}})
+                yield song, sentiment
+
+        with mock.patch.object(engine, 'score_songs', reparsed_meanwhile):
+            engine.update_collection(self.songs, incremental=True)
+        song = self.songs.find_one({'title': 'Song 0'})
+        self.assertEqual((song['lyrics_hash'], song['sentiment_stale']), (lyrics_hash('new'), True))
+        self.assertEqual(engine.update_collection(self.songs, incremental=True), 1)
+        self.assertEqual(self.songs.find_one({'title': 'Song 0'})['sentiment_hash'], lyrics_hash('new'))
+
+    def test_songs_without_lyrics_hash(self):
+        engine = BatchSentimentEngine(processes=1, chunk_size=4)
+        engine.update_collection(self.songs)
+        # Stored before songs carried a hash: current sentiment is kept, lyrics edited since then are rescored
+        self.songs.update_many({}, {'$unset': {'lyrics_hash': ''}})
+        self.songs.update_one({'title': 'Song 0'}, {'$set': {'sentiment': 'kept'}})
+        self.songs.update_one({'title': 'Song 1'}, {'$set': {'lyrics': 'edited'}})
+        self.assertEqual(engine.update_collection(self.songs, incremental=True), self.songs.count_documents({}))
+        self.assertEqual(self.songs.find_one({'title': 'Song 0'})['sentiment'], 'kept')
+        self.assertEqual(self.songs.find_one({'title': 'Song 1'})['sentiment_hash'], lyrics_hash('edited'))
+        self.assertEqual(self.songs.count_documents({'lyrics_hash': {'$exists': False}}), 0)
+        self.assertEqual(engine.update_collection(self.songs, incremental=True), 0)
+
+if __name__ == '__main__':
+    unittest.main()
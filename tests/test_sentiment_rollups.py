@@ -0,0 +1,79 @@
+import unittest
+from unittest import mock
+import mongomock
+import scripts.sentiment_analysis as sentiment_analysis
+from scripts.sentiment_engine import NRC_EMOTIONS, sentiment_fields
+from scripts.sentiment_rollups import get_rollups, refresh_rollups, rollup_collection
+from scripts.services import registry
+
+def scores(compound: float, joy: float = 0.0) -> dict:
+    return {'vader': {'neg': 0.0, 'neu': 1.0, 'pos': 0.0, 'compound': compound},
+            'nrc': dict.fromkeys(NRC_EMOTIONS, 0.0) | {'joy': joy}}
+
+class TestSentimentRollups(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().lyrical_analysis_db
+        self.enterContext(registry.override(db=self.db))
+        self.songs = self.db.songs
+        for title, album, year, compound in (('A', 'One', '2009', 0.5), ('B', 'One', '2009', -0.5),
+                                             ('C', 'Two', '2011', 1.0)):
+            self.songs.insert_one({'title': title, 'artist': 'Artist', 'album': album, 'release_year': year,
+                                   'lyrics_hash': title, **sentiment_fields(scores(compound, joy=0.2), title)})
+        self.songs.insert_one({'title': 'Unscored', 'artist': 'Other', 'album': 'Three', 'release_year': '2009',
+                               'lyrics_hash': 'u'})
+
+    def rollup(self, level: str, **key) -> dict:
+        return rollup_collection(level).find_one(key, {'_id': 0, 'updated_at': 0})
+
+    def test_summaries(self):
+        self.assertEqual(refresh_rollups(), 4)
+        album = self.rollup('album', artist='Artist', album='One')
+        self.assertEqual((album['songs'], album['scored'], album['vader_compound']), (2, 2, {'mean': 0.0, 'variance': 0.25}))
+        self.assertAlmostEqual(album['nrc']['joy'], 0.2)
+        artist = self.rollup('artist', artist='Artist')
+        self.assertEqual((artist['songs'], artist['scored']), (3, 3))
+        self.assertAlmostEqual(artist['vader_compound']['mean'], 1 / 3)
+        self.assertAlmostEqual(artist['vader_compound']['variance'], (0.25 + 0.25 + 1) / 3 - 1 / 9)
+        year = self.rollup('year', release_year='2009')
+        self.assertEqual((year['songs'], year['scored'], year['vader_compound']['mean']), (3, 2, 0.0))
+        self.assertEqual(self.rollup('artist', artist='Other')['vader_compound'], {'mean': None, 'variance': None})
+        self.assertEqual(len(get_rollups('album')), 3)
+
+    def test_incremental_refresh(self):
+        refresh_rollups()
+        self.assertEqual(refresh_rollups(), 0)
+        before = self.rollup('year', release_year='2011')
+
+        # Scoring a song flags it, the next refresh only recomputes its own album, artist and year
+        with mock.patch.object(sentiment_analysis, 'analyze_sentiment_nrc', lambda text: scores(0)['nrc']):
+            sentiment_analysis.update_song_with_sentiment(self.songs.find_one({'title': 'Unscored'}))
+        self.assertEqual(self.songs.count_documents({'rollup_stale': True}), 1)
+        self.assertEqual(refresh_rollups(), 1)
+        self.assertEqual(refresh_rollups(), 0)
+        self.assertEqual(self.rollup('artist', artist='Other')['scored'], 1)
+        self.assertEqual(self.rollup('year', release_year='2009')['scored'], 3)
+        self.assertEqual(self.rollup('year', release_year='2011'), before)
+
+        # A rescored song that moved to another album leaves its old groups, emptied groups are removed
+        self.songs.update_one({'title': 'C'}, {'$set': {'album': 'One', 'release_year': '2009',
+                                                         **sentiment_fields(scores(-1.0), 'C2')}})
+        self.assertEqual(refresh_rollups(), 1)
+        self.assertEqual(self.rollup('album', artist='Artist', album='One')['songs'], 3)
+        self.assertIsNone(self.rollup('album', artist='Artist', album='Two'))
+        self.assertIsNone(self.rollup('year', release_year='2011'))
+        self.assertEqual(self.rollup('artist', artist='Artist')['vader_compound']['mean'], -1 / 3)
+
+    def test_songs_stored_before_the_flag(self):
+        refresh_rollups()
+        # Counted or rescored before songs carried rollup_stale, only the rescored one is flagged, once
+        self.songs.update_many({}, {'$unset': {'rollup_stale': ''}})
+        self.db.pipeline_state.delete_many({})
+        self.songs.update_one({'title': 'A'}, {'$set': {'sentiment_hash': 'A2'}})
+        self.assertEqual(refresh_rollups(), 1)
+        self.assertEqual(self.songs.count_documents({'rollup_stale': False}), 1)
+        self.songs.update_one({'title': 'B'}, {'$set': {'sentiment_hash': 'B2'}})
+        self.assertEqual(refresh_rollups(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+import unittest
+import mongomock
+from scripts.services import ServiceRegistry, registry
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+class TestServiceRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.services = ServiceRegistry()
+        self.built = []
+        self.services.register('db', lambda: self.built.append('db') or mongomock.MongoClient().test_db)
+        self.services.register('songs', lambda: self.services.get('db').songs)
+
+    def test_built_once_on_first_use(self):
+        self.assertEqual(self.services.created(), [])
+        songs = self.services.get('songs')
+        self.assertIs(self.services.get('songs'), songs)
+        self.assertEqual(self.built, ['db'])
+        self.assertEqual(sorted(self.services.created()), ['db', 'songs'])
+
+    def test_override_redirects_dependents(self):
+        original = self.services.get('songs')
+        other = mongomock.MongoClient().other_db
+        with self.services.override(db=other):
+            self.assertEqual(self.services.get('songs').database.name, 'other_db')
+        self.assertIs(self.services.get('songs'), original)
+
+    def test_reset_and_unknown(self):
+        self.services.get('songs')
+        self.services.reset()
+        self.assertEqual(self.services.created(), [])
+        with self.assertRaises(KeyError):
+            self.services.get('missing')
+
+    def test_settings_driven_defaults(self):
+        with registry.override(mongo_client=mongomock.MongoClient()):
+            self.assertEqual(registry.get('songs_collection').full_name, 'lyrical_analysis_db.songs')
+
+    def test_imports_have_no_side_effects(self):
+        # A fresh interpreter importing every module must not build a client, an analyzer or a log file
+        code = ('import os, main, scripts.upload_to_mongodb, scripts.sentiment_analysis, scripts.bulk_scrape_lyrics, '
+                'scripts.job_queue\n'
+                'from scripts.services import registry\n'
+                'import logging\n'
+                'print(registry.created(), logging.getLogger().handlers)')
+        result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), '[] []')
+
+if __name__ == '__main__':
+    unittest.main()
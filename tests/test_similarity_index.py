@@ -0,0 +1,108 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from config import settings
+from scripts.generate_embeddings import EmbeddingStore
+from scripts.similarity_index import IVFIndex, exact_search, similar_songs
+
+def unit_vectors(n: int, dim: int, seed: int) -> np.ndarray:
+    # Points around a few directions, so the clusters mean something
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(8, dim))
+    vectors = centres[rng.integers(0, 8, n)] + rng.normal(scale=0.3, size=(n, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+class TestIVFIndex(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.store = EmbeddingStore(self.directory, dim=16, model='test')
+        self.addCleanup(self.store.close)
+        self.put(unit_vectors(400, 16, seed=0))
+
+    def put(self, vectors: np.ndarray):
+        start = len(self.store)
+        self.store.put_many([(f'id{i}', 'h', 'Artist', f'Song {i}') for i in range(start, start + len(vectors))], vectors)
+
+    def test_full_probe_matches_exact_search(self):
+        index = IVFIndex(self.store, nlist=10)
+        index.build()
+        self.assertEqual(index.meta['nlist'], 10)
+        vectors = self.store.vectors()
+        for row in (0, 17, 399):
+            expected = exact_search(vectors, vectors[row], k=5, exclude=row)
+            hits = index.search(vectors[row], k=5, nprobe=10, exclude=row)
+            self.assertEqual([r for r, _ in hits], [r for r, _ in expected])
+            np.testing.assert_allclose([s for _, s in hits], [s for _, s in expected], rtol=1e-5)
+
+    def test_exact_search_never_returns_the_excluded_row(self):
+        vectors = self.store.vectors()[:3]
+        hits = exact_search(vectors, vectors[1], k=5, exclude=1)
+        self.assertEqual(sorted(row for row, _ in hits), [0, 2])
+        self.assertEqual(exact_search(vectors[:1], vectors[0], k=5, exclude=0), [])
+
+    def test_incremental_inserts(self):
+        index = IVFIndex(self.store, nlist=10, nprobe=3)
+        self.assertEqual(index.update(), 400)
+        self.put(unit_vectors(50, 16, seed=1))
+        self.assertEqual(index.update(), 50)
+        self.assertEqual(index.update(), 0)
+        # New songs are found from a reopened index, without a rebuild
+        index = IVFIndex(self.store)
+        self.assertEqual((index.meta['rows'], index.meta['trained_rows']), (450, 400))
+        vector = self.store.vectors()[420]
+        self.assertEqual(index.search(vector, k=1)[0][0], 420)
+        # Retrained once the store has doubled
+        self.put(unit_vectors(400, 16, seed=2))
+        self.assertEqual(index.update(), 850)
+        self.assertEqual(len(index.appended_rows), 0)
+
+    def test_similar_songs(self):
+        with mock.patch.object(settings, 'EMBEDDINGS_DIR', self.directory):
+            hits = similar_songs('Artist', 'Song 3', k=4)
+            self.assertEqual(len(hits), 4)
+            self.assertNotIn(('Artist', 'Song 3'), [(artist, title) for artist, title, _ in hits])
+            self.assertEqual([score for *_, score in hits], sorted((score for *_, score in hits), reverse=True))
+            with self.assertRaises(KeyError):
+                similar_songs('Artist', 'Unknown')
+
+    def test_similar_songs_on_a_fresh_install(self):
+        with tempfile.TemporaryDirectory() as directory:
+            missing = os.path.join(directory, 'embeddings')
+            with mock.patch.object(settings, 'EMBEDDINGS_DIR', missing):
+                self.assertEqual(similar_songs('Artist', 'Song 3'), [])
+            # Nothing is created on the query path
+            self.assertFalse(os.path.exists(missing))
+
+    def test_queries_open_the_store_read_only(self):
+        size = os.path.getsize(self.store.vectors_path)
+        store = EmbeddingStore(self.directory, read_only=True)
+        self.addCleanup(store.close)
+        self.assertEqual(len(store), 400)
+        self.assertEqual(store.row_of('Artist', 'Song 7'), 7)
+        np.testing.assert_array_equal(store.vectors()[7], self.store.vectors()[7])
+        self.assertEqual(os.path.getsize(self.store.vectors_path), size)
+        with self.assertRaises(ValueError):
+            store.vectors()[0] = 0
+
+    def test_queries_never_update_the_index(self):
+        index = IVFIndex(self.store, nlist=10, nprobe=1)
+        index.update()
+        self.put(unit_vectors(20, 16, seed=3))
+        with mock.patch.object(settings, 'EMBEDDINGS_DIR', self.directory), \
+                mock.patch.object(IVFIndex, 'update', side_effect=AssertionError('updated on the query path')):
+            hits = similar_songs('Artist', 'Song 405', k=5)
+        self.assertEqual(IVFIndex(self.store).meta['rows'], 400)
+        # Songs embedded since the last update are scored exactly, whichever cluster they would fall in
+        vectors = self.store.vectors()
+        expected = [f'Song {row}' for row, _ in exact_search(vectors, vectors[405], k=5, exclude=405) if row >= 400]
+        self.assertTrue(expected)
+        self.assertLessEqual(set(expected), {title for _, title, _ in hits})
+        self.assertEqual(index.search(vectors[410], k=1)[0][0], 410)
+
+if __name__ == '__main__':
+    unittest.main()
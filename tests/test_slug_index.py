@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from config import settings
+from scripts.services import registry
+from scripts.slug_index import SlugIndex, guess_artist_slug, letter_of
+from scripts.scrape_discography import AZArtists
+from scripts.scrape_lyrics import AZLyrics
+from scripts.http_transport import HttpTransport
+from tests.stub_server import StubServer
+
+LETTER_P = '<div class="artist-col"><a href="//www.azlyrics.com/a.html">A</a><a href="p/pink.html">P!NK</a><br></div>'
+
+class TestSlugGuess(unittest.TestCase):
+
+    def test_only_a_leading_the_is_dropped(self):
+        self.assertEqual(guess_artist_slug('Theory of a Deadman'), 'theoryofadeadman')
+        self.assertEqual(guess_artist_slug('Heather Nova'), 'heathernova')
+        self.assertEqual(guess_artist_slug('The Academy Is...'), 'academyis')
+        self.assertEqual((letter_of('alltimelow'), letter_of('5sos')), ('a', '19'))
+
+class TestSlugIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.slugs = SlugIndex(':memory:')
+        self.enterContext(registry.override(slug_index=self.slugs))
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        patcher = mock.patch.object(settings, 'AZLYRICS_BASE_URL', self.server.base_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.transport = HttpTransport(retries=0)
+
+    def route(self, path: str, html: str):
+        file_path = os.path.join(self.tmp, f'{len(self.server.routes)}.html')
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(html)
+        self.server.routes[path] = file_path
+
+    def paths(self) -> list:
+        return [path for _, path in self.server.hits]
+
+    def test_letter_page_resolves_unguessable_slugs(self):
+        self.route('/p.html', LETTER_P)
+        self.server.routes['/lyrics/pink/sober.html'] = self.server.routes['/lyrics/alltimelow/weightless.html']
+        for _ in range(2):
+            self.assertIsNotNone(AZLyrics('P!nk', 'Sober', fetcher=self.transport).open_url())
+        # One letter page for the artist, then straight to the real lyrics URL
+        self.assertEqual(self.paths(), ['/p.html', '/lyrics/pink/sober.html'])
+        self.assertEqual(self.slugs.artist_slug('p!nk'), 'pink')
+        self.assertEqual(self.slugs.artist_slug('The Academy Is...'), None)
+
+    def test_discography_hrefs_are_used_for_lyrics(self):
+        # The site links this song under a slug that can't be guessed from its title
+        with open(self.server.routes['/a/alltimelow.html'], encoding='utf-8') as f:
+            self.route('/a/alltimelow.html', f.read().replace('dearmariacountmein.html', 'dearmaria.html'))
+        self.server.routes['/lyrics/alltimelow/dearmaria.html'] = self.server.routes['/lyrics/alltimelow/dearmariacountmein.html']
+
+        albums = AZArtists('The All Time Low', fetcher=self.transport).fetch_albums()
+        self.assertEqual(len(albums), 4)
+        self.assertEqual(self.slugs.song_href('All Time Low', 'Dear Maria, Count Me In'), 'lyrics/alltimelow/dearmaria.html')
+        lyrics, *_ = AZLyrics('All Time Low', 'Dear Maria, Count Me In', fetcher=self.transport).open_url()
+        self.assertIsNotNone(lyrics)
+        self.assertEqual(self.paths(), ['/a.html', '/a/alltimelow.html', '/lyrics/alltimelow/dearmaria.html'])
+
+    def test_index_persists(self):
+        path = os.path.join(self.tmp, 'slugs.sqlite')
+        slugs = SlugIndex(path)
+        self.assertEqual(slugs.load_letter('a', self.transport), 10)
+        slugs.add_songs('alltimelow', [('Weightless', '../lyrics/alltimelow/weightless.html')])
+        slugs.close()
+        slugs = SlugIndex(path)
+        self.addCleanup(slugs.close)
+        self.assertEqual(slugs.artist_slug('The Academy Is...'), 'academyis')
+        self.assertEqual(slugs.song_href('All Time Low', 'weightless'), 'lyrics/alltimelow/weightless.html')
+        # The letter was read recently, an unlisted artist is guessed without asking again
+        self.assertEqual(slugs.resolve('Another Artist', self.transport), 'anotherartist')
+        self.assertEqual(self.paths(), ['/a.html'])
+
+if __name__ == '__main__':
+    unittest.main()
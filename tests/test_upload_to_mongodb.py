@@ -0,0 +1,136 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+import mongomock
+from config import settings
+import scripts.upload_to_mongodb as upload
+from scripts.services import registry
+from scripts.slug_index import SlugIndex
+from scripts.similarity_index import similar_songs
+from scripts.search_index import SearchIndex
+from scripts.fetch_engine import FetchEngine
+from scripts.http_transport import HttpTransport
+from tests.stub_server import StubServer
+
+DISCOGRAPHY = [
+    {'title': 'Nothing Personal', 'songs': ['Weightless', 'The Other Side', 'Missing Song'], 'release_year': '2009'},
+    {'title': 'Singles', 'songs': ['Weightless', 'Dear Maria, Count Me In']}
+]
+
+class TestAddArtistToDb(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().lyrical_analysis_db
+        self.enterContext(registry.override(db=self.db, slug_index=SlugIndex(':memory:')))
+
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        patcher = mock.patch.object(settings, 'AZLYRICS_BASE_URL', self.server.base_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name in ('EMBEDDINGS_DIR', 'SEARCH_INDEX_DIR'):
+            patcher = mock.patch.object(settings, name, os.path.join(tmp.name, name.lower()))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.artist_file = os.path.join(tmp.name, 'All Time Low.json')
+        with open(self.artist_file, 'w', encoding='utf-8') as f:
+            json.dump(DISCOGRAPHY, f)
+
+    def add(self, **kwargs):
+        with FetchEngine(max_workers=2, rate=1000, jitter=(0, 0), session=HttpTransport()) as engine:
+            upload.add_artist_to_db(self.artist_file, engine=engine, **kwargs)
+
+    def assert_uploaded(self):
+        songs = {song['title']: song for song in self.db.songs.find()}
+        self.assertEqual(set(songs), {'Weightless', 'The Other Side', 'Dear Maria, Count Me In'})
+        self.assertEqual(songs['Weightless']['album'], 'Nothing Personal') # First album wins
+        self.assertEqual(songs['The Other Side']['genre'], 'Pop')
+        self.assertEqual(self.db.albums.count_documents({}), 2)
+        self.assertEqual(self.db.artists.count_documents({}), 1)
+
+    def test_add_artist(self):
+        self.add()
+        self.assert_uploaded()
+
+    def test_bulk_add_artist(self):
+        self.add(bulk=True, batch_size=2)
+        self.assert_uploaded()
+        index_keys = [index['key'] for index in self.db.songs.index_information().values()]
+        self.assertIn([('artist', 1), ('title', 1)], index_keys)
+
+    def test_uploaded_songs_are_indexed(self):
+        self.add()
+        hits = similar_songs('All Time Low', 'Weightless', k=5)
+        self.assertEqual({title for _, title, _ in hits}, {'The Other Side', 'Dear Maria, Count Me In'})
+        index = SearchIndex()
+        self.addCleanup(index.close)
+        self.assertEqual(index.search('"On the other side"'), [('All Time Low', 'The Other Side')])
+
+    def test_rerun_skips_existing_songs(self):
+        self.add(bulk=True)
+        hits = len(self.server.hits)
+        self.add(bulk=True)
+        # Only the song that failed the first time is requested again
+        self.assertEqual([path for _, path in self.server.hits[hits:]], ['/lyrics/alltimelow/missingsong.html'])
+        self.assertEqual(self.db.songs.count_documents({}), 3)
+
+    def write_versions(self):
+        # A live album whose 'Weightless (Live)' page has the same lyrics, the acoustic version has no page
+        self.server.routes['/lyrics/alltimelow/weightlesslive.html'] = self.server.routes['/lyrics/alltimelow/weightless.html']
+        with open(self.artist_file, 'w', encoding='utf-8') as f:
+            json.dump(DISCOGRAPHY + [{'title': 'Live', 'songs': ['Weightless (Live)', 'The Other Side (Acoustic)']}], f)
+
+    def test_duplicates_are_linked(self):
+        self.write_versions()
+        self.add(link_duplicates=True)
+        songs = {song['title']: song for song in self.db.songs.find()}
+        self.assertEqual(songs['Weightless (Live)']['duplicate_of'], 'Weightless')
+        self.assertNotIn('lyrics', songs['Weightless (Live)'])
+        self.assertNotIn('duplicate_of', songs['Weightless'])
+        self.assertNotIn('The Other Side (Acoustic)', songs)
+        # Linked duplicates are left out of the similarity index
+        self.assertEqual(len(similar_songs('All Time Low', 'Weightless', k=5)), 2)
+
+    def test_duplicate_titles_are_skipped(self):
+        self.write_versions()
+        self.add(skip_duplicates=True, link_duplicates=True)
+        self.assertFalse([path for _, path in self.server.hits if 'live' in path or 'acoustic' in path])
+        linked = {song['title']: song['duplicate_of'] for song in self.db.songs.find({'duplicate_of': {'$exists': True}})}
+        self.assertEqual(linked, {'Weightless (Live)': 'Weightless', 'The Other Side (Acoustic)': 'The Other Side'})
+
+    def test_reparse_only_restales_changed_lyrics(self):
+        self.write_versions()
+        transport = HttpTransport()
+        with FetchEngine(max_workers=2, rate=1000, jitter=(0, 0), session=transport) as engine:
+            upload.add_artist_to_db(self.artist_file, engine=engine, link_duplicates=True)
+        self.db.songs.update_many({}, {'$unset': {'sentiment_stale': ''}})
+        self.db.songs.update_one({'title': 'The Other Side'}, {'$set': {'lyrics': 'old parse', 'lyrics_hash': 'old', 'genre': None}})
+        with mock.patch.object(upload, 'get_transport', return_value=transport):
+            self.assertEqual(upload.reparse_cached_songs('All Time Low'), 3)
+        songs = {song['title']: song for song in self.db.songs.find()}
+        self.assertTrue(songs['The Other Side']['sentiment_stale'])
+        self.assertEqual(songs['The Other Side']['genre'], 'Pop')
+        self.assertNotIn('sentiment_stale', songs['Weightless'])
+        # Linked duplicates keep pointing at their original instead of getting lyrics back
+        self.assertNotIn('lyrics', songs['Weightless (Live)'])
+
+class TestBulkUpserter(unittest.TestCase):
+
+    def test_batches_and_keeps_existing(self):
+        songs = mongomock.MongoClient().db.songs
+        songs.insert_one({'artist': 'A', 'title': 'x', 'lyrics': 'original'})
+        with mock.patch.object(songs, 'bulk_write', wraps=songs.bulk_write) as bulk_write:
+            with upload.BulkUpserter(songs, batch_size=2) as writer:
+                for title in ('x', 'y', 'z'):
+                    writer.add({'artist': 'A', 'title': title, 'lyrics': 'new'})
+        self.assertEqual(bulk_write.call_count, 2)
+        self.assertEqual(writer.written, 2)
+        self.assertEqual(songs.find_one({'title': 'x'})['lyrics'], 'original')
+
+if __name__ == '__main__':
+    unittest.main()